@@ -17,35 +17,13 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-import os
-import signal
 import sys
 sys.path.insert(0,'/usr/lib/molecule/')
 sys.path.insert(0,'molecule/')
 sys.path.insert(0,'.')
 import molecule.cmdline
-from molecule.handlers import Runner
 
-parse_data = molecule.cmdline.parse()
-if parse_data is None:
-    raise SystemExit(1)
-molecule_data, molecule_data_order = parse_data
-if not molecule_data_order:
-    molecule.cmdline.print_help()
-    raise SystemExit(1)
-
-for el in molecule_data_order:
-    my = Runner(el, molecule_data.get(el))
-    try:
-        rc = my.run()
-    except KeyboardInterrupt:
-        while True:
-            my.kill()
-            break
-        raise SystemExit(1)
-    while True:
-        my.kill()
-        break
-    if rc != 0:
-        raise SystemExit(rc)
-raise SystemExit(0)
+rc = molecule.cmdline.run_command()
+if rc is None:
+    rc = molecule.cmdline.execute()
+raise SystemExit(rc)
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+asyncio based execution engine, Python 3 only.
+"""
+import os
+import time
+import asyncio
+import threading
+
+import molecule.utils
+from molecule.i18n import _
+from molecule.output import brown, darkgreen
+from molecule.handlers import Runner
+
+
+async def async_exec_cmd(args, env = None, timeout = None):
+    """
+    asyncio variant of molecule.utils.exec_cmd(). If the command does not
+    terminate within timeout seconds or the calling task is cancelled,
+    the child process is terminated (SIGTERM, then SIGKILL).
+
+    @param args: command arguments
+    @type args: list
+    @keyword env: environment, inherited if None
+    @type env: dict
+    @keyword timeout: timeout in seconds
+    @type timeout: float
+    @return: exit status
+    @rtype: int
+    @raise asyncio.TimeoutError: if the command timed out
+    """
+    proc = await asyncio.create_subprocess_exec(*args, env = env)
+    try:
+        return await asyncio.wait_for(proc.wait(), timeout)
+    except BaseException:
+        if proc.returncode is None:
+            try:
+                proc.terminate()
+                try:
+                    await asyncio.wait_for(proc.wait(), 10.0)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await proc.wait()
+            except ProcessLookupError:
+                pass
+        raise
+
+async def async_exec_chroot_cmd(args, chroot, pre_chroot = None, env = None,
+    timeout = None):
+    """
+    asyncio variant of molecule.utils.exec_chroot_cmd(), see
+    async_exec_cmd().
+    """
+    if pre_chroot is None:
+        pre_chroot = []
+    if env is None:
+        env = os.environ.copy()
+    exec_args = pre_chroot + ["chroot", chroot] + args
+    return await async_exec_cmd(exec_args, env = env, timeout = timeout)
+
+
+class AsyncRunner(Runner):
+
+    """
+    Runner variant built on asyncio, supporting per-step and per-spec
+    timeouts and cooperative cancellation.
+
+    GenericExecutionStep hooks can either be coroutine functions (which
+    are awaited and cancelled on timeout) or plain methods, executed in
+    worker threads: on timeout, child processes they spawned through
+    molecule.utils are terminated. In both cases, the step kill() hook is
+    called with success = False and the step fails.
+
+    A thread cannot be interrupted: a plain hook that times out is only
+    stopped through its child processes (signaled until the hook
+    returns), kill() is called once it returned. A plain hook blocked in
+    pure Python code thus delays the timeout until it returns by itself.
+    """
+
+    def __init__(self, spec_path, metadata, step_timeout = None,
+        timeout = None, **kwargs):
+        """
+        Object constructor.
+
+        @keyword step_timeout: maximum execution time of a single step,
+            in seconds
+        @type step_timeout: float
+        @keyword timeout: maximum execution time of the whole spec file,
+            in seconds
+        @type timeout: float
+
+        See Runner for the other arguments.
+        """
+        Runner.__init__(self, spec_path, metadata, **kwargs)
+        self._step_timeout = step_timeout
+        self._timeout = timeout
+        self._deadline = None
+
+    def _remaining(self, step_deadline):
+        deadlines = [x for x in (step_deadline, self._deadline) \
+                         if x is not None]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.time())
+
+    def _start_hook_thread(self, my, name, **kwargs):
+        """
+        Call the given hook of the GenericExecutionStep instance in a new
+        daemon thread (which, unlike concurrent.futures ones, does not
+        block interpreter exit). Return the thread and a future bound to
+        the running event loop, set once the hook returned.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def _set_result(result, exc):
+            if future.done():
+                return
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+        def _call():
+            result, exc = None, None
+            try:
+                result = self._call_hook(my, name, **kwargs)
+            except BaseException as err:
+                exc = err
+            try:
+                loop.call_soon_threadsafe(_set_result, result, exc)
+            except RuntimeError:
+                # event loop closed, nobody is waiting anymore
+                pass
+
+        th = threading.Thread(target = _call,
+            name = "%s.%s" % (self.spec_name, name,))
+        th.daemon = True
+        th.start()
+        return th, future
+
+    async def _join_hook_thread(self, my, name, th, future):
+        """
+        Wait for a timed out or cancelled hook thread to return,
+        terminating the child processes it spawns in the meantime.
+        """
+        waiting = False
+        while True:
+            molecule.utils.kill_children(thread_ident = th.ident)
+            done, _pending = await asyncio.wait([future], timeout = 1.0)
+            if done:
+                break
+            if not waiting:
+                waiting = True
+                self._output.output("[%s|%s] %s: %s.%s()" % (
+                        darkgreen("Runner"), brown(self.spec_name),
+                        _("waiting for hook to return"),
+                        my.__class__.__name__, name,),
+                    type = "warning"
+                )
+        if not future.cancelled():
+            # consume the outcome, the hook failed anyway
+            future.exception()
+
+    async def _call_hook_async(self, my, name, timeout = None, **kwargs):
+        """
+        Call the given hook of the GenericExecutionStep instance, in a
+        worker thread if it is not a coroutine function. On timeout or
+        cancellation, a worker thread hook is waited for before raising,
+        so that kill() never runs concurrently with it.
+        """
+        hook = getattr(my, name)
+        if asyncio.iscoroutinefunction(hook):
+            with self._hook_span(my, name):
+                return await asyncio.wait_for(hook(**kwargs), timeout)
+
+        th, future = self._start_hook_thread(my, name, **kwargs)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            await self._join_hook_thread(my, name, th, future)
+            raise
+
+    async def _execute_hooks_async(self, my, step_deadline):
+        for name in ("setup", "pre_run", "run", "post_run"):
+            rc = await self._call_hook_async(my, name,
+                timeout = self._remaining(step_deadline))
+            if rc:
+                return rc
+        return 0
+
+    async def _execute_step_async(self, myclass, count):
+        step = self._prepare_step(myclass, count)
+        if step is None:
+            return 0
+        my, step_id, cache_key, outputs = step
+
+        step_deadline = None
+        if self._step_timeout is not None:
+            step_deadline = time.time() + self._step_timeout
+
+        try:
+            rc = await self._execute_hooks_async(my, step_deadline)
+        except asyncio.TimeoutError:
+            self._output.output( "[%s|%s] %s %s" % (
+                    darkgreen("Runner"), brown(self.spec_name),
+                    _("timed out"), str(myclass),),
+                count = count, type = "error"
+            )
+            try:
+                await self._call_hook_async(my, "kill", success = False)
+            finally:
+                self._stop_accounting(my, step_id, 1)
+            return 1
+        except BaseException:
+            try:
+                await asyncio.shield(
+                    self._call_hook_async(my, "kill", success = False))
+            finally:
+                self._stop_accounting(my, step_id, None)
+            raise
+
+        await self._call_hook_async(my, "kill", success = rc == 0)
+        self._stop_accounting(my, step_id, rc)
+        if rc == 0:
+            self._complete_step(step_id, cache_key, outputs)
+        return rc
+
+    async def _execute_group_async(self, group, maxcount):
+        results = await asyncio.gather(
+            *[self._execute_step_async(myclass, (position, maxcount,)) \
+                  for position, myclass in group],
+            return_exceptions = True)
+        rc = 0
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+            if result and not rc:
+                rc = result
+        return rc
+
+    async def run_async(self):
+        """
+        Coroutine executing the spec file, return the exit status. Several
+        AsyncRunner instances can be executed by the same event loop.
+        """
+        if self._timeout is not None:
+            self._deadline = time.time() + self._timeout
+        groups, maxcount = self._begin()
+        for group in groups:
+            if len(group) == 1:
+                position, myclass = group[0]
+                rc = await self._execute_step_async(
+                    myclass, (position, maxcount,))
+            else:
+                rc = await self._execute_group_async(group, maxcount)
+            if rc:
+                return rc
+
+        self._end()
+        return 0
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(self.run_async())
+        try:
+            return loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            # cooperative cancellation, steps get kill(success = False)
+            task.cancel()
+            try:
+                loop.run_until_complete(task)
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                pass
+            raise
+        finally:
+            loop.close()
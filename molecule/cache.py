@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+import errno
+import json
+import hashlib
+import threading
+
+import molecule.utils
+from molecule.compat import convert_to_rawstring
+
+
+def _hash_path(path, hasher):
+    """
+    Feed the content of the given path (file or directory tree) into
+    hasher.
+    """
+    if os.path.islink(path):
+        hasher.update(convert_to_rawstring("link:%s\0" % (os.readlink(path),)))
+    elif os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                hasher.update(convert_to_rawstring("%s\0" % (
+                    os.path.relpath(file_path, path),)))
+                _hash_path(file_path, hasher)
+    elif os.path.isfile(path):
+        molecule.utils.feed_hashers(path, [hasher])
+    else:
+        hasher.update(convert_to_rawstring("missing\0"))
+
+def _copy_path(src, dest):
+    """
+    Make dest a copy of src, using reflinks when the filesystem supports
+    them. Hard links are never used: an in-place edit of a restored
+    output (or of a just stored one) would silently modify the cache
+    entry as well.
+    """
+    dest_dir = os.path.dirname(dest)
+    if dest_dir and not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir, 0o755)
+    molecule.utils.copy_tree(src, dest, mode = "auto")
+
+def _remove_path(path):
+    """
+    Remove the given literal path (no glob expansion), if it exists.
+    """
+    if not os.path.lexists(path):
+        return
+    if os.path.isdir(path) and not os.path.islink(path):
+        molecule.utils.remove_tree(path)
+    else:
+        os.remove(path)
+
+def _path_size(path):
+    """
+    Return the apparent size of the given path (file or directory tree).
+    """
+    if os.path.islink(path) or not os.path.isdir(path):
+        return os.lstat(path).st_size
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+    return size
+
+
+class StepCache(object):
+
+    """
+    Content addressed cache of GenericExecutionStep outputs, stored inside
+    the Molecule temporary directory. Entries are keyed by the spec file
+    metadata fingerprint, the step class and the content of the step
+    declared input files (see GenericExecutionStep.cache_inputs() and
+    GenericExecutionStep.cache_outputs()). Outputs are stored and restored
+    by copy (reflink, whenever the filesystem supports it), least
+    recently used entries are evicted when the cache grows bigger than
+    its maximum size.
+    """
+
+    CACHE_DIR = "molecule-cache"
+    _MANIFEST = "manifest"
+    _DATA_DIR = "data"
+
+    def __init__(self, cache_dir = None, max_size = None):
+        """
+        Object constructor.
+
+        @keyword cache_dir: cache directory, <tmp_dir>/molecule-cache if None
+        @type cache_dir: string
+        @keyword max_size: maximum cache size in bytes, Configuration
+            cache_max_size if None
+        @type max_size: int
+        """
+        if (cache_dir is None) or (max_size is None):
+            import molecule.settings
+            config = molecule.settings.Configuration()
+            if cache_dir is None:
+                cache_dir = os.path.join(config['tmp_dir'],
+                    StepCache.CACHE_DIR)
+            if max_size is None:
+                max_size = config['cache_max_size']
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+    def cache_dir(self):
+        """
+        Return the cache directory path.
+        """
+        return self._cache_dir
+
+    def key(self, fingerprint, step_class, inputs):
+        """
+        Compute the cache key of a step.
+
+        @param fingerprint: spec file metadata fingerprint
+        @type fingerprint: string
+        @param step_class: GenericExecutionStep class
+        @type step_class: class
+        @param inputs: list of input paths
+        @type inputs: list
+        @return: cache key
+        @rtype: string
+        """
+        hasher = hashlib.sha256()
+        hasher.update(convert_to_rawstring("%s\0%s.%s\0" % (
+            fingerprint, step_class.__module__, step_class.__name__,)))
+        for path in sorted(set(inputs)):
+            hasher.update(convert_to_rawstring("%s\0" % (path,)))
+            _hash_path(path, hasher)
+        return hasher.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self._cache_dir, key)
+
+    def _read_manifest(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, StepCache._MANIFEST), "r") \
+                    as manifest_f:
+                return json.load(manifest_f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def restore(self, key, outputs):
+        """
+        Restore the outputs of the given cache entry.
+
+        @param key: cache key, see key()
+        @type key: string
+        @param outputs: list of output paths
+        @type outputs: list
+        @return: True, if the entry was found and outputs restored
+        @rtype: bool
+        """
+        entry_dir = self._entry_dir(key)
+        manifest = self._read_manifest(entry_dir)
+        if manifest is None or manifest.get('outputs') != list(outputs):
+            return False
+
+        data_dir = os.path.join(entry_dir, StepCache._DATA_DIR)
+        for index, path in enumerate(outputs):
+            cached_path = os.path.join(data_dir, str(index))
+            if not os.path.lexists(cached_path):
+                # output did not exist at store time
+                continue
+            _remove_path(path)
+            _copy_path(cached_path, path)
+
+        # LRU bookkeeping
+        os.utime(os.path.join(entry_dir, StepCache._MANIFEST), None)
+        return True
+
+    def store(self, key, outputs):
+        """
+        Store the given outputs into the cache, evicting least recently
+        used entries if needed.
+
+        @param key: cache key, see key()
+        @type key: string
+        @param outputs: list of output paths
+        @type outputs: list
+        """
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+
+        if not os.path.isdir(self._cache_dir):
+            try:
+                os.makedirs(self._cache_dir, 0o755)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+        tmp_dir = os.path.join(self._cache_dir, ".tmp-%s-%d-%d" % (
+            key, os.getpid(), threading.current_thread().ident,))
+        try:
+            data_dir = os.path.join(tmp_dir, StepCache._DATA_DIR)
+            os.makedirs(data_dir, 0o755)
+            size = 0
+            for index, path in enumerate(outputs):
+                if not os.path.lexists(path):
+                    continue
+                cached_path = os.path.join(data_dir, str(index))
+                _copy_path(path, cached_path)
+                size += _path_size(cached_path)
+
+            with open(os.path.join(tmp_dir, StepCache._MANIFEST), "w") \
+                    as manifest_f:
+                json.dump({'outputs': list(outputs), 'size': size},
+                    manifest_f)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # stored by somebody else in the meantime
+                pass
+        finally:
+            _remove_path(tmp_dir)
+
+        self.prune()
+
+    def _entries(self):
+        """
+        Return a list of (last used timestamp, size, entry directory)
+        tuples, sorted from the least recently used one.
+        """
+        entries = []
+        try:
+            names = os.listdir(self._cache_dir)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return entries
+
+        for name in names:
+            if name.startswith("."):
+                continue
+            entry_dir = self._entry_dir(name)
+            manifest = self._read_manifest(entry_dir)
+            if manifest is None:
+                continue
+            try:
+                last_used = os.stat(os.path.join(
+                    entry_dir, StepCache._MANIFEST)).st_mtime
+            except OSError:
+                continue
+            entries.append((last_used, manifest.get('size', 0), entry_dir))
+        entries.sort()
+        return entries
+
+    def stats(self):
+        """
+        Return cache statistics.
+
+        @return: dict with "entries", "size" and "max_size" keys
+        @rtype: dict
+        """
+        entries = self._entries()
+        return {
+            'entries': len(entries),
+            'size': sum(x[1] for x in entries),
+            'max_size': self._max_size,
+        }
+
+    def prune(self, max_size = None):
+        """
+        Evict least recently used entries until the cache size fits
+        max_size (the cache maximum size if None).
+
+        @keyword max_size: target size in bytes
+        @type max_size: int
+        @return: tuple composed by the number of evicted entries and the
+            amount of freed bytes
+        @rtype: tuple
+        """
+        if max_size is None:
+            max_size = self._max_size
+
+        with self._lock:
+            entries = self._entries()
+            size = sum(x[1] for x in entries)
+            evicted, freed = 0, 0
+            for last_used, entry_size, entry_dir in entries:
+                if size <= max_size:
+                    break
+                molecule.utils.remove_path(entry_dir, defer = True)
+                size -= entry_size
+                freed += entry_size
+                evicted += 1
+            return evicted, freed
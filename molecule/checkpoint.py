@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+import errno
+import hashlib
+import threading
+
+from molecule.compat import convert_to_rawstring, convert_to_unicode
+
+
+def metadata_fingerprint(metadata):
+    """
+    Return a fingerprint (hex string) of the given parsed spec file
+    metadata. Internal keys ("__plugin__", etc) are ignored, the plugin
+    class name is taken into account instead.
+
+    @param metadata: metadata as returned by SpecParser.parse()
+    @type metadata: dict
+    @return: fingerprint
+    @rtype: string
+    """
+    items = sorted((k, v) for k, v in metadata.items() \
+                       if not k.startswith("__"))
+    plugin = metadata.get('__plugin__')
+    if plugin is not None:
+        klass = plugin.__class__
+        items.append(("__plugin__", "%s.%s" % (
+            klass.__module__, klass.__name__,)))
+    return hashlib.sha1(convert_to_rawstring(repr(items))).hexdigest()
+
+
+class CheckpointJournal(object):
+
+    """
+    Per-spec journal of the completed GenericExecutionStep classes, stored
+    inside the Molecule temporary directory. Every record carries the
+    metadata fingerprint it has been written with, so that changing the
+    spec file invalidates it.
+    """
+
+    JOURNAL_DIR = "molecule-checkpoints"
+
+    def __init__(self, spec_path, fingerprint, tmp_dir = None):
+        """
+        Object constructor.
+
+        @param spec_path: spec file path
+        @type spec_path: string
+        @param fingerprint: metadata fingerprint, see metadata_fingerprint()
+        @type fingerprint: string
+        @keyword tmp_dir: base directory, Configuration tmp_dir if None
+        @type tmp_dir: string
+        """
+        if tmp_dir is None:
+            import molecule.settings
+            tmp_dir = molecule.settings.Configuration()['tmp_dir']
+        real_path = os.path.realpath(spec_path)
+        path_hash = hashlib.sha1(convert_to_rawstring(real_path)).hexdigest()
+        self._path = os.path.join(tmp_dir, CheckpointJournal.JOURNAL_DIR,
+            "%s-%s.journal" % (os.path.basename(real_path), path_hash[:12],))
+        self._fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self._completed = None
+
+    def path(self):
+        """
+        Return the journal file path.
+        """
+        return self._path
+
+    def _load(self):
+        completed = set()
+        try:
+            with open(self._path, "r") as journal_f:
+                for line in journal_f.readlines():
+                    try:
+                        fingerprint, step_id = line.rstrip("\n").split(" ", 1)
+                    except ValueError:
+                        # truncated record, ignore
+                        continue
+                    if fingerprint == self._fingerprint:
+                        completed.add(step_id)
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT:
+                raise
+        return completed
+
+    def is_completed(self, step_id):
+        """
+        Return whether the given step has been recorded as completed with
+        the current metadata fingerprint.
+        """
+        with self._lock:
+            if self._completed is None:
+                self._completed = self._load()
+            return step_id in self._completed
+
+    def record(self, step_id):
+        """
+        Record the given step as completed.
+        """
+        with self._lock:
+            journal_dir = os.path.dirname(self._path)
+            if not os.path.isdir(journal_dir):
+                try:
+                    os.makedirs(journal_dir, 0o755)
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
+            with open(self._path, "a") as journal_f:
+                journal_f.write("%s %s\n" % (self._fingerprint,
+                    convert_to_unicode(step_id),))
+                journal_f.flush()
+                os.fsync(journal_f.fileno())
+            if self._completed is not None:
+                self._completed.add(step_id)
+
+    def reset(self):
+        """
+        Drop all the recorded steps.
+        """
+        with self._lock:
+            self._completed = set()
+            try:
+                os.remove(self._path)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
@@ -18,33 +18,361 @@
 
 import os
 import sys
+import json
+import pickle
+import sqlite3
+import multiprocessing
 import molecule.utils
 import molecule.output
 from molecule.i18n import _
-from molecule.settings import SpecParser, Configuration
+from molecule.exception import SpecFileError
+from molecule.scheduler import SpecScheduler
+from molecule.settings import SpecParser, SpecPreprocessor, Configuration, \
+    get_include_loader
+from molecule.trace import Tracer
+from molecule.history import TimingHistory
+from molecule.speccache import SpecCache
 
-def parse():
+# boolean command line switches
+_BOOL_OPTIONS = ("--nocolor", "--help", "--fail-fast", "--resume",
+    "--cache", "--daemon", "--connect", "--plan", "--no-spec-cache",)
+# command line options taking a value, mapped to their value parser
+_VALUE_OPTIONS = {
+    "--jobs": int,
+    "--socket": str,
+    "--timeout": float,
+    "--step-timeout": float,
+    "--trace": str,
+    "--report": str,
+}
+_DEFAULT_OPTIONS = {
+    "jobs": 1,
+    "socket": None,
+    "timeout": None,
+    "step_timeout": None,
+    "trace": None,
+    "report": None,
+}
 
+def _option_key(option):
+    return option.lstrip("-").replace("-", "_")
+
+def parse_options(args = None):
+    """
+    Split command line arguments (sys.argv[1:] if args is None) into
+    options and the remaining arguments (spec files).
+    Return a tuple composed by a dict (key=option name without leading
+    dashes, "-" replaced by "_", value=option value) and a list of
+    the remaining arguments.
+    Raise ValueError if an option value is missing or invalid.
+    """
+    if args is None:
+        args = sys.argv[1:]
+
+    options = dict((_option_key(x), False) for x in _BOOL_OPTIONS)
+    options.update(_DEFAULT_OPTIONS)
+    remaining = []
+
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in _BOOL_OPTIONS:
+            options[_option_key(arg)] = True
+            continue
+
+        opt, value = arg, None
+        if "=" in arg:
+            opt, value = arg.split("=", 1)
+        value_parser = _VALUE_OPTIONS.get(opt)
+        if value_parser is None:
+            remaining.append(arg)
+            continue
+
+        if value is None:
+            if not args:
+                raise ValueError("%s: %s" % (opt, _("missing value"),))
+            value = args.pop(0)
+        try:
+            options[_option_key(opt)] = value_parser(value)
+        except (ValueError, TypeError):
+            raise ValueError("%s: %s: %s" % (opt, _("invalid value"), value,))
+
+    if options["jobs"] < 1:
+        raise ValueError("--jobs: %s: %s" % (
+            _("invalid value"), options["jobs"],))
+    for opt in ("timeout", "step_timeout"):
+        if (options[opt] is not None) and options[opt] <= 0:
+            raise ValueError("--%s: %s: %s" % (opt.replace("_", "-"),
+                _("invalid value"), options[opt],))
+
+    return options, remaining
+
+def _cache_command(args):
+    """
+    Handle "cache stats" and "cache prune [<max size in bytes>]".
+    """
+    from molecule.cache import StepCache
+
+    def _mib(size):
+        return "%.1f MiB" % (float(size) / (1024 * 1024),)
+
+    cache = StepCache()
+    if args == ["stats"]:
+        stats = cache.stats()
+        molecule.output.print_info("%s: %s" % (_("cache directory"),
+            cache.cache_dir(),))
+        molecule.output.print_info("%s: %s" % (_("entries"),
+            stats['entries'],))
+        molecule.output.print_info("%s: %s / %s" % (_("size"),
+            _mib(stats['size']), _mib(stats['max_size']),))
+        return 0
+
+    if args and args[0] == "prune" and len(args) < 3:
+        max_size = None
+        if len(args) == 2:
+            try:
+                max_size = int(args[1])
+            except ValueError:
+                max_size = -1
+            if max_size < 0:
+                molecule.output.print_error("%s: %s" % (
+                    _("invalid size"), args[1],))
+                return 1
+        evicted, freed = cache.prune(max_size = max_size)
+        # evicted entries are removed in background, actually free them
+        molecule.utils.get_trash().wait()
+        molecule.output.print_info("%s: %s, %s: %s" % (
+            _("evicted entries"), evicted, _("freed"), _mib(freed),))
+        return 0
+
+    print_help()
+    return 1
+
+def _daemon_command(args, options):
+    """
+    Handle "daemon status" and "daemon cancel <job id>".
+    """
+    from molecule.daemon import DaemonClient
+
+    client = DaemonClient(options["socket"])
+    if args == ["status"]:
+        return client.status()
+    if len(args) == 2 and args[0] == "cancel":
+        try:
+            job_id = int(args[1])
+        except ValueError:
+            molecule.output.print_error("%s: %s" % (
+                _("invalid job id"), args[1],))
+            return 1
+        return client.cancel(job_id)
+
+    print_help()
+    return 1
+
+_COMMANDS = {
+    "cache": lambda args, options: _cache_command(args),
+    "daemon": _daemon_command,
+}
+
+def run_command(args = None):
+    """
+    Execute the command (for example: "cache") passed in args
+    (sys.argv[1:] if None), if any.
+    Return the command exit status or None if no command has been passed.
+    """
+    try:
+        options, args = parse_options(args)
+    except ValueError as err:
+        molecule.output.print_error(str(err))
+        return 1
+
+    if not args or args[0] not in _COMMANDS:
+        return None
+    if options["nocolor"]:
+        molecule.output.nocolor()
+    return _COMMANDS[args[0]](args[1:], options)
+
+def execute(args = None):
+    """
+    Execute the spec files passed in args (sys.argv[1:] if None), return
+    the exit status. When --daemon is passed, a BuildDaemon is started
+    instead, when --connect is passed, spec files are executed by the
+    BuildDaemon.
+    """
+    try:
+        options, _args = parse_options(args)
+    except ValueError as err:
+        molecule.output.print_error(str(err))
+        return 1
+
+    if options["daemon"]:
+        from molecule.daemon import BuildDaemon
+        return BuildDaemon(options["socket"]).serve_forever()
+    if options["connect"]:
+        from molecule.daemon import DaemonClient
+        if args is None:
+            args = sys.argv[1:]
+        return DaemonClient(options["socket"]).build(args)
+
+    parse_data = parse(args)
+    if parse_data is None:
+        return 1
+    data, data_order = parse_data
+    if not data_order:
+        print_help()
+        return 1
+
+    tracer = None
+    if options['trace']:
+        tracer = Tracer()
+    history = TimingHistory()
+
+    try:
+        scheduler = SpecScheduler(data, data_order,
+            jobs = options['jobs'], fail_fast = options['fail_fast'],
+            resume = options['resume'], use_cache = options['cache'],
+            timeout = options['timeout'],
+            step_timeout = options['step_timeout'], tracer = tracer,
+            history = history)
+    except SpecFileError as err:
+        molecule.output.print_error(str(err))
+        history.close()
+        return 1
+
+    if options['plan']:
+        print_plan(scheduler, data, data_order, history)
+        history.close()
+        return 0
+
+    try:
+        rc = scheduler.run()
+    except KeyboardInterrupt:
+        rc = 1
+    history.close()
+
+    if tracer is not None:
+        tracer.print_summary()
+        try:
+            tracer.write(options['trace'])
+        except (IOError, OSError) as err:
+            molecule.output.print_error("%s: %s" % (
+                _("cannot write trace file"), err,))
+
+    if options['report']:
+        try:
+            write_report(options['report'], scheduler, data_order)
+        except (IOError, OSError) as err:
+            molecule.output.print_error("%s: %s" % (
+                _("cannot write report file"), err,))
+
+    # the removal thread does not survive the process
+    molecule.utils.get_trash().wait()
+    return rc
+
+def _format_duration(duration):
+    if duration is None:
+        return _("unknown")
+    return "%dm%05.2fs" % (int(duration) // 60, duration % 60,)
+
+def print_plan(scheduler, data, data_order, history):
+    """
+    Print the expected duration of the spec files (and of their steps)
+    and the critical path, according to the timing history.
+
+    @param scheduler: SpecScheduler instance
+    @type scheduler: molecule.scheduler.SpecScheduler
+    @param data: dict (key=spec file, value=metadata) as returned by
+        parse()
+    @type data: dict
+    @param data_order: spec file order
+    @type data_order: list
+    @param history: timing history
+    @type history: molecule.history.TimingHistory
+    """
+    expected, critical_path, critical_duration = scheduler.plan()
+    deps = scheduler.dependencies()
+    total = 0.0
+    for spec_path in data_order:
+        duration = expected.get(spec_path)
+        if duration is not None:
+            total += duration
+        molecule.output.print_info("%s: %s" % (
+            molecule.output.brown(spec_path), _format_duration(duration),))
+        if deps[spec_path]:
+            molecule.output.print_info("  %s: %s" % (
+                _("depends on"), ", ".join(deps[spec_path]),))
+
+        try:
+            steps = history.expected_steps(spec_path)
+        except sqlite3.Error as err:
+            molecule.output.print_warning("%s: %s" % (
+                _("cannot read timing history"), err,))
+            steps = {}
+        plugin = data[spec_path]['__plugin__']
+        for item in plugin.execution_steps():
+            if not isinstance(item, (list, tuple)):
+                item = (item,)
+            for myclass in item:
+                name = "%s.%s" % (myclass.__module__, myclass.__name__,)
+                molecule.output.print_info("  %10s  %s" % (
+                    _format_duration(steps.get(name)), name,))
+
+    molecule.output.print_info("%s: %s" % (
+        _("expected sequential duration"), _format_duration(total),))
+    molecule.output.print_info("%s: %s (%s)" % (
+        _("critical path"), " -> ".join(critical_path),
+        _format_duration(critical_duration),))
+
+def write_report(path, scheduler, data_order):
     """
-    Parse .spec files passed in sys.argv and returns a tuple composed by
-    a dict (key=spec file, value=metadata) and a list (spec file order).
+    Write a JSON report of the executed spec files and of the resource
+    usage of their steps (see Runner.step_results()) to path.
+
+    @param path: report file path
+    @type path: string
+    @param scheduler: SpecScheduler instance, after run()
+    @type scheduler: molecule.scheduler.SpecScheduler
+    @param data_order: spec file order
+    @type data_order: list
+    """
+    results = scheduler.results()
+    skipped = scheduler.skipped()
+    step_results = scheduler.step_results()
+    specs = []
+    for spec_path in data_order:
+        specs.append({
+            'spec': spec_path,
+            'rc': results.get(spec_path),
+            'skipped': spec_path in skipped,
+            'steps': step_results.get(spec_path, []),
+        })
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as report_f:
+        json.dump({'specs': specs}, report_f, indent = 2, sort_keys = True)
+    os.rename(tmp_path, path)
+
+def parse(args = None):
+
+    """
+    Parse .spec files passed in args (sys.argv[1:] if None) and returns
+    a tuple composed by a dict (key=spec file, value=metadata) and a list
+    (spec file order).
     Can return None if an error occurs.
     """
 
-    args_to_remove = ["--nocolor"]
     data = {}
 
-    myargs = sys.argv[1:]
+    try:
+        options, myargs = parse_options(args)
+    except ValueError as err:
+        molecule.output.print_error(str(err))
+        return None
 
-    if "--nocolor" in myargs:
+    if options["nocolor"]:
         molecule.output.nocolor()
-    if "--help" in myargs:
+    if options["help"]:
         return data, []
 
-    for arg in args_to_remove:
-        if arg in myargs:
-            myargs.remove(arg)
-
     def check_super_user(el_data):
         # check is super user is required
         su_required = el_data['__plugin__'].require_super_user()
@@ -54,22 +382,130 @@ def parse():
             return False
         return True
 
+    spec_cache = None
+    if not options["no_spec_cache"]:
+        spec_cache = SpecCache()
+
+    spec_paths = [x for x in myargs if os.path.isfile(x) and \
+                      os.access(x, os.R_OK)]
+    results = parse_specs(spec_paths, spec_cache = spec_cache)
+    errors = [(x, y) for x, z, y in results if y is not None]
+    if errors:
+        for el, error in errors:
+            molecule.output.print_error("%s: %s" % (el, error,))
+        return None
+
     super_user = molecule.utils.is_super_user()
     data_order = []
-    for el in myargs:
-        if os.path.isfile(el) and os.access(el, os.R_OK):
-            obj = SpecParser(el)
-            el_data = obj.parse()
-            del obj
-            if el_data:
-                el_data['__plugin__'].output(el_data)
-                good = check_super_user(el_data)
-                if not good:
-                    return None
-                data_order.append(el)
-                data[el] = el_data
+    for el, el_data, error in results:
+        if el_data:
+            el_data['__plugin__'].output(el_data)
+            good = check_super_user(el_data)
+            if not good:
+                return None
+            data_order.append(el)
+            data[el] = el_data
     return data, data_order
 
+def _parse_spec(spec_path, spec_cache = None):
+    """
+    Parse a single spec file, return a tuple composed by its metadata
+    (None on error), the error message (None on success) and its include
+    graph (see SpecPreprocessor.includes()).
+    """
+    try:
+        parser = SpecParser(spec_path, spec_cache = spec_cache)
+        return parser.parse(), None, parser.includes()
+    except (SpecFileError, SpecPreprocessor.PreprocessorError) as err:
+        return None, str(err).strip(), {}
+    except (IOError, OSError, UnicodeError) as err:
+        return None, "%s: %s" % (err.__class__.__name__, err,), {}
+
+# SpecCache used by _parse_spec_worker(), inherited through fork()
+_WORKER_SPEC_CACHE = None
+
+def _parse_spec_worker(spec_path):
+    """
+    Parse a single spec file inside a parse_specs() worker process.
+    Plugin objects are not sent back to the parent process, which
+    creates its own, see parse_specs().
+    """
+    metadata, error, includes = _parse_spec(spec_path,
+        spec_cache = _WORKER_SPEC_CACHE)
+    strategy = None
+    if metadata is not None:
+        strategy = metadata['__plugin__'].execution_strategy()
+        metadata = dict((x, y) for x, y in metadata.items() \
+                            if x != '__plugin__')
+        try:
+            pickle.dumps(metadata)
+        except Exception:
+            # the parent process will parse it by itself
+            return spec_path, None, None, None, None
+    return spec_path, strategy, metadata, error, includes
+
+def parse_specs(spec_paths, spec_cache = None, processes = None):
+    """
+    Parse the given spec files in parallel, using a pool of worker
+    processes.
+
+    @param spec_paths: list of spec file paths
+    @type spec_paths: list
+    @keyword spec_cache: SpecCache to use, see SpecParser
+    @type spec_cache: molecule.speccache.SpecCache
+    @keyword processes: number of worker processes, the number of CPUs
+        if None
+    @type processes: int
+    @return: list of (spec file path, metadata, error message) tuples,
+        in spec_paths order. Exactly one of metadata and error message
+        is None.
+    @rtype: list
+    """
+    global _WORKER_SPEC_CACHE
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(spec_paths))
+    if processes < 2:
+        return [(x,) + _parse_spec(x, spec_cache = spec_cache)[:2] \
+                    for x in spec_paths]
+
+    # load the plugin manifest once, workers inherit it
+    from molecule.specs.factory import PluginFactory
+    spec_plugins = PluginFactory.get_spec_plugins()
+
+    mp = multiprocessing
+    if hasattr(multiprocessing, "get_context"):
+        mp = multiprocessing.get_context("fork")
+    _WORKER_SPEC_CACHE = spec_cache
+    pool = mp.Pool(processes = processes)
+    try:
+        # chunks let workers reuse the %import-ed fragments they loaded
+        chunksize = max(1, len(spec_paths) // (processes * 4))
+        worker_results = pool.map(_parse_spec_worker, spec_paths,
+            chunksize = chunksize)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _WORKER_SPEC_CACHE = None
+
+    loader = get_include_loader()
+    results = []
+    for spec_path, strategy, metadata, error, includes in worker_results:
+        if (metadata is None) and (error is None):
+            metadata, error = _parse_spec(spec_path,
+                spec_cache = spec_cache)[:2]
+        elif metadata is not None:
+            metadata['__plugin__'] = spec_plugins[strategy](spec_path)
+            for includer, included in includes.items():
+                for path in included:
+                    loader.add_include(includer, path)
+        results.append((spec_path, metadata, error))
+    return results
+
 def print_help():
     config = Configuration()
     help_data = [
@@ -82,10 +518,42 @@ def print_help():
         None,
         (1, '--help', 2, _('this output')),
         (1, '--nocolor', 1, _('disable colorized output')),
+        (1, '--no-spec-cache', 1,
+            _('always preprocess spec files, ignoring the cache')),
         None,
         (0, _('Application Options'), 0, None),
+        (1, '--jobs <N>', 1, _('execute up to N spec files in parallel')),
+        (1, '--fail-fast', 1,
+            _('stop the other spec files as soon as one fails')),
+        (1, '--resume', 2,
+            _('skip the steps completed by the previous execution')),
+        (1, '--cache', 2,
+            _('restore and store cacheable step outputs from/to cache')),
+        (1, '--timeout <secs>', 1,
+            _('terminate spec files running longer than given seconds')),
+        (1, '--step-timeout <secs>', 1,
+            _('terminate steps running longer than given seconds')),
+        (1, '--trace <file>', 1,
+            _('write hook timings to file (Chrome trace format)')),
+        (1, '--plan', 2,
+            _('print expected durations and critical path, then exit')),
+        (1, '--report <file>', 1,
+            _('write step resource usage report to file (JSON)')),
         (1, '<spec file path 1> <spec file path 2> ...', 1,
             _('execute against specified specification files')),
         None,
+        (0, _('Cache Commands'), 0, None),
+        (1, 'cache stats', 2, _('show step output cache statistics')),
+        (1, 'cache prune [<bytes>]', 1,
+            _('evict least recently used entries down to given size')),
+        None,
+        (0, _('Daemon Options'), 0, None),
+        (1, '--daemon', 2, _('start the build daemon')),
+        (1, '--connect', 2,
+            _('execute the spec files through the build daemon')),
+        (1, '--socket <path>', 1, _('build daemon socket path')),
+        (1, 'daemon status', 2, _('show build daemon queue')),
+        (1, 'daemon cancel <id>', 1, _('cancel a build daemon job')),
+        None,
     ]
     molecule.output.print_menu(help_data)
@@ -0,0 +1,907 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import io
+import os
+import sys
+import json
+import stat
+import errno
+import signal
+import socket
+import select
+import struct
+import threading
+
+import molecule
+import molecule.output
+import molecule.utils
+from molecule.compat import convert_to_rawstring, convert_to_unicode, \
+    is_python3, isstring
+from molecule.i18n import _
+from molecule.output import brown, darkgreen
+from molecule.specs.factory import PluginFactory
+
+# Both directions of the stream are sequences of frames: a type byte
+# followed by the payload length (network byte order) and the payload.
+# Build output is sent as-is inside output frames, so it can contain any
+# byte, daemon messages are JSON objects.
+_FRAME_HEADER = struct.Struct("!cI")
+_OUTPUT_FRAME = b"o"
+_MESSAGE_FRAME = b"m"
+_MAX_FRAME_SIZE = 16 * 1024 * 1024
+_SOCKET_DIR = "molecule-%d"
+_SOCKET_NAME = "molecule.sock"
+# execute() arguments that cannot be forwarded to the daemon
+_REJECTED_ARGS = ("--daemon", "--connect",)
+# struct ucred, see unix(7)
+_SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+_UCRED = struct.Struct("3i")
+
+
+def get_socket_path(socket_path = None):
+    """
+    Return the build daemon socket path,
+    <tmp_dir>/molecule-<uid>/molecule.sock if socket_path is None. The
+    socket directory is private to the user running the daemon.
+    """
+    if socket_path is not None:
+        return socket_path
+    import molecule.settings
+    return os.path.join(molecule.settings.Configuration()['tmp_dir'],
+        _SOCKET_DIR % (os.getuid(),), _SOCKET_NAME)
+
+def _make_private_dir(path):
+    """
+    Create the given directory with mode 0700, if it does not exist, and
+    make sure that nobody else than the current user can access it.
+    Raise EnvironmentError otherwise.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() \
+            or st.st_mode & 0o077:
+        raise EnvironmentError(errno.EPERM, "%s: %s" % (path,
+            _("not a private directory of the current user"),))
+
+def _peer_uid(sock):
+    """
+    Return the user id of the process at the other end of the given
+    Unix socket.
+    """
+    creds = sock.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED, _UCRED.size)
+    _pid, uid, _gid = _UCRED.unpack(creds)
+    return uid
+
+def _send_frame(conn, kind, payload):
+    conn.sendall(_FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+def _send_message(conn, message):
+    _send_frame(conn, _MESSAGE_FRAME,
+        convert_to_rawstring(json.dumps(message)))
+
+def _recv_exact(conn, size):
+    """
+    Read exactly size bytes from conn, return None at end of stream.
+    """
+    chunks = []
+    while size:
+        chunk = conn.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def _recv_frame(conn):
+    """
+    Read a frame from conn, return a (frame type, payload) tuple or None
+    at end of stream. Raise ValueError if the frame is malformed.
+    """
+    header = _recv_exact(conn, _FRAME_HEADER.size)
+    if header is None:
+        return None
+    kind, size = _FRAME_HEADER.unpack(header)
+    if kind not in (_OUTPUT_FRAME, _MESSAGE_FRAME) or size > _MAX_FRAME_SIZE:
+        raise ValueError(_("invalid frame"))
+    payload = _recv_exact(conn, size)
+    if payload is None:
+        raise ValueError(_("truncated frame"))
+    return kind, payload
+
+def _decode_message(payload):
+    """
+    Decode a message frame payload. Raise ValueError if it is not a
+    JSON object.
+    """
+    message = json.loads(convert_to_unicode(payload, enctype = "utf-8"))
+    if not isinstance(message, dict):
+        raise ValueError(_("invalid message"))
+    return message
+
+def _read_request(conn):
+    try:
+        frame = _recv_frame(conn)
+        if frame is None or frame[0] != _MESSAGE_FRAME:
+            return None
+        return _decode_message(frame[1])
+    except ValueError:
+        return None
+
+def _native(value):
+    """
+    Convert JSON decoded strings to the native string type.
+    """
+    if is_python3():
+        return value
+    return convert_to_rawstring(value, from_enctype = "utf-8")
+
+def _run_job(request, fd):
+    """
+    Execute the given build request in the current process, forked from
+    the BuildDaemon zygote, writing its output to fd. Return the exit
+    status.
+    """
+    import molecule.cmdline
+
+    def _stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.close(null_fd)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    # line buffered, output is streamed to the client
+    if is_python3():
+        sys.stdout = io.open(1, "w", buffering = 1, closefd = False)
+        sys.stderr = io.open(2, "w", buffering = 1, closefd = False)
+    else:
+        sys.stdout = os.fdopen(1, "w", 1)
+        sys.stderr = os.fdopen(2, "w", 1)
+
+    env = request.get("env")
+    if env is not None:
+        os.environ.clear()
+        os.environ.update(dict(
+            (_native(k), _native(v)) for k, v in env.items()))
+    try:
+        os.chdir(_native(request.get("cwd", "/")))
+    except OSError as err:
+        molecule.output.print_error("%s: %s" % (
+            _("cannot execute job"), err,))
+        return 1
+    try:
+        return molecule.cmdline.execute(
+            [_native(x) for x in request["args"]])
+    except KeyboardInterrupt:
+        return 1
+
+
+class _Job(object):
+
+    def __init__(self, job_id, args, cwd, env, conn):
+        self.id = job_id
+        self.args = args
+        self.cwd = cwd
+        self.env = env
+        self.conn = conn
+        self.started = False
+        self.cancelled = False
+
+
+class BuildDaemon(object):
+
+    """
+    Molecule build daemon. It executes build requests received through a
+    Unix socket, one at a time, in child processes whose output is
+    streamed back to the requesting DaemonClient. Only processes running
+    as the same user can submit jobs.
+    Jobs are forked from a zygote process, itself forked before any
+    thread is started, which keeps molecule and the plugin registry
+    loaded: forking the threaded daemon itself would not be safe.
+    The zygote reloads the plugin modules that change on disk.
+    """
+
+    def __init__(self, socket_path = None):
+        """
+        Object constructor.
+
+        @keyword socket_path: Unix socket path, see get_socket_path()
+        @type socket_path: string
+        """
+        self._socket_path = get_socket_path(socket_path)
+        self._private_dir = socket_path is None
+        self._output = molecule.output.Output()
+        self._queue = []
+        self._running = None
+        self._next_id = 1
+        self._cond = threading.Condition()
+        self._plugin_mtimes = None
+        self._package_mtime = None
+        self._sock = None
+        self._zygote_pid = None
+        self._zygote_sock = None
+        self._quit = False
+
+    def _info(self, msg, type = "info"):
+        self._output.output("[%s] %s" % (darkgreen("Daemon"), msg,),
+            type = type)
+
+    def _module_mtime(self, module):
+        path = getattr(module, "__file__", None)
+        if not path:
+            return None
+        if path.endswith((".pyc", ".pyo")):
+            path = path[:-1]
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def _plugins_dir_mtime(self):
+        import molecule.specs.plugins
+        try:
+            return os.stat(os.path.dirname(
+                molecule.specs.plugins.__file__)).st_mtime
+        except OSError:
+            return None
+
+    def _refresh_plugins(self):
+        """
+        Load the spec plugins, reloading the plugin modules that changed
+        since the last call. The plugin registry is left untouched if no
+        plugin module changed and no plugin module was added.
+        """
+        try:
+            from importlib import reload as reload_module
+        except ImportError:
+            from imp import reload as reload_module
+
+        factory = PluginFactory._get_spec()
+        package_mtime = self._plugins_dir_mtime()
+        changed = False
+        for modname, mtime in list((self._plugin_mtimes or {}).items()):
+            module = sys.modules.get(modname)
+            if module is None:
+                continue
+            new_mtime = self._module_mtime(module)
+            if new_mtime == mtime:
+                continue
+            self._info("%s: %s" % (_("reloading plugin module"),
+                brown(modname),))
+            try:
+                reload_module(module)
+            except Exception as err:
+                self._info("%s: %s: %s" % (_("cannot reload plugin module"),
+                    modname, err,), type = "warning")
+            changed = True
+
+        if not changed and self._plugin_mtimes is not None and \
+                package_mtime == self._package_mtime:
+            return False
+
+        # pick up new plugin modules as well
+        factory.clear_cache()
+        plugins = PluginFactory.get_spec_plugins()
+
+        mtimes = {}
+        for klass in plugins.values():
+            module = sys.modules.get(klass.__module__)
+            if module is not None:
+                mtimes[klass.__module__] = self._module_mtime(module)
+        self._plugin_mtimes = mtimes
+        self._package_mtime = package_mtime
+        return changed
+
+    def _bind(self):
+        if self._private_dir:
+            _make_private_dir(os.path.dirname(self._socket_path))
+        if os.path.exists(self._socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self._socket_path)
+            except socket.error:
+                # stale socket
+                os.remove(self._socket_path)
+            else:
+                probe.close()
+                raise EnvironmentError("%s: %s" % (
+                    self._socket_path, _("build daemon already running"),))
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            sock.bind(self._socket_path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(16)
+        return sock
+
+    def _start_zygote(self):
+        """
+        Fork the zygote process, see _zygote_main(). Must be called before
+        any thread is started.
+        """
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            rc = 1
+            try:
+                parent_sock.close()
+                self._sock.close()
+                self._zygote_main(child_sock)
+                rc = 0
+            except BaseException:
+                molecule.utils.print_traceback()
+            finally:
+                os._exit(rc)
+
+        child_sock.close()
+        self._zygote_pid = pid
+        self._zygote_sock = parent_sock
+
+    def _zygote_main(self, sock):
+        """
+        Zygote process main loop: read build requests from the daemon and
+        execute them, one at a time, in forked children. The job output is
+        sent back as output frames, followed by an exit status message.
+        Return when the daemon goes away.
+        """
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        while True:
+            try:
+                request = _read_request(sock)
+            except EnvironmentError:
+                return
+            if request is None:
+                return
+            if "args" not in request:
+                # late cancel request of a job that already terminated
+                continue
+
+            try:
+                self._refresh_plugins()
+            except Exception as err:
+                self._info("%s: %s" % (_("cannot load plugins"), err,),
+                    type = "warning")
+            rc = self._zygote_run(sock, request)
+            try:
+                _send_message(sock, {'exit': rc})
+            except EnvironmentError:
+                return
+
+    def _zygote_run(self, sock, request):
+        """
+        Fork a child executing the given build request, forward its output
+        to sock until it exits and terminate it if a cancel request is
+        received. Return its exit status.
+        """
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            rc = 1
+            try:
+                os.close(read_fd)
+                sock.close()
+                rc = _run_job(request, write_fd)
+            except BaseException:
+                molecule.utils.print_traceback()
+            finally:
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                finally:
+                    os._exit(rc)
+
+        os.close(write_fd)
+        fds = [read_fd, sock]
+        while read_fd in fds:
+            try:
+                ready, _unused, _unused = select.select(fds, [], [])
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if sock in ready:
+                try:
+                    message = _read_request(sock)
+                except EnvironmentError:
+                    message = None
+                if message is None:
+                    # daemon gone, stop listening to it
+                    fds.remove(sock)
+                if message is None or message.get("cancel"):
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+
+            if read_fd in ready:
+                try:
+                    chunk = os.read(read_fd, 65536)
+                except OSError as err:
+                    if err.errno == errno.EINTR:
+                        continue
+                    raise
+                if not chunk:
+                    fds.remove(read_fd)
+                elif sock in fds:
+                    try:
+                        _send_frame(sock, _OUTPUT_FRAME, chunk)
+                    except EnvironmentError:
+                        fds.remove(sock)
+                        try:
+                            os.kill(pid, signal.SIGTERM)
+                        except OSError:
+                            pass
+        os.close(read_fd)
+
+        while True:
+            try:
+                _pid, status = os.waitpid(pid, 0)
+                break
+            except OSError as err:
+                if err.errno != errno.EINTR:
+                    raise
+        if os.WIFEXITED(status):
+            return os.WEXITSTATUS(status)
+        return 1
+
+    def _stop_zygote(self):
+        """
+        Make the zygote exit, terminating the running job, if any, and
+        wait for it.
+        """
+        if self._zygote_pid is None:
+            return
+        try:
+            # also wakes up the worker thread reading from the zygote
+            self._zygote_sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        while True:
+            try:
+                os.waitpid(self._zygote_pid, 0)
+                break
+            except OSError as err:
+                if err.errno != errno.EINTR:
+                    break
+        self._zygote_pid = None
+
+    def serve_forever(self):
+        """
+        Serve build requests until SIGTERM or SIGINT is received.
+        Return the exit status.
+        """
+        try:
+            self._sock = self._bind()
+        except (EnvironmentError, socket.error) as err:
+            molecule.output.print_error(str(err))
+            return 1
+
+        # warm up the zygote: jobs are forked from it
+        import molecule.cmdline
+        self._refresh_plugins()
+        self._start_zygote()
+
+        def _stop(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, _stop)
+
+        molecule.utils.get_trash().reclaim()
+        worker = threading.Thread(target = self._worker)
+        worker.daemon = True
+        worker.start()
+        self._info("%s: %s" % (_("listening on"), self._socket_path,))
+
+        try:
+            while True:
+                conn, addr = self._sock.accept()
+                th = threading.Thread(target = self._handle, args = (conn,))
+                th.daemon = True
+                th.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            with self._cond:
+                self._quit = True
+                for job in self._queue:
+                    self._finish(job, 1)
+                del self._queue[:]
+                if self._running is not None:
+                    self._cancel_running()
+                self._cond.notify_all()
+            self._stop_zygote()
+            self._sock.close()
+            try:
+                os.remove(self._socket_path)
+            except OSError:
+                pass
+        return 0
+
+    def _handle(self, conn):
+        try:
+            if _peer_uid(conn) != os.getuid():
+                conn.close()
+                return
+            request = _read_request(conn)
+        except EnvironmentError:
+            conn.close()
+            return
+        if not isinstance(request, dict):
+            conn.close()
+            return
+
+        command = request.get("command")
+        try:
+            if command == "build":
+                self._enqueue(conn, request)
+                # connection now owned by the job
+                return
+            elif command == "cancel":
+                _send_message(conn, {
+                    'cancelled': self._cancel(request.get("id"))})
+            elif command == "status":
+                _send_message(conn, self._status())
+            else:
+                _send_message(conn, {'error': "invalid command"})
+        except socket.error:
+            pass
+        conn.close()
+
+    def _validate(self, request):
+        """
+        Return the reason why the given build request cannot be accepted,
+        or None.
+        """
+        args = request.get("args", [])
+        env = request.get("env")
+        if not isinstance(args, list) or \
+                not all(isstring(x) for x in args):
+            return _("invalid arguments")
+        if not isstring(request.get("cwd", "/")):
+            return _("invalid working directory")
+        if env is not None and (not isinstance(env, dict) or \
+                not all(isstring(x) for x in env.values())):
+            return _("invalid environment")
+        for arg in args:
+            if arg.split("=", 1)[0] in _REJECTED_ARGS:
+                return "%s: %s" % (arg, _("cannot be forwarded"),)
+        return None
+
+    def _enqueue(self, conn, request):
+        error = self._validate(request)
+        if error is not None:
+            _send_message(conn, {'error': error, 'exit': 1})
+            conn.close()
+            return
+
+        with self._cond:
+            job = _Job(self._next_id, list(request.get("args", [])),
+                request.get("cwd", "/"), request.get("env"), conn)
+            self._next_id += 1
+            self._queue.append(job)
+            position = len(self._queue)
+            _send_message(conn, {'id': job.id, 'queued': position})
+            self._info("%s %s: %s" % (_("queued job"), job.id,
+                " ".join(job.args),))
+            self._cond.notify_all()
+
+    def _status(self):
+        with self._cond:
+            running = None
+            if self._running is not None:
+                running = {'id': self._running.id,
+                           'args': self._running.args}
+            return {
+                'running': running,
+                'queued': [{'id': x.id, 'args': x.args} \
+                               for x in self._queue],
+            }
+
+    def _cancel_running(self):
+        job = self._running
+        job.cancelled = True
+        if job.started:
+            try:
+                _send_message(self._zygote_sock, {'cancel': True})
+            except socket.error:
+                pass
+
+    def _cancel(self, job_id):
+        with self._cond:
+            if (self._running is not None) and (self._running.id == job_id):
+                self._cancel_running()
+                self._info("%s %s" % (_("cancelling job"), job_id,))
+                return True
+            for job in self._queue:
+                if job.id == job_id:
+                    self._queue.remove(job)
+                    job.cancelled = True
+                    self._finish(job, 1)
+                    self._info("%s %s" % (_("cancelled job"), job_id,))
+                    return True
+        return False
+
+    def _finish(self, job, rc):
+        try:
+            _send_message(job.conn, {'exit': rc, 'cancelled': job.cancelled})
+        except socket.error:
+            pass
+        job.conn.close()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._quit:
+                    self._cond.wait()
+                if self._quit:
+                    return
+                job = self._queue.pop(0)
+                self._running = job
+
+            rc = self._execute(job)
+
+            with self._cond:
+                self._running = None
+                self._finish(job, rc)
+                self._info("%s %s: %s" % (_("job"), job.id, rc,))
+
+    def _execute(self, job):
+        """
+        Execute the job through the zygote, streaming its output to the
+        client, return its exit status.
+        """
+        with self._cond:
+            if job.cancelled:
+                return 1
+            try:
+                _send_message(self._zygote_sock, {'args': job.args,
+                    'cwd': job.cwd, 'env': job.env})
+            except socket.error as err:
+                try:
+                    _send_frame(job.conn, _OUTPUT_FRAME, convert_to_rawstring(
+                        "%s: %s\n" % (_("cannot execute job"), err,)))
+                except socket.error:
+                    pass
+                return 1
+            job.started = True
+
+        connected = True
+        while True:
+            try:
+                frame = _recv_frame(self._zygote_sock)
+                if frame is not None and frame[0] == _MESSAGE_FRAME:
+                    message = _decode_message(frame[1])
+                    return int(message.get("exit", 1))
+            except (socket.error, ValueError, TypeError):
+                frame = None
+            if frame is None:
+                if not self._quit:
+                    self._info(_("build daemon zygote terminated"),
+                        type = "error")
+                return 1
+            if not connected:
+                # client gone, keep draining the job output
+                continue
+            try:
+                _send_frame(job.conn, _OUTPUT_FRAME, frame[1])
+            except socket.error:
+                connected = False
+
+
+class DaemonClient(object):
+
+    """
+    Thin BuildDaemon client.
+    """
+
+    # options consumed by the client itself
+    _CLIENT_OPTIONS = ("--connect",)
+    _CLIENT_VALUE_OPTIONS = ("--socket",)
+
+    def __init__(self, socket_path = None):
+        """
+        Object constructor.
+
+        @keyword socket_path: Unix socket path, see get_socket_path()
+        @type socket_path: string
+        """
+        self._socket_path = get_socket_path(socket_path)
+
+    def _connect(self, request):
+        """
+        Connect to the daemon and send the given request. Raise
+        EnvironmentError if the socket, or the daemon process, does not
+        belong to the current user: requests carry the whole environment.
+        """
+        st = os.lstat(self._socket_path)
+        if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+            raise EnvironmentError(errno.EPERM,
+                _("socket not owned by the current user"))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._socket_path)
+            if _peer_uid(sock) != os.getuid():
+                raise EnvironmentError(errno.EPERM,
+                    _("build daemon running as another user"))
+            _send_message(sock, request)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def _request(self, request):
+        """
+        Send a request and return the first daemon message, or None.
+        """
+        sock = self._connect(request)
+        try:
+            frame = _recv_frame(sock)
+            if frame is None or frame[0] != _MESSAGE_FRAME:
+                return None
+            return _decode_message(frame[1])
+        except ValueError:
+            return None
+        finally:
+            sock.close()
+
+    def _filter_args(self, args):
+        filtered = []
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg in DaemonClient._CLIENT_OPTIONS:
+                continue
+            if arg in DaemonClient._CLIENT_VALUE_OPTIONS:
+                if args:
+                    args.pop(0)
+                continue
+            if arg.split("=", 1)[0] in DaemonClient._CLIENT_VALUE_OPTIONS:
+                continue
+            filtered.append(arg)
+        return filtered
+
+    def build(self, args, out = None):
+        """
+        Execute the given command line arguments through the daemon,
+        streaming its output. Return the exit status.
+
+        @param args: command line arguments
+        @type args: list
+        @keyword out: binary file object receiving the build output,
+            stdout if None
+        @type out: file object
+        @return: exit status
+        @rtype: int
+        """
+        request = {
+            'command': "build",
+            'args': self._filter_args(args),
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+        }
+        try:
+            sock = self._connect(request)
+        except EnvironmentError as err:
+            molecule.output.print_error("%s: %s" % (
+                self._socket_path, err,))
+            return 1
+
+        if out is None:
+            out = getattr(sys.stdout, "buffer", sys.stdout)
+        job_id = None
+        try:
+            while True:
+                frame = _recv_frame(sock)
+                if frame is None:
+                    return 1
+                kind, payload = frame
+                if kind == _OUTPUT_FRAME:
+                    out.write(payload)
+                    out.flush()
+                    continue
+                message = _decode_message(payload)
+                if 'error' in message:
+                    molecule.output.print_error(message['error'])
+                if 'exit' in message:
+                    return message['exit']
+                if 'id' in message:
+                    job_id = message['id']
+                    molecule.output.print_info("%s %s, %s: %s" % (
+                        _("job"), job_id, _("queue position"),
+                        message.get('queued'),))
+        except ValueError as err:
+            molecule.output.print_error("%s: %s" % (
+                _("invalid build daemon reply"), err,))
+            return 1
+        except EnvironmentError as err:
+            molecule.output.print_error("%s: %s" % (
+                self._socket_path, err,))
+            return 1
+        except KeyboardInterrupt:
+            if job_id is not None:
+                self.cancel(job_id)
+            return 1
+        finally:
+            sock.close()
+
+    def cancel(self, job_id):
+        """
+        Cancel the given job. Return the exit status.
+        """
+        try:
+            reply = self._request({'command': "cancel", 'id': job_id})
+        except EnvironmentError as err:
+            molecule.output.print_error("%s: %s" % (
+                self._socket_path, err,))
+            return 1
+        if reply and reply.get('cancelled'):
+            molecule.output.print_info("%s %s %s" % (
+                _("job"), job_id, _("cancelled"),))
+            return 0
+        molecule.output.print_error("%s %s %s" % (
+            _("job"), job_id, _("not found"),))
+        return 1
+
+    def queue(self):
+        """
+        Return the daemon queue: a dict with "running" (None or a dict
+        with "id" and "args" keys) and "queued" (list of dicts with "id"
+        and "args" keys) keys.
+
+        @return: daemon queue
+        @rtype: dict
+        @raise EnvironmentError: if the daemon cannot be reached
+        """
+        reply = self._request({'command': "status"})
+        if reply is None:
+            raise EnvironmentError(errno.EPROTO,
+                _("invalid build daemon reply"))
+        return reply
+
+    def status(self):
+        """
+        Print the daemon queue. Return the exit status.
+        """
+        try:
+            reply = self.queue()
+        except EnvironmentError as err:
+            molecule.output.print_error("%s: %s" % (
+                self._socket_path, err,))
+            return 1
+        running = reply.get('running')
+        if running:
+            molecule.output.print_info("%s %s: %s" % (_("running job"),
+                running['id'], " ".join(running['args']),))
+        else:
+            molecule.output.print_info(_("no running jobs"))
+        for job in reply.get('queued', []):
+            molecule.output.print_info("%s %s: %s" % (_("queued job"),
+                job['id'], " ".join(job['args']),))
+        return 0
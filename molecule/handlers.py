@@ -16,71 +16,364 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+import time
+import resource
+import threading
+import contextlib
+
+import molecule.utils
+from molecule.cache import StepCache
+from molecule.checkpoint import CheckpointJournal, metadata_fingerprint
 from molecule.i18n import _
 from molecule.output import brown, darkgreen
 from molecule.specs.skel import GenericExecutionStep
 
 
+@contextlib.contextmanager
+def _null_span():
+    yield
+
+
 class Runner(GenericExecutionStep):
 
-    def __init__(self, spec_path, metadata):
+    """
+    Execute the GenericExecutionStep classes returned by
+    GenericSpec.execution_steps(). Steps are executed in order, while the
+    steps of a parallel group (a tuple or list of classes inside
+    execution_steps()) are executed at the same time, each one in its
+    own thread.
+    Successfully completed steps are recorded in a CheckpointJournal, so
+    that a failed execution can be resumed. Outputs of cacheable steps can
+    be taken from a StepCache.
+    Resource usage of the child processes spawned by every executed step
+    is collected, see step_results().
+    """
+
+    def __init__(self, spec_path, metadata, resume = False, use_cache = False,
+        tracer = None):
+        """
+        Object constructor.
+
+        @param spec_path: spec file path
+        @type spec_path: string
+        @param metadata: metadata as returned by SpecParser.parse()
+        @type metadata: dict
+        @keyword resume: skip the steps that already completed successfully
+            in a previous execution with the same metadata
+        @type resume: bool
+        @keyword use_cache: restore the outputs of cacheable steps from
+            the step output cache (see StepCache) and store them there
+        @type use_cache: bool
+        @keyword tracer: record hook timings into the given Tracer
+        @type tracer: molecule.trace.Tracer
+        """
         GenericExecutionStep.__init__(self, spec_path, metadata)
         self.execution_order = metadata['__plugin__'].execution_steps()
+        self._resume = resume
+        self._fingerprint = metadata_fingerprint(metadata)
+        self._journal = CheckpointJournal(spec_path, self._fingerprint)
+        self._cache = None
+        if use_cache:
+            self._cache = StepCache()
+        self._tracer = tracer
+        self._accounting = {}
+        self._step_results = []
+        self._results_lock = threading.Lock()
 
     def kill(self, success = True):
         return 0
 
-    def run(self):
+    def step_results(self):
+        """
+        Return the list of executed steps, in completion order, as dicts
+        with the following keys: "step" (step id), "class", "rc" (None if
+        the step raised an exception), "wall_time" (seconds), "children"
+        (resource usage of the child processes spawned through
+        molecule.utils, see molecule.utils.ChildUsage.as_dict()) and
+        "rusage_children" (user and system CPU time deltas of
+        RUSAGE_CHILDREN, also including children spawned by other means
+        and, for parallel groups, by the other steps of the group).
+        """
+        with self._results_lock:
+            return list(self._step_results)
 
-        count = 0
-        maxcount = len(self.execution_order)
-        self._output.output( "[%s|%s] %s" % (
-            darkgreen("Runner"), brown(self.spec_name),
-            _("preparing execution"),), count = (count, maxcount,)
+    def _start_accounting(self, my):
+        """
+        Start collecting the resource usage of the given
+        GenericExecutionStep instance.
+        """
+        self._accounting[my] = (molecule.utils.ChildUsage(), time.time(),
+            resource.getrusage(resource.RUSAGE_CHILDREN))
+
+    def _stop_accounting(self, my, step_id, rc):
+        """
+        Stop collecting the resource usage of the given
+        GenericExecutionStep instance and record its step result.
+        """
+        usage, start, rusage = self._accounting.pop(my)
+        end_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        klass = my.__class__
+        result = {
+            'step': step_id,
+            'class': "%s.%s" % (klass.__module__, klass.__name__,),
+            'rc': rc,
+            'wall_time': round(time.time() - start, 6),
+            'children': usage.as_dict(),
+            'rusage_children': {
+                'user_time': round(end_rusage.ru_utime - rusage.ru_utime, 6),
+                'system_time': round(
+                    end_rusage.ru_stime - rusage.ru_stime, 6),
+            },
+        }
+        with self._results_lock:
+            self._step_results.append(result)
+
+    def _hook_span(self, my, name):
+        """
+        Return a context manager tracing the execution of the given hook.
+        """
+        if self._tracer is None:
+            return _null_span()
+        klass = my.__class__
+        return self._tracer.span("%s.%s" % (klass.__name__, name), "hook",
+            args = {'spec': self.spec_name, 'step': "%s.%s" % (
+                        klass.__module__, klass.__name__,)})
+
+    def _call_hook(self, my, name, **kwargs):
+        """
+        Call the given hook of the GenericExecutionStep instance.
+        """
+        accounting = self._accounting.get(my)
+        usage = None
+        if accounting is not None:
+            usage = accounting[0]
+        with molecule.utils.account_children(usage):
+            with self._hook_span(my, name):
+                return getattr(my, name)(**kwargs)
+
+    def _execution_groups(self):
+        """
+        Return the execution order as a list of groups (tuples) of
+        (position, class) pairs.
+        """
+        groups = []
+        position = 0
+        for item in self.execution_order:
+            if not isinstance(item, (list, tuple)):
+                item = (item,)
+            group = []
+            for myclass in item:
+                position += 1
+                group.append((position, myclass))
+            if group:
+                groups.append(tuple(group))
+        return groups
+
+    def _execute_hooks(self, my):
+        """
+        Execute the setup, pre_run, run and post_run hooks of the given
+        GenericExecutionStep instance, stopping at the first failure.
+        Return the exit status.
+        """
+        # setup hook
+        rc = self._call_hook(my, "setup")
+        if rc:
+            return rc
+        # pre-run
+        rc = self._call_hook(my, "pre_run")
+        if rc:
+            return rc
+        # run
+        rc = self._call_hook(my, "run")
+        if rc:
+            return rc
+        # post-run
+        return self._call_hook(my, "post_run")
+
+    def _step_id(self, position, myclass):
+        return "%d:%s.%s" % (position, myclass.__module__, myclass.__name__,)
+
+    def _record_step(self, step_id):
+        try:
+            self._journal.record(step_id)
+        except (IOError, OSError) as err:
+            self._warning(_("cannot write checkpoint"), err)
+
+    def _warning(self, msg, err):
+        self._output.output( "[%s|%s] %s: %s" % (
+                darkgreen("Runner"), brown(self.spec_name), msg, err,),
+            type = "warning"
         )
-        for myclass in self.execution_order:
 
-            count += 1
+    def _cache_key(self, my):
+        """
+        Return a tuple composed by the step output cache key and the list of
+        outputs of the given GenericExecutionStep instance, (None, None)
+        if its outputs cannot be cached.
+        """
+        if self._cache is None:
+            return None, None
+        outputs = my.cache_outputs()
+        if not outputs:
+            return None, None
+        try:
+            key = self._cache.key(self._fingerprint, my.__class__,
+                my.cache_inputs() or [])
+        except (IOError, OSError) as err:
+            self._warning(_("cannot compute cache key"), err)
+            return None, None
+        return key, outputs
+
+    def _prepare_step(self, myclass, count):
+        """
+        Prepare the execution of a GenericExecutionStep class. Return None
+        if the step does not need to be executed (already completed or
+        outputs restored from cache), otherwise a tuple composed by the
+        step instance, its id, its cache key and its outputs.
+        """
+        step_id = self._step_id(count[0], myclass)
+        if self._resume and self._journal.is_completed(step_id):
             self._output.output( "[%s|%s] %s %s" % (
-                darkgreen("Runner"), brown(self.spec_name), _("executing"),
-                str(myclass),), count = (count, maxcount,)
+                darkgreen("Runner"), brown(self.spec_name),
+                _("already completed, skipping"), str(myclass),),
+                count = count
             )
-            my = myclass(self.spec_path, self.metadata)
-
-            rc = 0
-            while True:
-
-                try:
-
-                    # setup hook
-                    rc = my.setup()
-                    if rc:
-                        break
-                    # pre-run
-                    rc = my.pre_run()
-                    if rc:
-                        break
-                    # run
-                    rc = my.run()
-                    if rc:
-                        break
-                    # post-run
-                    rc = my.post_run()
-                    if rc:
-                        break
-
-                    break
-                except:
-                    my.kill(success = False)
-                    raise
-
-            my.kill(success = rc == 0)
-            if rc:
-                return rc
+            return None
+
+        self._output.output( "[%s|%s] %s %s" % (
+            darkgreen("Runner"), brown(self.spec_name), _("executing"),
+            str(myclass),), count = count
+        )
+        my = myclass(self.spec_path, self.metadata)
+
+        cache_key, outputs = self._cache_key(my)
+        if cache_key is not None:
+            try:
+                restored = self._cache.restore(cache_key, outputs)
+            except (IOError, OSError) as err:
+                self._warning(_("cannot restore cached outputs"), err)
+                restored = False
+            if restored:
+                self._output.output( "[%s|%s] %s %s" % (
+                    darkgreen("Runner"), brown(self.spec_name),
+                    _("outputs restored from cache"), str(myclass),),
+                    count = count
+                )
+                self._record_step(step_id)
+                return None
+
+        self._start_accounting(my)
+        return my, step_id, cache_key, outputs
+
+    def _complete_step(self, step_id, cache_key, outputs):
+        """
+        Bookkeeping of a successfully executed step.
+        """
+        if cache_key is not None:
+            try:
+                self._cache.store(cache_key, outputs)
+            except (IOError, OSError) as err:
+                self._warning(_("cannot store outputs into cache"), err)
+        self._record_step(step_id)
+
+    def _execute_step(self, myclass, count):
+        """
+        Execute a single GenericExecutionStep class, return its exit status.
+        """
+        step = self._prepare_step(myclass, count)
+        if step is None:
+            return 0
+        my, step_id, cache_key, outputs = step
+
+        try:
+            rc = self._execute_hooks(my)
+        except:
+            try:
+                self._call_hook(my, "kill", success = False)
+            finally:
+                self._stop_accounting(my, step_id, None)
+            raise
+
+        self._call_hook(my, "kill", success = rc == 0)
+        self._stop_accounting(my, step_id, rc)
+        if rc == 0:
+            self._complete_step(step_id, cache_key, outputs)
+        return rc
+
+    def _execute_group(self, group, maxcount):
+        """
+        Execute a group of GenericExecutionStep classes in parallel, return
+        the exit status of the first failed one (in group order) or 0.
+        Exceptions raised by a step are re-raised once all the other
+        steps of the group are terminated.
+        """
+        results = {}
+
+        def _worker(position, myclass):
+            try:
+                results[position] = (self._execute_step(
+                    myclass, (position, maxcount,)), None)
+            except BaseException as err:
+                results[position] = (1, err)
+
+        threads = []
+        for position, myclass in group:
+            th = threading.Thread(target = _worker, args = (position, myclass,))
+            th.name = "Runner-%s" % (myclass.__name__,)
+            th.start()
+            threads.append(th)
+        for th in threads:
+            th.join()
+
+        rc = 0
+        for position, myclass in group:
+            step_rc, err = results[position]
+            if err is not None:
+                raise err
+            if step_rc and not rc:
+                rc = step_rc
+        return rc
+
+    def _begin(self):
+        """
+        Prepare the execution, return a tuple composed by the list of
+        execution groups and the total number of steps.
+        """
+        groups = self._execution_groups()
+        maxcount = sum(len(x) for x in groups)
+        if not self._resume:
+            self._journal.reset()
+        self._output.output( "[%s|%s] %s" % (
+            darkgreen("Runner"), brown(self.spec_name),
+            _("preparing execution"),), count = (0, maxcount,)
+        )
+        return groups, maxcount
+
+    def _end(self):
+        """
+        Finalize a successful execution.
+        """
+        # a new execution will start from scratch
+        self._journal.reset()
 
         self._output.output( "[%s|%s] %s" % (
                 darkgreen("Runner"), brown(self.spec_name),
                 _("All done"),
             )
         )
+
+    def run(self):
+
+        groups, maxcount = self._begin()
+        for group in groups:
+
+            if len(group) == 1:
+                position, myclass = group[0]
+                rc = self._execute_step(myclass, (position, maxcount,))
+            else:
+                rc = self._execute_group(group, maxcount)
+            if rc:
+                return rc
+
+        self._end()
         return 0
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+
+import os
+import time
+import sqlite3
+import threading
+
+
+class TimingHistory(object):
+
+    """
+    Durations of past spec file and GenericExecutionStep executions,
+    stored in a SQLite database inside the Molecule temporary directory.
+    Spec files are keyed by their real path (spec files with the same
+    name can live in different directories), steps by spec file path and
+    step class. Expected durations are the average of the most
+    recent successful executions.
+    """
+
+    DB_NAME = "molecule-history.db"
+    # number of recent successful executions averaged by expected_*()
+    SAMPLES = 5
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS spec_runs (spec TEXT NOT NULL, "
+            "started REAL NOT NULL, duration REAL NOT NULL, "
+            "rc INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS spec_runs_spec ON spec_runs "
+            "(spec, started)",
+        "CREATE TABLE IF NOT EXISTS step_runs (spec TEXT NOT NULL, "
+            "step TEXT NOT NULL, started REAL NOT NULL, "
+            "duration REAL NOT NULL, rc INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS step_runs_spec_step ON step_runs "
+            "(spec, step, started)",
+    )
+
+    def __init__(self, db_path = None):
+        """
+        Object constructor.
+
+        @keyword db_path: database path, <tmp_dir>/molecule-history.db
+            if None
+        @type db_path: string
+        """
+        if db_path is None:
+            import molecule.settings
+            db_path = os.path.join(
+                molecule.settings.Configuration()['tmp_dir'],
+                TimingHistory.DB_NAME)
+        self._db_path = db_path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def path(self):
+        """
+        Return the database path.
+        """
+        return self._db_path
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self._db_path, timeout = 30.0,
+                check_same_thread = False)
+            with conn:
+                for statement in TimingHistory._SCHEMA:
+                    conn.execute(statement)
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @staticmethod
+    def spec_key(spec_path):
+        """
+        Return the history key of the given spec file path.
+        """
+        return os.path.realpath(spec_path)
+
+    def record_spec(self, spec_path, duration, rc, started = None):
+        """
+        Record the execution of a spec file.
+
+        @param spec_path: spec file path
+        @type spec_path: string
+        @param duration: execution time in seconds
+        @type duration: float
+        @param rc: exit status
+        @type rc: int
+        @keyword started: execution start timestamp, now - duration if
+            None
+        @type started: float
+        @raise sqlite3.Error: on database errors
+        """
+        if started is None:
+            started = time.time() - duration
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("INSERT INTO spec_runs VALUES (?, ?, ?, ?)",
+                    (self.spec_key(spec_path), started, duration, rc,))
+
+    def record_steps(self, spec_path, step_results, started = None):
+        """
+        Record the execution of the steps of a spec file.
+
+        @param spec_path: spec file path
+        @type spec_path: string
+        @param step_results: step results, see Runner.step_results()
+        @type step_results: list
+        @keyword started: spec file execution start timestamp, now if None
+        @type started: float
+        @raise sqlite3.Error: on database errors
+        """
+        if started is None:
+            started = time.time()
+        rows = []
+        for result in step_results:
+            rc = result['rc']
+            if rc is None:
+                rc = 1
+            rows.append((self.spec_key(spec_path), result['class'], started,
+                result['wall_time'], rc,))
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    "INSERT INTO step_runs VALUES (?, ?, ?, ?, ?)", rows)
+
+    def expected_spec(self, spec_path):
+        """
+        Return the expected execution time of the given spec file in
+        seconds, or None if no successful execution has been recorded.
+
+        @raise sqlite3.Error: on database errors
+        """
+        with self._lock:
+            cur = self._connection().execute(
+                "SELECT AVG(duration) FROM (SELECT duration FROM spec_runs "
+                "WHERE spec = ? AND rc = 0 ORDER BY started DESC LIMIT ?)",
+                (self.spec_key(spec_path), TimingHistory.SAMPLES,))
+            return cur.fetchone()[0]
+
+    def expected_steps(self, spec_path):
+        """
+        Return a dict (key=step class name, "module.Class", value=expected
+        execution time in seconds) of the steps of the given spec file
+        that have been successfully executed in the past.
+
+        @raise sqlite3.Error: on database errors
+        """
+        expected = {}
+        with self._lock:
+            cur = self._connection().execute(
+                "SELECT step, duration FROM step_runs WHERE spec = ? AND "
+                "rc = 0 ORDER BY started DESC", (self.spec_key(spec_path),))
+            samples = {}
+            for step, duration in cur.fetchall():
+                durations = samples.setdefault(step, [])
+                if len(durations) < TimingHistory.SAMPLES:
+                    durations.append(duration)
+        for step, durations in samples.items():
+            expected[step] = sum(durations) / len(durations)
+        return expected
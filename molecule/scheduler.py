@@ -0,0 +1,568 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+import sys
+import json
+import time
+import signal
+import sqlite3
+import multiprocessing
+
+import molecule.utils
+import molecule.output
+from molecule.i18n import _
+from molecule.exception import SpecFileError
+from molecule.output import brown, darkgreen, darkred
+from molecule.handlers import Runner
+from molecule.settings import SpecParser
+
+
+def _sigterm_handler(signum, frame):
+    # let Runner.run() unwind through its kill(success = False) path
+    raise KeyboardInterrupt()
+
+def _exit_status(rc):
+    """
+    Map a Runner.run() return code to a valid, non-ambiguous process
+    exit status.
+    """
+    if rc == 0:
+        return 0
+    if isinstance(rc, int) and 0 < rc < 256:
+        return rc
+    return 1
+
+def _run_traced(my, tracer):
+    """
+    Execute the given Runner, recording its execution time into tracer,
+    if not None.
+    """
+    if tracer is None:
+        return my.run()
+    with tracer.span(my.spec_name, "spec", args = {'spec': my.spec_path}):
+        return my.run()
+
+def _spec_worker(my, log_path, tracer, trace_path, results_path):
+    """
+    Execute a single spec file through the given Runner, inside a child
+    process.
+    stdout and stderr (of this process and of its children) are
+    redirected to log_path. If tracer is not None, collected timings are
+    written to trace_path. Runner step results are written to
+    results_path.
+    """
+    signal.signal(signal.SIGTERM, _sigterm_handler)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(log_fd, sys.stdout.fileno())
+    os.dup2(log_fd, sys.stderr.fileno())
+    os.close(log_fd)
+    molecule.output.nocolor()
+    if tracer is not None:
+        # drop the events inherited from the parent
+        tracer.reset()
+
+    try:
+        rc = _run_traced(my, tracer)
+    except KeyboardInterrupt:
+        rc = 1
+    except Exception:
+        molecule.utils.print_traceback()
+        rc = 1
+    my.kill()
+    if tracer is not None:
+        try:
+            tracer.write(trace_path)
+        except (IOError, OSError):
+            molecule.utils.print_traceback()
+    try:
+        with open(results_path, "w") as results_f:
+            json.dump(my.step_results(), results_f)
+    except (IOError, OSError):
+        molecule.utils.print_traceback()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    raise SystemExit(_exit_status(rc))
+
+
+class SpecScheduler(object):
+
+    """
+    Execute spec files honouring their dependencies (see
+    SpecParser.DEPENDS_KEY). A spec file is started as soon as all the
+    spec files it depends on completed successfully. Spec files depending
+    on a failed one are skipped.
+
+    With jobs = 1, spec files are executed one after another inside the
+    current process and execution stops at the first failure.
+    With jobs > 1, every spec file runs through its own Runner living in
+    a separate process and Runner output is written to a per-spec log
+    file. If a TimingHistory is given, durations are recorded into it
+    and, with jobs > 1, ready spec files are started longest first: by
+    expected duration of the longest chain of spec files depending on
+    them (including themselves).
+    """
+
+    def __init__(self, data, data_order, jobs = 1, fail_fast = False,
+        log_dir = None, resume = False, use_cache = False, timeout = None,
+        step_timeout = None, tracer = None, history = None):
+        """
+        Object constructor.
+
+        @param data: dict (key=spec file, value=metadata) as returned by
+            molecule.cmdline.parse()
+        @type data: dict
+        @param data_order: spec file order
+        @type data_order: list
+        @keyword jobs: maximum number of Runners executing at the same time
+        @type jobs: int
+        @keyword fail_fast: terminate the running Runners as soon as one
+            of them fails and do not start the remaining ones
+        @type fail_fast: bool
+        @keyword log_dir: directory where per-spec log files are written,
+            a new temporary directory is created if None
+        @type log_dir: string
+        @keyword resume: resume the spec file executions, see Runner
+        @type resume: bool
+        @keyword use_cache: use the step output cache, see Runner
+        @type use_cache: bool
+        @keyword timeout: per spec file timeout in seconds, see AsyncRunner
+        @type timeout: float
+        @keyword step_timeout: per step timeout in seconds, see AsyncRunner
+        @type step_timeout: float
+        @keyword tracer: record spec file and hook timings into the given
+            Tracer
+        @type tracer: molecule.trace.Tracer
+        @keyword history: record durations into, and take expected
+            durations from, the given TimingHistory
+        @type history: molecule.history.TimingHistory
+        @raise SpecFileError: if a spec file depends on a spec file that
+            is not going to be executed or if dependencies are circular
+        """
+        self._data = data
+        self._data_order = list(data_order)
+        self._jobs = max(1, jobs)
+        self._inline = self._jobs == 1
+        self._fail_fast = fail_fast or self._inline
+        self._log_dir = log_dir
+        self._resume = resume
+        self._use_cache = use_cache
+        self._timeout = timeout
+        self._step_timeout = step_timeout
+        self._tracer = tracer
+        self._output = molecule.output.Output()
+        self._results = {}
+        self._skipped = set()
+        self._log_paths = {}
+        self._step_results = {}
+        self._started = {}
+        self._history = history
+        self._deps = self._build_graph()
+        self._expected = self._load_expected()
+        self._ranks = self._build_ranks()
+
+        if hasattr(multiprocessing, "get_context"):
+            # metadata carries plugin objects, avoid pickling them
+            self._mp = multiprocessing.get_context("fork")
+        else:
+            self._mp = multiprocessing
+
+    def _build_graph(self):
+        """
+        Build the dependency graph, return a dict (key=spec file,
+        value=list of spec files it depends on).
+        """
+        by_path = {}
+        for spec_path in self._data_order:
+            by_path[os.path.realpath(spec_path)] = spec_path
+
+        deps = {}
+        for spec_path in self._data_order:
+            metadata = self._data.get(spec_path) or {}
+            spec_deps = []
+            for dep in metadata.get(SpecParser.DEPENDS_KEY, []):
+                dep_spec = by_path.get(os.path.realpath(dep))
+                if dep_spec is None:
+                    raise SpecFileError(
+                        "SpecFileError: '%s' depends on '%s', which is"
+                        " not going to be executed" % (spec_path, dep,))
+                if dep_spec not in spec_deps:
+                    spec_deps.append(dep_spec)
+            deps[spec_path] = spec_deps
+
+        # look for cycles, three-color depth first search: grey spec
+        # files are on the current path, black ones are cycle free
+        grey, black = 1, 2
+        colors = {}
+        for root in self._data_order:
+            if root in colors:
+                continue
+            colors[root] = grey
+            path = [root]
+            iterators = [iter(deps[root])]
+            while iterators:
+                dep = next(iterators[-1], None)
+                if dep is None:
+                    colors[path.pop()] = black
+                    iterators.pop()
+                    continue
+                color = colors.get(dep)
+                if color == grey:
+                    raise SpecFileError(
+                        "SpecFileError: circular dependency: %s" % (
+                            " -> ".join(path[path.index(dep):] + [dep]),))
+                if color is None:
+                    colors[dep] = grey
+                    path.append(dep)
+                    iterators.append(iter(deps[dep]))
+
+        return deps
+
+    def _load_expected(self):
+        """
+        Return a dict (key=spec file, value=expected duration in seconds)
+        of the spec files with a known expected duration.
+        """
+        expected = {}
+        if self._history is None:
+            return expected
+        try:
+            for spec_path in self._data_order:
+                duration = self._history.expected_spec(spec_path)
+                if duration is not None:
+                    expected[spec_path] = duration
+        except sqlite3.Error as err:
+            self._history_error(_("cannot read timing history"), err)
+        return expected
+
+    def _build_ranks(self):
+        """
+        Return a dict (key=spec file, value=expected duration of the
+        longest chain of spec files starting with it, following reverse
+        dependencies). Unknown durations count as zero.
+        """
+        dependents = dict((x, []) for x in self._data_order)
+        for spec_path, deps in self._deps.items():
+            for dep in deps:
+                dependents[dep].append(spec_path)
+
+        ranks = {}
+        def _rank(spec_path):
+            if spec_path not in ranks:
+                ranks[spec_path] = self._expected.get(spec_path, 0.0) + \
+                    max([0.0] + [_rank(x) for x in dependents[spec_path]])
+            return ranks[spec_path]
+
+        for spec_path in self._data_order:
+            _rank(spec_path)
+        return ranks
+
+    def _history_error(self, msg, err):
+        self._output.output("[%s] %s: %s" % (
+                darkgreen("Scheduler"), msg, err,), type = "warning"
+        )
+
+    def plan(self):
+        """
+        Return the execution plan computed from the timing history.
+
+        @return: tuple composed by a dict (key=spec file, value=expected
+            duration in seconds, None if unknown), the critical path
+            (list of spec files, the longest chain of dependent spec
+            files) and its expected duration in seconds
+        @rtype: tuple
+        """
+        expected = dict((x, self._expected.get(x)) for x in self._data_order)
+        critical_path = []
+        candidates = self._data_order
+        while candidates:
+            # stable: first spec file in order wins ties
+            best = None
+            for spec_path in candidates:
+                if best is None or self._ranks[spec_path] > self._ranks[best]:
+                    best = spec_path
+            critical_path.append(best)
+            candidates = [x for x in self._data_order if \
+                best in self._deps[x]]
+        duration = 0.0
+        if critical_path:
+            duration = self._ranks[critical_path[0]]
+        return expected, critical_path, duration
+
+    def dependencies(self):
+        """
+        Return the dependency graph, a dict (key=spec file, value=list of
+        spec files it depends on).
+        """
+        return dict((x, list(y)) for x, y in self._deps.items())
+
+    def results(self):
+        """
+        Return a dict (key=spec file, value=exit status) of the spec files
+        that have been executed. Spec files that did not run are missing.
+        """
+        return self._results.copy()
+
+    def skipped(self):
+        """
+        Return the set of spec files skipped because one of their
+        dependencies did not complete successfully.
+        """
+        return self._skipped.copy()
+
+    def log_paths(self):
+        """
+        Return a dict (key=spec file, value=log file path).
+        """
+        return self._log_paths.copy()
+
+    def step_results(self):
+        """
+        Return a dict (key=spec file, value=list of step results, see
+        Runner.step_results()) of the spec files that have been executed.
+        """
+        return dict((x, list(y)) for x, y in self._step_results.items())
+
+    def _info(self, spec_path, msg, type = "info"):
+        self._output.output("[%s|%s] %s" % (
+                darkgreen("Scheduler"), brown(os.path.basename(spec_path)),
+                msg,), type = type
+        )
+
+    def _ready(self, pending):
+        """
+        Return the pending spec files that can be started, in order.
+        Pending spec files with failed or skipped dependencies are
+        moved to the skipped set.
+        """
+        changed = True
+        while changed:
+            changed = False
+            for spec_path in list(pending):
+                failed = [x for x in self._deps[spec_path] if \
+                    x in self._skipped or self._results.get(x, 0) != 0]
+                if failed:
+                    pending.remove(spec_path)
+                    self._skipped.add(spec_path)
+                    self._info(spec_path, "%s: %s" % (
+                            _("skipped, dependency failed"),
+                            ", ".join(failed),), type = "warning")
+                    changed = True
+
+        ready = [x for x in pending if \
+                     all(y in self._results for y in self._deps[x])]
+        if (self._history is not None) and not self._inline:
+            # longest first, stable
+            ready.sort(key = lambda x: -self._ranks[x])
+        return ready
+
+    def _record_history(self, spec_path, rc):
+        """
+        Record the duration of the given spec file, and of its steps,
+        into the timing history.
+        """
+        if self._history is None:
+            return
+        started = self._started.get(spec_path)
+        if started is None:
+            return
+        try:
+            self._history.record_spec(spec_path, time.time() - started, rc,
+                started = started)
+            self._history.record_steps(spec_path,
+                self._step_results.get(spec_path, []), started = started)
+        except sqlite3.Error as err:
+            self._history_error(_("cannot write timing history"), err)
+
+    def _new_runner(self, spec_path):
+        """
+        Return a new Runner for the given spec file, an AsyncRunner if
+        timeouts are requested.
+        """
+        metadata = self._data.get(spec_path)
+        kwargs = {
+            'resume': self._resume,
+            'use_cache': self._use_cache,
+            'tracer': self._tracer,
+        }
+        if (self._timeout is not None) or (self._step_timeout is not None):
+            from molecule.aio import AsyncRunner
+            return AsyncRunner(spec_path, metadata, timeout = self._timeout,
+                step_timeout = self._step_timeout, **kwargs)
+        return Runner(spec_path, metadata, **kwargs)
+
+    def _run_inline(self, spec_path):
+        self._started[spec_path] = time.time()
+        my = self._new_runner(spec_path)
+        try:
+            rc = _run_traced(my, self._tracer)
+        except KeyboardInterrupt:
+            my.kill()
+            raise
+        finally:
+            self._step_results[spec_path] = my.step_results()
+        my.kill()
+        return _exit_status(rc)
+
+    def _start(self, spec_path):
+        index = self._data_order.index(spec_path)
+        log_path = os.path.join(self._log_dir, "%03d-%s.log" % (
+            index, os.path.basename(spec_path),))
+        self._log_paths[spec_path] = log_path
+        proc = self._mp.Process(target = _spec_worker,
+            args = (self._new_runner(spec_path), log_path, self._tracer,
+                self._trace_path(spec_path), self._results_path(spec_path),))
+        self._started[spec_path] = time.time()
+        proc.start()
+        self._info(spec_path, "%s, %s: %s" % (
+            _("started"), _("log"), log_path,))
+        return proc
+
+    def _trace_path(self, spec_path):
+        return self._log_paths[spec_path] + ".trace.json"
+
+    def _results_path(self, spec_path):
+        return self._log_paths[spec_path] + ".steps.json"
+
+    def _collect_step_results(self, spec_path):
+        """
+        Load the step results written by a child process.
+        """
+        results_path = self._results_path(spec_path)
+        try:
+            with open(results_path, "r") as results_f:
+                self._step_results[spec_path] = json.load(results_f)
+            os.remove(results_path)
+        except (IOError, OSError, ValueError):
+            # child did not manage to write it
+            self._step_results[spec_path] = []
+
+    def _collect_trace(self, spec_path):
+        """
+        Merge the timings collected by a child process.
+        """
+        if self._tracer is None:
+            return
+        trace_path = self._trace_path(spec_path)
+        try:
+            self._tracer.add_events(self._tracer.load(trace_path))
+            os.remove(trace_path)
+        except (IOError, OSError, ValueError):
+            # child did not manage to write it
+            pass
+
+    def _wait_any(self, running):
+        """
+        Block until at least one of the running processes terminates,
+        return the list of terminated spec files.
+        """
+        try:
+            from multiprocessing.connection import wait
+        except ImportError:
+            wait = None
+        while True:
+            if wait is not None:
+                wait([x.sentinel for x in running.values()])
+            finished = [x for x, y in running.items() if not y.is_alive()]
+            if finished:
+                return finished
+            if wait is None:
+                time.sleep(0.5)
+
+    def _terminate(self, running):
+        for proc in running.values():
+            if proc.is_alive():
+                proc.terminate()
+        for proc in running.values():
+            proc.join()
+
+    def run(self):
+        """
+        Execute all the spec files, return the combined exit status, which
+        is the exit status of the first failed spec file or 0.
+        """
+        if (self._log_dir is None) and not self._inline:
+            self._log_dir = molecule.utils.mkdtemp(suffix = "-logs")
+
+        pending = list(self._data_order)
+        running = {}
+        rc = 0
+        aborted = False
+
+        try:
+            while pending or running:
+
+                ready = []
+                if not aborted:
+                    ready = self._ready(pending)
+                if not (ready or running):
+                    break
+
+                if ready and (len(running) < self._jobs):
+                    spec_path = ready[0]
+                    pending.remove(spec_path)
+                    if self._inline:
+                        finished = [(spec_path, self._run_inline(spec_path))]
+                    else:
+                        running[spec_path] = self._start(spec_path)
+                        continue
+                else:
+                    finished = []
+                    for spec_path in self._wait_any(running):
+                        proc = running.pop(spec_path)
+                        proc.join()
+                        self._collect_trace(spec_path)
+                        self._collect_step_results(spec_path)
+                        finished.append(
+                            (spec_path, _exit_status(proc.exitcode)))
+
+                for spec_path, spec_rc in finished:
+                    self._results[spec_path] = spec_rc
+                    self._record_history(spec_path, spec_rc)
+                    if spec_rc == 0:
+                        if not self._inline:
+                            self._info(spec_path,
+                                _("completed successfully"))
+                        continue
+
+                    if not self._inline:
+                        self._info(spec_path, "%s: %s, %s: %s" % (
+                                darkred(_("failed")), spec_rc, _("log"),
+                                self._log_paths[spec_path],), type = "error")
+                    if rc == 0:
+                        rc = spec_rc
+                    if self._fail_fast and not aborted:
+                        aborted = True
+                        self._terminate(running)
+
+        except KeyboardInterrupt:
+            self._terminate(running)
+            raise
+
+        # all the workers have been reaped, the removal thread can be
+        # started without forking after it: paths trashed by the workers
+        # and leftovers of previous runs
+        molecule.utils.get_trash().reclaim()
+
+        for spec_path in pending:
+            self._info(spec_path, _("not executed"), type = "warning")
+
+        return rc
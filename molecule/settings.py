@@ -15,15 +15,17 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
-import codecs
 import os
 import re
 import shlex
+import threading
 
-from molecule.compat import get_stringtype, convert_to_unicode
+from molecule.compat import get_stringtype, convert_to_unicode, \
+    convert_to_rawstring
 from molecule.exception import SpecFileError
 from molecule.specs.skel import GenericSpec
 from molecule.version import VERSION
+from molecule.speccache import content_hash
 
 import molecule.utils
 
@@ -38,10 +40,18 @@ class Constants(dict):
         ETC_DIR = '/etc'
         CONFIG_FILE_NAME = 'molecule.conf'
         TMP_DIR = os.getenv("MOLECULE_TMPDIR", "/var/tmp")
+        # maximum size of the step output cache, in bytes
+        CACHE_MAX_SIZE = 20 * 1024 * 1024 * 1024
+        try:
+            CACHE_MAX_SIZE = int(os.getenv("MOLECULE_CACHE_MAX_SIZE",
+                CACHE_MAX_SIZE))
+        except ValueError:
+            pass
 
         settings = {
             'config_file': os.path.join(ETC_DIR, CONFIG_FILE_NAME),
             'tmp_dir': TMP_DIR,
+            'cache_max_size': CACHE_MAX_SIZE,
         }
         self.clear()
         self.update(settings)
@@ -61,6 +71,7 @@ class Configuration(dict):
         settings = {
             'version': VERSION,
             'tmp_dir': self._constants['tmp_dir'],
+            'cache_max_size': self._constants['cache_max_size'],
         }
 
         # convert everything to unicode in one pass
@@ -75,6 +86,352 @@ class Configuration(dict):
         self.update(mysettings)
 
 
+class _UnsupportedExpansion(Exception):
+    """ Shell syntax not handled by _expand_parameters() """
+
+# variables set (or changed) by the shell itself, their value cannot be
+# taken from our environment
+_SHELL_VARIABLES = frozenset([
+    "BASH", "BASHOPTS", "BASHPID", "BASH_ARGV0", "BASH_SUBSHELL",
+    "BASH_VERSINFO", "BASH_VERSION", "COLUMNS", "DIRSTACK", "EPOCHREALTIME",
+    "EPOCHSECONDS", "EUID", "FUNCNAME", "GROUPS", "HISTCMD", "HOSTNAME",
+    "HOSTTYPE", "IFS", "KSH_VERSION", "LINENO", "LINES", "MACHTYPE",
+    "OLDPWD", "OPTARG", "OPTIND", "OSTYPE", "PIPESTATUS", "PPID", "PS1",
+    "PS2", "PS4", "PWD", "RANDOM", "SECONDS", "SHELLOPTS", "SHLVL",
+    "SRANDOM", "UID", "ZSH_VERSION", "_",
+])
+_NAME_START = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_"
+_NAME_CHARS = _NAME_START + "0123456789"
+
+def _expand_word(string, pos, env, in_braces):
+    """
+    Expand string, starting at pos, as the shell would do inside double
+    quotes. Return a tuple composed by the expanded string and the
+    position where expansion stopped (the closing brace, if in_braces).
+    """
+    result = []
+    length = len(string)
+    while pos < length:
+        char = string[pos]
+        if in_braces and char == "}":
+            return "".join(result), pos
+        if char in "\\`\"" or (in_braces and char in "'{"):
+            raise _UnsupportedExpansion()
+        if char != "$":
+            result.append(char)
+            pos += 1
+            continue
+
+        pos += 1
+        if pos >= length:
+            result.append("$")
+            break
+        char = string[pos]
+        if char in _NAME_START:
+            end = pos
+            while end < length and string[end] in _NAME_CHARS:
+                end += 1
+            result.append(_variable_value(string[pos:end], env) or "")
+            pos = end
+        elif char == "{":
+            value, pos = _expand_braces(string, pos + 1, env)
+            result.append(value)
+        elif char in "(0123456789@*#?$!-":
+            # command substitution, arithmetic, special parameters
+            raise _UnsupportedExpansion()
+        else:
+            result.append("$")
+
+    if in_braces:
+        # missing closing brace
+        raise _UnsupportedExpansion()
+    return "".join(result), pos
+
+def _expand_braces(string, pos, env):
+    """
+    Expand a ${VAR}, ${VAR-word}, ${VAR:-word}, ${VAR+word} or
+    ${VAR:+word} parameter expansion, pos points right after the opening
+    brace. Return a tuple composed by the expanded string and the
+    position after the closing brace.
+    """
+    end = pos
+    if end < len(string) and string[end] in _NAME_START:
+        while end < len(string) and string[end] in _NAME_CHARS:
+            end += 1
+    if end == pos:
+        raise _UnsupportedExpansion()
+    value = _variable_value(string[pos:end], env)
+
+    operator = None
+    for candidate in (":-", ":+", "-", "+"):
+        if string.startswith(candidate, end):
+            operator = candidate
+            end += len(candidate)
+            break
+    if operator is None:
+        if not string.startswith("}", end):
+            raise _UnsupportedExpansion()
+        return value or "", end + 1
+
+    word, end = _expand_word(string, end, env, True)
+    if operator == ":-":
+        value = value or word
+    elif operator == "-":
+        if value is None:
+            value = word
+    elif operator == ":+":
+        value = value and word
+    else:
+        if value is not None:
+            value = word
+    return value or "", end + 1
+
+def _variable_value(name, env):
+    if name in _SHELL_VARIABLES or name.startswith("BASH_"):
+        raise _UnsupportedExpansion()
+    return env.get(name)
+
+class _RecordingEnvironment(object):
+    """ Environment wrapper recording the looked up variables """
+
+    def __init__(self, env):
+        self._env = env
+        self.referenced = {}
+
+    def get(self, name):
+        value = self._env.get(name)
+        self.referenced[name] = value
+        return value
+
+def _expand_parameters(argument, env = None):
+    """
+    Evaluate argument like molecule.utils.eval_shell_argument() does,
+    without spawning a shell: only $VAR, ${VAR}, ${VAR-word},
+    ${VAR:-word}, ${VAR+word} and ${VAR:+word} expansions are supported.
+
+    @param argument: shell argument
+    @type argument: string
+    @keyword env: environment, os.environ if None
+    @type env: dict
+    @return: the evaluated argument, or None if argument contains
+        unsupported syntax (command substitutions, quotes, escapes,
+        special parameters, etc) and must be evaluated by a shell
+    @rtype: string
+    """
+    if env is None:
+        env = os.environ
+    try:
+        return _expand_word(argument, 0, env, False)[0]
+    except _UnsupportedExpansion:
+        return None
+
+
+def _split_lines(chunks):
+    """
+    Generator equivalent to "".join(chunks).split("\\n"), without
+    building the joined string.
+    """
+    pending = []
+    for chunk in chunks:
+        parts = chunk.split("\n")
+        pending.append(parts[0])
+        if len(parts) == 1:
+            continue
+        yield "".join(pending)
+        for part in parts[1:-1]:
+            yield part
+        pending = [parts[-1]]
+    yield "".join(pending)
+
+def _iter_statements(lines):
+    """
+    Generator filtering comments and white lines out of preprocessed
+    lines.
+    """
+    for line in lines:
+        if line.startswith("#"):
+            continue
+        line = line.strip()
+        if line:
+            yield line.rsplit("#", 1)[0].strip()
+
+def _merge_values(values):
+    """
+    Merge the parsed values of a parameter spanning multiple lines:
+    strings are joined by a space, lists are concatenated.
+    """
+    value, rest = values[0], values[1:]
+    if not rest:
+        return value
+    string_type = get_stringtype()
+    if isinstance(value, string_type) and \
+            all(isinstance(x, string_type) for x in rest):
+        return " ".join([value] + rest)
+    if isinstance(value, list) and all(isinstance(x, list) for x in rest):
+        merged = list(value)
+        for part in rest:
+            merged.extend(part)
+        return merged
+    # mixed types, merge them one by one
+    for part in rest:
+        if isinstance(part, string_type):
+            value += " %s" % (part,)
+        else:
+            value += part
+    return value
+
+def _file_signature(path):
+    """
+    Return a tuple identifying the current version of the given file
+    without reading it.
+    """
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, getattr(st, "st_mtime_ns", st.st_mtime))
+
+
+class IncludeLoader(object):
+
+    """
+    Process-wide loader of the files read by SpecPreprocessor (spec files
+    and %import-ed fragments), shared by all the spec files parsed in a
+    run. File content is memoized by path and mtime, fragments expanded
+    without the help of the shell are memoized as well, as long as the
+    environment variables they referenced do not change. The resolved
+    include graph is exposed through graph() and includers().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # real path -> (signature, content hash, lines)
+        self._files = {}
+        # (real path, base directory) -> expanded fragment, see store()
+        self._fragments = {}
+        # real path -> set of directly imported real paths
+        self._graph = {}
+
+    def clear(self):
+        """
+        Drop all the memoized content and the include graph.
+        """
+        with self._lock:
+            self._files.clear()
+            self._fragments.clear()
+            self._graph.clear()
+
+    def read(self, path):
+        """
+        Return the content of the given UTF-8 file.
+
+        @param path: file path
+        @type path: string
+        @return: tuple composed by the content hash (see
+            molecule.speccache.content_hash()) and the list of lines
+        @rtype: tuple
+        """
+        real_path = os.path.realpath(path)
+        signature = _file_signature(real_path)
+        with self._lock:
+            entry = self._files.get(real_path)
+        if entry is not None and entry[0] == signature:
+            return entry[1], entry[2]
+
+        with open(real_path, "rb") as path_f:
+            data = path_f.read()
+        digest = content_hash(data)
+        lines = tuple(data.decode("UTF-8").splitlines(True))
+        with self._lock:
+            self._files[real_path] = (signature, digest, lines)
+        return digest, lines
+
+    def add_include(self, includer, included):
+        """
+        Record that includer (real path) imports included (real path).
+        """
+        with self._lock:
+            self._graph.setdefault(includer, set()).add(included)
+
+    def graph(self):
+        """
+        Return the include graph, a dict (key=real path of a spec file or
+        fragment, value=sorted list of the real paths it imports).
+        """
+        with self._lock:
+            return dict((x, sorted(y)) for x, y in self._graph.items())
+
+    def includers(self, path):
+        """
+        Return the sorted list of files (real paths) directly or
+        indirectly importing the given file.
+        """
+        target = os.path.realpath(path)
+        with self._lock:
+            reverse = {}
+            for includer, includes in self._graph.items():
+                for included in includes:
+                    reverse.setdefault(included, set()).add(includer)
+        found = set()
+        stack = [target]
+        while stack:
+            for includer in reverse.get(stack.pop(), ()):
+                if includer not in found:
+                    found.add(includer)
+                    stack.append(includer)
+        found.discard(target)
+        return sorted(found)
+
+    def lookup(self, path, base_dir):
+        """
+        Return the memoized expansion of the given fragment, or None if
+        not available or stale.
+
+        @param path: real path of the fragment
+        @type path: string
+        @param base_dir: directory relative imports are resolved against
+        @type base_dir: string
+        @return: tuple composed by the expanded content, a dict (key=path,
+            value=content hash) of the files read and a dict (key=name,
+            value=value) of the referenced environment variables
+        @rtype: tuple
+        """
+        with self._lock:
+            entry = self._fragments.get((path, base_dir))
+        if entry is None:
+            return None
+        content, inputs, signatures, referenced = entry
+        for name, value in referenced.items():
+            if os.environ.get(name) != value:
+                return None
+        for input_path, signature in signatures.items():
+            try:
+                if _file_signature(input_path) != signature:
+                    return None
+            except OSError:
+                return None
+        return content, dict(inputs), dict(referenced)
+
+    def store(self, path, base_dir, content, inputs, referenced):
+        """
+        Memoize the expansion of the given fragment, see lookup().
+        """
+        signatures = {}
+        try:
+            for input_path in inputs:
+                signatures[input_path] = _file_signature(input_path)
+        except OSError:
+            return
+        with self._lock:
+            self._fragments[(path, base_dir)] = (content, dict(inputs),
+                signatures, dict(referenced))
+
+_INCLUDE_LOADER = IncludeLoader()
+
+def get_include_loader():
+    """
+    Return the IncludeLoader shared by the current process.
+    """
+    return _INCLUDE_LOADER
+
+
 class SpecPreprocessor(object):
 
     PREFIX = "%"
@@ -82,10 +439,26 @@ class SpecPreprocessor(object):
     class PreprocessorError(Exception):
         """ Error while preprocessing file """
 
-    def __init__(self, spec_path):
+    def __init__(self, spec_path, cache = None):
+        """
+        Object constructor.
+
+        @param spec_path: spec file path
+        @type spec_path: string
+        @keyword cache: take the preprocessed content from, and store it
+            into, the given SpecCache
+        @type cache: molecule.speccache.SpecCache
+        """
         self.__expanders = {}
         self.__builtin_expanders = {}
         self._spec_path = spec_path
+        self._cache = cache
+        # inputs of the current parse() call, see SpecCache
+        self._inputs = {}
+        self._environment = _RecordingEnvironment(os.environ)
+        self._cacheable = True
+        # real paths of the files being expanded, innermost last
+        self._import_stack = []
         self._add_builtin_expanders()
 
     def add_expander(self, statement, expander_callback):
@@ -150,14 +523,87 @@ class SpecPreprocessor(object):
             raise SpecPreprocessor.PreprocessorError(
                 "invalid preprocessor line: %s" % (line,))
 
-        with codecs.open(path, "r", encoding="UTF-8") as spec_f:
-            lines = convert_to_unicode("")
-            for line in spec_f.readlines():
-                # call recursively
-                lines += self._builtin_recursive_expand(line)
+        real_path = os.path.realpath(path)
+        if real_path in self._import_stack:
+            raise SpecPreprocessor.PreprocessorError(
+                "circular %%import: %s" % (
+                    " -> ".join(self._import_stack + [real_path]),))
+        loader = get_include_loader()
+        loader.add_include(self._import_stack[-1], real_path)
+
+        base_dir = os.path.dirname(self._spec_path)
+        memoized = loader.lookup(real_path, base_dir)
+        if memoized is not None:
+            lines, inputs, referenced = memoized
+            self._inputs.update(inputs)
+            self._environment.referenced.update(referenced)
+            return lines
+
+        # track the inputs of this fragment alone
+        outer = (self._inputs, self._environment, self._cacheable)
+        self._inputs = {}
+        self._environment = _RecordingEnvironment(os.environ)
+        self._cacheable = True
+        self._import_stack.append(real_path)
+        try:
+            lines = convert_to_unicode("").join(self._expand_lines(path))
+        finally:
+            self._import_stack.pop()
+            inputs = self._inputs
+            referenced = self._environment.referenced
+            cacheable = self._cacheable
+            self._inputs, self._environment, self._cacheable = outer
+            self._inputs.update(inputs)
+            self._environment.referenced.update(referenced)
+            self._cacheable = self._cacheable and cacheable
+
+        if cacheable:
+            loader.store(real_path, base_dir, lines, inputs, referenced)
+        return lines
+
+    def _expand_lines(self, path):
+        """
+        Generator yielding the lines of the given file, expanded by the
+        builtin expanders (recursively).
+        """
+        for line in self._read_lines(path):
+            yield self._builtin_recursive_expand(line)
+
+    def _apply_expanders(self, lines):
+        """
+        Generator applying the expanders added through add_expander().
+        """
+        for line in lines:
+            expander = self.__expanders.get(line.split(" ", 1)[0])
+            if expander is not None:
+                line = expander(line)
+            yield line
 
+    def _read_lines(self, path):
+        """
+        Read the lines of the given UTF-8 file, keeping track of its
+        content for SpecCache.
+        """
+        digest, lines = get_include_loader().read(path)
+        self._inputs[path] = digest
         return lines
 
+    def includes(self):
+        """
+        Return the include graph of the spec file, see
+        IncludeLoader.graph(). Available after parse().
+        """
+        graph = get_include_loader().graph()
+        result = {}
+        stack = [os.path.realpath(self._spec_path)]
+        while stack:
+            path = stack.pop()
+            if path in result:
+                continue
+            result[path] = graph.get(path, [])
+            stack.extend(result[path])
+        return result
+
     def _env_expander(self, line):
         """
         Expand the line evaluating the environment variables
@@ -169,10 +615,21 @@ class SpecPreprocessor(object):
         if not split_line:
             return line
 
+        evaluator = molecule.utils.get_shell_evaluator()
         new_split_line = []
         for arg in split_line:
             try:
-                new_arg = molecule.utils.eval_shell_argument(arg)
+                new_arg = _expand_parameters(arg, env = self._environment)
+                if new_arg is None:
+                    # whatever the shell did cannot be tracked
+                    self._cacheable = False
+                    new_arg = evaluator.evaluate(arg)
+                elif not new_arg:
+                    raise AttributeError(
+                        "error while parsing argument: '%s'" % (arg,))
+                else:
+                    new_arg = convert_to_rawstring(new_arg,
+                        from_enctype = "utf-8")
             except AttributeError as err:
                 raise SpecPreprocessor.PreprocessorError(
                     "invalid preprocessor line: '%s', error: %s" % (
@@ -185,38 +642,56 @@ class SpecPreprocessor(object):
 
     def parse(self):
 
-        content = []
-        with codecs.open(self._spec_path, "r", encoding="UTF-8") as spec_f:
-            for line in spec_f.readlines():
-                line = self._builtin_recursive_expand(line)
-                content.append(line)
-
-        final_content = []
-        for line in content:
-            split_line = line.split(" ", 1)
-            if split_line:
-                expander = self.__expanders.get(split_line[0])
-                if expander is not None:
-                    line = expander(line)
-            final_content.append(line)
-
-        final_content = ("".join(final_content)).split("\n")
-
+        use_cache = (self._cache is not None) and not self.__expanders
+        if use_cache:
+            entry = self._cache.load_entry(self._spec_path)
+            if entry is not None:
+                content, includes = entry
+                loader = get_include_loader()
+                for includer, included in includes.items():
+                    for path in included:
+                        loader.add_include(includer, path)
+                return content
+
+        self._inputs = {}
+        self._environment = _RecordingEnvironment(os.environ)
+        self._cacheable = True
+        self._import_stack = [os.path.realpath(self._spec_path)]
+        lines = self._expand_lines(self._spec_path)
+        if self.__expanders:
+            # builtin expansion must be complete before custom expanders
+            # are called
+            lines = self._apply_expanders(list(lines))
+        final_content = list(_split_lines(lines))
+
+        if use_cache and self._cacheable:
+            try:
+                self._cache.store(self._spec_path, self._inputs,
+                    self._environment.referenced, final_content,
+                    includes = self.includes())
+            except (IOError, OSError):
+                # the cache is an optimization, never fail because of it
+                pass
         return final_content
 
 
 class SpecParser(object):
 
-    def __init__(self, filepath):
+    # comma separated list of spec files that must be executed
+    # successfully before this one
+    DEPENDS_KEY = "depends"
+
+    def __init__(self, filepath, spec_cache = None):
 
         self.filepath = filepath[:]
-        self._preprocessor = SpecPreprocessor(self.filepath)
+        self._preprocessor = SpecPreprocessor(self.filepath,
+            cache = spec_cache)
+        # preprocessed statements, computed once, see _generic_parser()
+        self._statements = None
 
         from molecule.specs.factory import PluginFactory
-        spec_plugins = PluginFactory.get_spec_plugins()
-
         execution_strategy = self.parse_execution_strategy()
-        plugin = spec_plugins.get(execution_strategy)
+        plugin = PluginFactory.get_spec_plugin(execution_strategy)
         if plugin is None:
             raise SpecFileError("Execution strategy provided in %s spec file"
                 " not supported, strategy: %s" % (
@@ -224,7 +699,42 @@ class SpecParser(object):
 
         self.__plugin = plugin(filepath)
         self.vital_parameters = self.__plugin.vital_parameters()
-        self.parameters = self.__plugin.parameters()
+        self.parameters = dict(self.__plugin.parameters())
+        for key, value in self._core_parameters().items():
+            if key in self.parameters:
+                raise SpecFileError("Execution strategy %s of %s spec file"
+                    " defines the '%s' parameter, reserved by Molecule" % (
+                        execution_strategy, self.filepath, key,))
+            self.parameters[key] = value
+
+    def _core_parameters(self):
+        """
+        Return the parameters handled by Molecule itself, available to
+        every spec file regardless of its execution strategy.
+        Dict format is the same of GenericSpec.parameters().
+        """
+        return {
+            SpecParser.DEPENDS_KEY: {
+                'parser': self._parse_depends,
+                'verifier': lambda x: len(x) != 0,
+            },
+        }
+
+    def _parse_depends(self, string):
+        """
+        Parse the list of spec files this spec file depends on. Relative
+        paths are relative to the directory containing this spec file.
+        """
+        spec_dir = os.path.dirname(os.path.abspath(self.filepath))
+        return [os.path.normpath(os.path.join(spec_dir, x.strip())) \
+                    for x in string.split(",") if x.strip()]
+
+    def includes(self):
+        """
+        Return the include graph of the spec file, see
+        SpecPreprocessor.includes().
+        """
+        return self._preprocessor.includes()
 
     def parse_execution_strategy(self):
         data = self._generic_parser()
@@ -250,10 +760,11 @@ class SpecParser(object):
 
     def parse(self):
         mydict = {}
-        data = self._generic_parser()
+        # parsed values of every parameter, merged once at the end
+        values = {}
         # compact lines properly
         old_key = None
-        for line in data:
+        for line in self._generic_parser():
             key = None
             value = None
             v_key, v_value = self.parse_line_statement(line)
@@ -273,15 +784,13 @@ class SpecParser(object):
             value = check_dict['parser'](value)
             if not check_dict['verifier'](value):
                 continue
-            if key in mydict:
-                if isinstance(value, get_stringtype()):
-                    mydict[key] += " %s" % (value,)
-                elif isinstance(value, list):
-                    mydict[key] += value
-                else:
-                    continue
-            else:
-                mydict[key] = value
+            key_values = values.get(key)
+            if key_values is None:
+                values[key] = [value]
+            elif isinstance(value, (get_stringtype(), list)):
+                key_values.append(value)
+        for key, key_values in values.items():
+            mydict[key] = _merge_values(key_values)
         mydict['__plugin__'] = self.__plugin
         self.validate_parse(mydict)
         return mydict.copy()
@@ -296,11 +805,12 @@ class SpecParser(object):
                 )
 
     def _generic_parser(self):
-        data = []
-        content = self._preprocessor.parse()
-        # filter comments and white lines
-        content = [x.strip().rsplit("#", 1)[0].strip() for x in content if \
-            not x.startswith("#") and x.strip()]
-        for line in content:
-            data.append(line)
-        return data
+        """
+        Return the list of statements of the spec file: preprocessed lines
+        without comments and white lines. The spec file is preprocessed
+        only once, by the first call.
+        """
+        if self._statements is None:
+            self._statements = list(_iter_statements(
+                self._preprocessor.parse()))
+        return self._statements
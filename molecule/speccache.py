@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+
+import os
+import stat
+import json
+import errno
+import hashlib
+
+import molecule.utils
+from molecule.compat import convert_to_rawstring
+from molecule.version import VERSION
+
+
+def content_hash(data):
+    """
+    Return the hex digest identifying the given raw file content.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+def _file_hash(path):
+    """
+    Return the sha256 hex digest of the given file content.
+    """
+    return molecule.utils.file_digests(path, ("sha256",))['sha256']
+
+
+class SpecCache(object):
+
+    """
+    On-disk cache of preprocessed spec files (see SpecPreprocessor),
+    stored inside the Molecule temporary directory. An entry is valid as
+    long as the content of the spec file and of every file it imported
+    (transitively), together with the value of every environment
+    variable it referenced, did not change.
+    Spec files evaluating arguments through the shell (command
+    substitutions, etc) cannot be cached, since their inputs are unknown.
+    """
+
+    CACHE_DIR = "molecule-spec-cache"
+
+    def __init__(self, cache_dir = None):
+        """
+        Object constructor.
+
+        @keyword cache_dir: cache directory, <tmp_dir>/molecule-spec-cache
+            if None
+        @type cache_dir: string
+        """
+        if cache_dir is None:
+            import molecule.settings
+            cache_dir = os.path.join(
+                molecule.settings.Configuration()['tmp_dir'],
+                SpecCache.CACHE_DIR)
+        self._cache_dir = cache_dir
+
+    def cache_dir(self):
+        """
+        Return the cache directory path.
+        """
+        return self._cache_dir
+
+    def _entry_path(self, spec_path):
+        real_path = os.path.realpath(spec_path)
+        return os.path.join(self._cache_dir, "%s.json" % (
+            hashlib.sha1(convert_to_rawstring(real_path)).hexdigest(),))
+
+    def _trusted(self):
+        """
+        Return whether the cache directory is owned by us and not
+        writable by others, cached content ends up being executed.
+        """
+        try:
+            st = os.lstat(self._cache_dir)
+        except OSError:
+            return False
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            return False
+        return not (st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+    def load(self, spec_path):
+        """
+        Return the cached preprocessed content of the given spec file, or
+        None if not cached or if the cache entry is stale.
+
+        @param spec_path: spec file path
+        @type spec_path: string
+        @return: list of lines, see SpecPreprocessor.parse()
+        @rtype: list
+        """
+        entry = self.load_entry(spec_path)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def load_entry(self, spec_path):
+        """
+        Same as load(), but return a tuple composed by the preprocessed
+        content and the include graph of the spec file (see
+        SpecPreprocessor.includes()), or None.
+        """
+        if not self._trusted():
+            return None
+        try:
+            with open(self._entry_path(spec_path), "r") as entry_f:
+                entry = json.load(entry_f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if entry.get('version') != VERSION:
+            return None
+        for name, value in entry['env'].items():
+            if os.environ.get(name) != value:
+                return None
+        for path, digest in entry['inputs'].items():
+            try:
+                if _file_hash(path) != digest:
+                    return None
+            except (IOError, OSError):
+                return None
+        includes = entry.get('includes', {})
+        return entry['content'], includes
+
+    def store(self, spec_path, inputs, env, content, includes = None):
+        """
+        Store the preprocessed content of the given spec file.
+
+        @param spec_path: spec file path
+        @type spec_path: string
+        @param inputs: dict (key=path, value=sha256 hex digest of the
+            content that has been preprocessed) of the spec file and of
+            the files it imported
+        @type inputs: dict
+        @param env: dict (key=name, value=value, None if unset) of the
+            referenced environment variables
+        @type env: dict
+        @param content: preprocessed content, list of lines
+        @type content: list
+        @keyword includes: include graph, see SpecPreprocessor.includes()
+        @type includes: dict
+        @raise IOError: if the entry cannot be written
+        @raise OSError: if the entry cannot be written
+        """
+        try:
+            os.makedirs(self._cache_dir, 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        if not self._trusted():
+            return
+
+        entry = {
+            'version': VERSION,
+            'inputs': dict(inputs),
+            'env': dict(env),
+            'content': list(content),
+            'includes': includes or {},
+        }
+        entry_path = self._entry_path(spec_path)
+        tmp_path = "%s.%d.tmp" % (entry_path, os.getpid(),)
+        with open(tmp_path, "w") as entry_f:
+            json.dump(entry, entry_f)
+        os.rename(tmp_path, entry_path)
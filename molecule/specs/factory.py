@@ -17,7 +17,57 @@
 #    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 import sys
 import os
+import json
+import stat
+import errno
+import hashlib
 import inspect
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from molecule.compat import convert_to_rawstring
+
+
+def iter_entry_points(group):
+    """
+    Return the entry points registered in the given group, through
+    importlib.metadata, falling back to pkg_resources (setuptools) on
+    older Python versions. Entry points are not loaded.
+
+    @param group: entry point group name
+    @type group: string
+    @return: list of entry point objects, having "name" attribute and
+        "load()" method
+    @rtype: list
+    """
+    try:
+        from importlib import metadata
+    except ImportError:
+        metadata = None
+
+    if metadata is None:
+        # needs setuptools
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(group))
+
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        entries = entry_points.select(group = group)
+    else:
+        entries = entry_points.get(group, ())
+
+    # the same distribution can be found more than once in sys.path
+    seen = set()
+    result = []
+    for entry in entries:
+        entry_id = (entry.name, entry.value)
+        if entry_id in seen:
+            continue
+        seen.add(entry_id)
+        result.append(entry)
+    return result
 
 class PluginFactory:
 
@@ -30,10 +80,14 @@ class PluginFactory:
     # A colon separated list of modules to load, looking for
     # Molecule plugins.
     _PLUGIN_MODULES = os.getenv("MOLECULE_PLUGIN_MODULES")
+    # plugin manifests directory name, inside Molecule tmp_dir
+    MANIFEST_DIR = "molecule-plugin-manifests"
+    _MANIFEST_VERSION = 1
 
     def __init__(self, base_plugin_class, plugin_package_module,
         default_plugin_name = None, fallback_plugin_name = None,
-        egg_entry_point_group = None):
+        egg_entry_point_group = None, manifest_key = None,
+        manifest_dir = None):
         """
         Molecule Generic Plugin Factory constructor.
         MANDATORY: every plugin module/package(name) must end with _plugin
@@ -67,8 +121,15 @@ class PluginFactory:
         a boolean value of True, such plugin will be ignored.
 
         If egg_entry_point_group is specified, Python Egg support is enabled
-        and classes are loaded via this infrastructure.
-        NOTE: if egg_entry_point_group is set, you NEED the setuptools package.
+        and classes are loaded via this infrastructure (entry points).
+        NOTE: if egg_entry_point_group is set and Python is older than 3.8,
+        you NEED the setuptools package.
+
+        If manifest_key is specified, plugins can be looked up by key (see
+        get_plugin()) through an on-disk manifest mapping keys to plugin
+        modules, so that only the module providing the requested plugin
+        gets imported. The manifest is regenerated (by importing all the
+        plugin modules) whenever a plugin module changes.
 
         @param base_plugin_class: Base class that valid plugin classes must
             inherit from.
@@ -86,6 +147,12 @@ class PluginFactory:
         @keyword egg_entry_point_group: valid Python Egg entry point group, in
             this case, Python Egg support is used
         @type egg_entry_point_group: string
+        @keyword manifest_key: function returning the lookup key of the
+            given plugin class
+        @type manifest_key: callable
+        @keyword manifest_dir: plugin manifests directory,
+            <tmp_dir>/molecule-plugin-manifests if None
+        @type manifest_dir: string
         @raise AttributeError: when passed plugin_package_module is not a
             valid Python package module
         """
@@ -95,8 +162,13 @@ class PluginFactory:
         self.__default_plugin_name = default_plugin_name
         self.__fallback_plugin_name = fallback_plugin_name
         self.__egg_entry_group = egg_entry_point_group
+        self.__manifest_key = manifest_key
+        self.__manifest_dir = manifest_dir
         self.__cache = None
         self.__inspect_cache = None
+        self.__manifest = None
+        self.__loaded = {}
+        self.__entry_points = None
 
     def clear_cache(self):
         """
@@ -105,6 +177,9 @@ class PluginFactory:
         """
         self.__cache = None
         self.__inspect_cache = None
+        self.__manifest = None
+        self.__loaded.clear()
+        self.__entry_points = None
 
     def _inspect_object(self, obj):
         """
@@ -173,16 +248,12 @@ class PluginFactory:
         self.__inspect_cache[obj_memory_pos] = True
         return True
 
-    def _scan_dir(self):
+    def _plugin_modules(self):
         """
-        Scan modules in given directory looking for a valid plugin class.
-        Directory is os.path.dirname(self.__modfile).
-
-        @return: module dictionary composed by module name as key and plugin
-            class as value
-        @rtype: dict
+        Return the list of candidate plugin module paths: the *_plugin
+        modules inside the plugin package, followed by the ones listed in
+        MOLECULE_PLUGIN_MODULES.
         """
-        available = {}
         pkg_modname = self.__plugin_package_module.__name__
         mod_dir = os.path.dirname(self.__modfile)
         modules = []
@@ -201,35 +272,72 @@ class PluginFactory:
             if not modname.endswith(PluginFactory._PLUGIN_SUFFIX):
                 continue
 
-            # remove suffix
-            modname_clean = modname[:-len(PluginFactory._PLUGIN_SUFFIX)]
-
             modpath = "%s.%s" % (pkg_modname, modname,)
             modules.append(modpath)
 
         plugin_modules = self._PLUGIN_MODULES
         if plugin_modules:
             modules.extend(plugin_modules.split(":"))
+        return modules
 
-        for modpath in modules:
+    def _scan_module(self, modpath):
+        """
+        Import the given module and return its valid plugin class (the
+        last one found), or None.
+        """
+        try:
+            __import__(modpath)
+        except ImportError as err:
+            sys.stderr.write("!!! Molecule Plugin warning, cannot " \
+                "load module: %s | %s !!!\n" % (modpath, err,))
+            return None
 
-            try:
-                __import__(modpath)
-            except ImportError as err:
-                sys.stderr.write("!!! Molecule Plugin warning, cannot " \
-                    "load module: %s | %s !!!\n" % (modpath, err,))
-                continue
+        plugin = None
+        for obj in list(sys.modules[modpath].__dict__.values()):
 
-            for obj in list(sys.modules[modpath].__dict__.values()):
+            valid = self._inspect_object(obj)
+            if not valid:
+                continue
 
-                valid = self._inspect_object(obj)
-                if not valid:
-                    continue
+            plugin = obj
+        return plugin
 
-                available[modpath] = obj
+    def _scan_dir(self):
+        """
+        Scan modules in given directory looking for a valid plugin class.
+        Directory is os.path.dirname(self.__modfile).
 
+        @return: module dictionary composed by module name as key and plugin
+            class as value
+        @rtype: dict
+        """
+        available = {}
+        for modpath in self._plugin_modules():
+            plugin = self._scan_module(modpath)
+            if plugin is not None:
+                available[modpath] = plugin
         return available
 
+    def _egg_entry_points(self):
+        if self.__entry_points is None:
+            self.__entry_points = iter_entry_points(self.__egg_entry_group)
+        return self.__entry_points
+
+    def _load_entry_point(self, entry):
+        """
+        Load the given entry point, return the plugin class or None if
+        not valid.
+        """
+        try:
+            obj = entry.load()
+        except ImportError as err:
+            sys.stderr.write("!!! Molecule Plugin warning, cannot " \
+                "load entry point: %s | %s !!!\n" % (entry.name, err,))
+            return None
+        if not self._inspect_object(obj):
+            return None
+        return obj
+
     def _scan_egg_group(self):
         """
         Scan classes in given Python Egg group name looking for a valid plugin.
@@ -238,20 +346,39 @@ class PluginFactory:
             class as value
         @rtype: dict
         """
-        # needs setuptools
-        import pkg_resources
         available = {}
 
-        for entry in pkg_resources.iter_entry_points(self.__egg_entry_group):
+        for entry in self._egg_entry_points():
 
-            obj = entry.load()
-            valid = self._inspect_object(obj)
-            if not valid:
+            obj = self._load_entry_point(entry)
+            if obj is None:
                 continue
             available[entry.name] = obj
 
         return available
 
+    def _plugin_key(self, name, plugin):
+        if self.__manifest_key is None:
+            return name
+        return self.__manifest_key(plugin)
+
+    def _get_egg_plugin(self, key):
+        """
+        Return the plugin class having the given key, loading only the
+        entry points named after it, if possible.
+        """
+        for entry in self._egg_entry_points():
+            if entry.name != key:
+                continue
+            obj = self._load_entry_point(entry)
+            if obj is not None and self._plugin_key(entry.name, obj) == key:
+                return obj
+
+        # entry point names do not match plugin keys, load them all
+        for name, obj in self.get_available_plugins().items():
+            if self._plugin_key(name, obj) == key:
+                return obj
+        return None
 
     def get_available_plugins(self):
         """
@@ -274,6 +401,188 @@ class PluginFactory:
         self.__cache = available.copy()
         return available
 
+    def _manifest_path(self):
+        manifest_dir = self.__manifest_dir
+        if manifest_dir is None:
+            import molecule.settings
+            manifest_dir = os.path.join(
+                molecule.settings.Configuration()['tmp_dir'],
+                PluginFactory.MANIFEST_DIR)
+        klass = self.__base_class
+        factory_id = "%s.%s %s %s %s" % (
+            klass.__module__, klass.__name__,
+            self.__plugin_package_module.__name__,
+            os.path.realpath(self.__modfile), sys.version_info[:2],)
+        return os.path.join(manifest_dir, "%s-%s.json" % (
+            klass.__name__,
+            hashlib.sha1(convert_to_rawstring(factory_id)).hexdigest()[:12],))
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def _load_manifest(self):
+        """
+        Load the on-disk manifest, return None if missing or stale.
+        """
+        manifest_path = self._manifest_path()
+        try:
+            # manifest data decides what gets imported, trust only our own
+            st = os.lstat(os.path.dirname(manifest_path))
+            if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() \
+                    or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                return None
+            with open(manifest_path, "r") as manifest_f:
+                manifest = json.load(manifest_f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            if manifest['version'] != PluginFactory._MANIFEST_VERSION:
+                return None
+            if manifest['plugin_modules'] != (self._PLUGIN_MODULES or ""):
+                return None
+            package_dir = os.path.dirname(self.__modfile)
+            if manifest['package_mtime'] != self._mtime(package_dir):
+                return None
+            for path, mtime in manifest['files'].items():
+                if self._mtime(path) != mtime:
+                    return None
+            return manifest
+        except (KeyError, AttributeError, TypeError):
+            return None
+
+    def _build_manifest(self):
+        """
+        Scan all the plugin modules and write a new manifest, return it.
+        """
+        package_dir = os.path.dirname(self.__modfile)
+        package_mtime = self._mtime(package_dir)
+        available = self.get_available_plugins()
+
+        plugins = {}
+        for modpath, plugin in available.items():
+            plugins[self.__manifest_key(plugin)] = [modpath, plugin.__name__]
+        manifest = {
+            'version': PluginFactory._MANIFEST_VERSION,
+            'plugin_modules': self._PLUGIN_MODULES or "",
+            'package_mtime': package_mtime,
+            'files': {},
+            'plugins': plugins,
+        }
+
+        cacheable = True
+        for modpath in self._plugin_modules():
+            module = sys.modules.get(modpath)
+            modfile = getattr(module, "__file__", None)
+            if modfile is None:
+                # broken module: it must be looked at on every run
+                cacheable = False
+                break
+            manifest['files'][modfile] = self._mtime(modfile)
+
+        if cacheable:
+            self._write_manifest(manifest)
+        return manifest
+
+    def _write_manifest(self, manifest):
+        manifest_path = self._manifest_path()
+        manifest_dir = os.path.dirname(manifest_path)
+        tmp_path = "%s.%d.tmp" % (manifest_path, os.getpid(),)
+        try:
+            try:
+                os.makedirs(manifest_dir, 0o700)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            with open(tmp_path, "w") as manifest_f:
+                json.dump(manifest, manifest_f)
+            os.rename(tmp_path, manifest_path)
+        except (IOError, OSError):
+            # the manifest is an optimization, never fail because of it
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _get_manifest(self):
+        if self.__manifest is None:
+            manifest = self._load_manifest()
+            if manifest is None:
+                manifest = self._build_manifest()
+            self.__manifest = manifest
+        return self.__manifest
+
+    def get_plugin_keys(self):
+        """
+        Return the list of keys of the available plugins, without importing
+        them (if the manifest is up-to-date). Requires manifest_key, unless
+        egg_entry_point_group is set (see get_plugin()).
+
+        @return: list of plugin keys
+        @rtype: list
+        """
+        if self.__egg_entry_group:
+            keys = []
+            for entry in self._egg_entry_points():
+                if entry.name not in keys:
+                    keys.append(entry.name)
+            return keys
+        return list(self._get_manifest()['plugins'].keys())
+
+    def get_plugin(self, key):
+        """
+        Return the plugin class having the given key, importing only the
+        module providing it (if the manifest is up-to-date). Requires
+        manifest_key, unless egg_entry_point_group is set: in this case
+        no manifest is used and only the entry points named after the key
+        are loaded (keys default to entry point names).
+
+        @param key: plugin key, as returned by manifest_key
+        @type key: string
+        @return: plugin class or None, if not available
+        @rtype: class
+        """
+        plugin = self.__loaded.get(key)
+        if plugin is not None:
+            return plugin
+
+        if self.__egg_entry_group:
+            plugin = self._get_egg_plugin(key)
+            if plugin is not None:
+                self.__loaded[key] = plugin
+            return plugin
+
+        entry = self._get_manifest()['plugins'].get(key)
+        if entry is None:
+            return None
+        modpath, name = entry
+        plugin = self._scan_module(modpath)
+        if plugin is None or plugin.__name__ != name \
+                or self.__manifest_key(plugin) != key:
+            # stale manifest (sys.path changes, etc), regenerate it
+            self.__cache = None
+            self.__manifest = self._build_manifest()
+            entry = self.__manifest['plugins'].get(key)
+            if entry is None:
+                return None
+            plugin = self.get_available_plugins()[entry[0]]
+
+        self.__loaded[key] = plugin
+        return plugin
+
+    def get_plugin_map(self):
+        """
+        Return a read-only, lazily loaded mapping of plugin keys to plugin
+        classes, see get_plugin(). Requires manifest_key.
+
+        @rtype: Mapping
+        """
+        return _LazyPluginMap(self)
+
     def get_default_plugin(self):
         """
         Return currently configured Molecule Plugin class.
@@ -308,13 +617,45 @@ class PluginFactory:
                 from .. import plugins as plugs
             except ImportError:
                 from . import plugins as plugs
-            PluginFactory._SPEC_FACTORY = PluginFactory(GenericSpec, plugs)
+            PluginFactory._SPEC_FACTORY = PluginFactory(GenericSpec, plugs,
+                manifest_key = lambda x: x.execution_strategy())
         return PluginFactory._SPEC_FACTORY
 
+    @staticmethod
+    def get_spec_plugin(strategy):
+        """
+        Return the spec plugin class implementing the given execution
+        strategy, or None. Only the module providing it is imported.
+        """
+        return PluginFactory._get_spec().get_plugin(strategy)
+
     @staticmethod
     def get_spec_plugins():
-        factory = PluginFactory._get_spec()
-        plugins = factory.get_available_plugins()
-        spec_plugins = dict((y.execution_strategy(), y) for x, y \
-            in list(plugins.items()))
-        return spec_plugins
+        """
+        Return a mapping of execution strategies to spec plugin classes,
+        plugin modules are imported on access.
+        """
+        return PluginFactory._get_spec().get_plugin_map()
+
+
+class _LazyPluginMap(Mapping):
+
+    """
+    Read-only mapping of plugin keys to plugin classes, importing the
+    plugin modules on access. See PluginFactory.get_plugin_map().
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getitem__(self, key):
+        plugin = self._factory.get_plugin(key)
+        if plugin is None:
+            raise KeyError(key)
+        return plugin
+
+    def __iter__(self):
+        return iter(self._factory.get_plugin_keys())
+
+    def __len__(self):
+        return len(self._factory.get_plugin_keys())
@@ -72,6 +72,27 @@ class GenericExecutionStep(object):
         """
         raise NotImplementedError()
 
+    def cache_inputs(self):
+        """
+        Return the list of paths (files or directories), besides the spec
+        file metadata, the outputs of this step depend on. Their content
+        is part of the step output cache key.
+        See cache_outputs().
+        """
+        return []
+
+    def cache_outputs(self):
+        """
+        Return the list of paths (files or directories) produced by this
+        step. If the step output cache is enabled, these paths are stored
+        into the cache after a successful execution and restored, instead
+        of executing the step again, when the cache key (see
+        cache_inputs()) matches. The returned list must only depend on
+        the spec file metadata, this method is called before setup().
+        Default: None, step outputs cannot be cached.
+        """
+        return None
+
 
 class GenericSpec(object):
 
@@ -191,7 +212,11 @@ class GenericSpec(object):
     def execution_steps(self):
         """
         Return a list of GenericExecutionStep classes that will be initialized
-        and executed by molecule.handlers.Runner
+        and executed by molecule.handlers.Runner, in order.
+        A list element can also be a tuple (or list) of GenericExecutionStep
+        classes: they form a parallel group and are executed at the same
+        time, in separate threads. The next list element is executed once
+        every step of the group is terminated successfully.
         """
         raise NotImplementedError()
 
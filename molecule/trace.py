@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+import molecule.output
+from molecule.i18n import _
+
+
+def _cpu_time():
+    """
+    Return the CPU time consumed by the calling thread (by the whole
+    process if per-thread accounting is not available), in seconds.
+    """
+    thread_time = getattr(time, "thread_time", None)
+    if thread_time is not None:
+        return thread_time()
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Tracer(object):
+
+    """
+    Collect wall clock and CPU timings of spec file executions and of
+    GenericExecutionStep hooks, in Chrome trace event format (complete
+    events, "ph" = "X"), loadable by chrome://tracing and compatible
+    trace viewers.
+    """
+
+    def __init__(self):
+        self._events = []
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """
+        Drop all the collected events.
+        """
+        with self._lock:
+            del self._events[:]
+
+    def events(self):
+        """
+        Return a copy of the collected events.
+        """
+        with self._lock:
+            return list(self._events)
+
+    def add_events(self, events):
+        """
+        Add already collected events (for example, coming from another
+        process).
+        """
+        with self._lock:
+            self._events.extend(events)
+
+    @contextlib.contextmanager
+    def span(self, name, cat, args = None):
+        """
+        Context manager recording the wall clock and CPU time spent
+        inside it.
+
+        @param name: event name
+        @type name: string
+        @param cat: event category ("spec", "hook", etc)
+        @type cat: string
+        @keyword args: extra event arguments
+        @type args: dict
+        """
+        start = time.time()
+        cpu_start = _cpu_time()
+        try:
+            yield
+        finally:
+            cpu = _cpu_time() - cpu_start
+            end = time.time()
+            event_args = {'cpu_ms': round(cpu * 1000.0, 3)}
+            if args:
+                event_args.update(args)
+            event = {
+                'name': name,
+                'cat': cat,
+                'ph': "X",
+                'ts': int(start * 1000000),
+                'dur': int((end - start) * 1000000),
+                'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'args': event_args,
+            }
+            with self._lock:
+                self._events.append(event)
+
+    def write(self, path):
+        """
+        Write the collected events to path, as Chrome trace JSON.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as trace_f:
+            json.dump({
+                'traceEvents': self.events(),
+                'displayTimeUnit': "ms",
+            }, trace_f)
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        """
+        Load events from a Chrome trace JSON file written by write().
+        """
+        with open(path, "r") as trace_f:
+            return json.load(trace_f).get('traceEvents', [])
+
+    def summary(self):
+        """
+        Aggregate the collected events by category and name.
+
+        @return: list of (category, name, count, wall seconds,
+            cpu seconds) tuples, sorted by wall time, descending
+        @rtype: list
+        """
+        totals = {}
+        for event in self.events():
+            key = (event['cat'], event['name'])
+            count, wall, cpu = totals.get(key, (0, 0.0, 0.0))
+            totals[key] = (count + 1, wall + event['dur'] / 1000000.0,
+                cpu + event['args'].get('cpu_ms', 0.0) / 1000.0)
+        rows = [(k[0], k[1], v[0], v[1], v[2]) for k, v in totals.items()]
+        rows.sort(key = lambda x: x[3], reverse = True)
+        return rows
+
+    def print_summary(self):
+        """
+        Print the summary() table.
+        """
+        molecule.output.print_info("%10s %10s %6s  %-6s %s" % (
+            _("wall (s)"), _("cpu (s)"), _("count"), _("type"), _("name"),))
+        for cat, name, count, wall, cpu in self.summary():
+            molecule.output.print_info("%10.3f %10.3f %6d  %-6s %s" % (
+                wall, cpu, count, cat, name,))
@@ -17,16 +17,26 @@
 #    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 import os
+import stat
 import errno
 import fcntl
+import atexit
+import hashlib
+import binascii
 import sys
 import time
 import tempfile
 import subprocess
 import signal
-import shutil
 import glob
 import random
+import re
+import threading
+import contextlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 random.seed()
 
 from molecule.compat import convert_to_rawstring
@@ -47,7 +57,11 @@ def is_super_user():
 def valid_exec_check(path):
     """
     Determine whethern give path is valid executable (by running it).
+    Bare executable names missing from PATH (see ExecutableIndex) are
+    rejected without spawning anything.
     """
+    if "/" not in path and not get_executable_index().lookup(path):
+        raise EnvironmentError("EnvironmentError: %s not found" % (path,))
     tmp_fd, tmp_path = None, None
     try:
         tmp_fd, tmp_path = tempfile.mkstemp()
@@ -65,6 +79,124 @@ def valid_exec_check(path):
         if tmp_path is not None:
             os.remove(tmp_path)
 
+def _is_executable_file(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+def _list_dir_names(path):
+    """
+    Return the set of entry names of the given directory, with a single
+    scandir() (listdir() on Python 2).
+    """
+    scandir = getattr(os, "scandir", None)
+    if scandir is None:
+        return frozenset(os.listdir(path))
+    iterator = scandir(path)
+    try:
+        return frozenset(entry.name for entry in iterator)
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+
+
+class ExecutableIndex(object):
+
+    """
+    Memoized index of the executables available in PATH. Every PATH
+    directory is listed once and its listing is reused until the
+    directory changes (modification time in nanoseconds, where
+    available, inode number or size). Names missing from the listings are
+    rejected without touching the filesystem, while listed names are
+    checked for executability at every lookup (permission changes do
+    not update the directory mtime).
+    This class is thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # directory -> (stat signature, names)
+        self._dirs = {}
+        # PATH value -> tuple of directories
+        self._paths = {}
+
+    def clear(self):
+        """
+        Drop all the memoized directory listings.
+        """
+        with self._lock:
+            self._dirs.clear()
+            self._paths.clear()
+
+    def _directories(self, paths):
+        dirs = self._paths.get(paths)
+        if dirs is None:
+            dirs = []
+            for path in paths.split(":"):
+                if path not in dirs:
+                    dirs.append(path)
+            dirs = tuple(dirs)
+            self._paths[paths] = dirs
+        return dirs
+
+    def _dir_entry(self, path):
+        """
+        Return the up-to-date (stat signature, names) record of the given
+        directory, None if it cannot be listed.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._dirs.pop(path, None)
+            return None
+        # st_mtime is a float, with a coarser resolution
+        signature = (getattr(st, "st_mtime_ns", st.st_mtime), st.st_ino,
+            st.st_size)
+        record = self._dirs.get(path)
+        if record is not None and record[0] == signature:
+            return record
+        try:
+            names = _list_dir_names(path)
+        except OSError:
+            self._dirs.pop(path, None)
+            return None
+        record = (signature, names)
+        self._dirs[path] = record
+        return record
+
+    def lookup(self, exec_name, paths = None):
+        """
+        Return the full path of the given executable name, as found in
+        PATH, or None.
+
+        @param exec_name: executable name, without directory components
+        @type exec_name: string
+        @keyword paths: PATH value, os.environ PATH if None
+        @type paths: string
+        @return: executable path or None
+        @rtype: string
+        """
+        if paths is None:
+            paths = os.getenv("PATH")
+        if not paths:
+            return None
+        with self._lock:
+            for path in self._directories(paths):
+                record = self._dir_entry(path)
+                if record is None or exec_name not in record[1]:
+                    continue
+                exec_path = os.path.join(path, exec_name)
+                if _is_executable_file(exec_path):
+                    return exec_path
+        return None
+
+_EXECUTABLE_INDEX = ExecutableIndex()
+
+def get_executable_index():
+    """
+    Return the process-wide ExecutableIndex instance.
+    """
+    return _EXECUTABLE_INDEX
+
 def is_exec_available(exec_name):
     """
     Determine whether given executable name is available in PATH.
@@ -73,12 +205,15 @@ def is_exec_available(exec_name):
     paths = os.getenv("PATH")
     if not paths:
         return False
-    paths = paths.split(":")
-    for path in paths:
-        path = os.path.join(path, exec_name)
-        if os.path.isfile(path) and os.access(path, os.X_OK):
-            return True
-    return False
+    if os.path.isabs(exec_name):
+        return _is_executable_file(exec_name)
+    if "/" in exec_name:
+        for path in paths.split(":"):
+            if _is_executable_file(os.path.join(path, exec_name)):
+                return True
+        return False
+    return get_executable_index().lookup(exec_name, paths = paths) \
+        is not None
 
 def eval_shell_argument(argument, env = None):
     """
@@ -90,45 +225,395 @@ def eval_shell_argument(argument, env = None):
 
     In case of errors, AttributeError() is raised.
     """
-    read, write = None, None
-    try:
-        shell_exec = os.getenv("SHELL", "/bin/sh")
-        read, write = os.pipe()
-        # set non-blocking
-        fcntl.fcntl(read, fcntl.F_SETFL, os.O_NONBLOCK)
-        exit_st = subprocess.call(
-            [shell_exec, "-c",
-            "printf '%s' \"" + argument + "\""],
-        env = env, stdout = write)
-        if exit_st != 0:
+    shell_exec = os.getenv("SHELL", "/bin/sh")
+    proc = subprocess.Popen(
+        [shell_exec, "-c",
+        "printf '%s' \"" + argument + "\""],
+        env = env, stdout = subprocess.PIPE)
+    evaluated = proc.communicate()[0]
+    if proc.returncode != 0 or not evaluated:
+        raise AttributeError(
+            "error while parsing argument: '%s'" % (
+                argument,))
+    return evaluated
+
+class ShellEvaluator(object):
+
+    """
+    Evaluate shell arguments like eval_shell_argument() does, through a
+    single long-lived $SHELL coprocess instead of spawning a new shell
+    for every argument. Every argument is evaluated inside its own
+    subshell (so that shell state does not leak from an argument to
+    another) with stdin redirected from /dev/null, and its output is
+    framed by a random token followed by the subshell exit status.
+    The coprocess is restarted if the environment changes or after a
+    fork(). Shells that are not POSIX compatible are handled by falling
+    back to eval_shell_argument().
+    """
+
+    # shells understanding the framing protocol
+    POSIX_SHELLS = ("sh", "bash", "dash", "ash", "ksh", "mksh", "zsh",
+        "busybox",)
+
+    def __init__(self, shell = None, env = None):
+        """
+        Object constructor.
+
+        @keyword shell: shell executable, $SHELL (or /bin/sh) if None
+        @type shell: string
+        @keyword env: environment, inherited if None
+        @type env: dict
+        """
+        if shell is None:
+            shell = os.getenv("SHELL", "/bin/sh")
+        self._shell = shell
+        self._env = env
+        self._proc = None
+        self._pid = None
+        self._env_snapshot = None
+        self._token = None
+        self._lock = threading.Lock()
+
+    def _current_env(self):
+        if self._env is not None:
+            return self._env
+        return dict(os.environ)
+
+    def _start(self):
+        env = self._current_env()
+        self._proc = subprocess.Popen([self._shell], stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE, env = env)
+        self._pid = os.getpid()
+        self._env_snapshot = env
+        self._token = convert_to_rawstring(
+            "%s" % (binascii.hexlify(os.urandom(16)).decode("ascii"),))
+
+    def _stop(self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        if self._pid != os.getpid():
+            # inherited through fork(), the coprocess belongs to the parent
+            return
+        for pipe in (proc.stdin, proc.stdout):
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+        try:
+            proc.wait()
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Terminate the shell coprocess.
+        """
+        with self._lock:
+            self._stop()
+
+    def _ensure_started(self):
+        if self._proc is not None:
+            if (self._pid != os.getpid()) or \
+                    (self._env_snapshot != self._current_env()):
+                self._stop()
+        if self._proc is None:
+            self._start()
+
+    def _read_frame(self):
+        """
+        Read the output of an evaluation, return a tuple composed by the
+        output and the exit status, or None if the coprocess died.
+        """
+        marker = b"\036" + self._token + b" "
+        fd = self._proc.stdout.fileno()
+        buf = b""
+        while True:
+            pos = buf.find(marker)
+            if pos != -1:
+                end = buf.find(b"\n", pos)
+                if end != -1:
+                    try:
+                        exit_st = int(buf[pos + len(marker):end])
+                    except ValueError:
+                        return None
+                    return buf[:pos], exit_st
+            try:
+                chunk = os.read(fd, 65536)
+            except OSError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                return None
+            if not chunk:
+                return None
+            buf += chunk
+
+    def _evaluate(self, argument):
+        self._ensure_started()
+        command = "printf '%s' \"" + argument + "\""
+        request = "( eval %s ) </dev/null; printf '\\036%%s %%d\\n' %s $?\n" % (
+            _shell_quote(command), self._token.decode("ascii"),)
+        try:
+            self._proc.stdin.write(convert_to_rawstring(request))
+            self._proc.stdin.flush()
+        except (IOError, OSError):
+            return None
+        return self._read_frame()
+
+    def evaluate(self, argument):
+        """
+        Evaluate a single shell argument, see eval_shell_argument().
+
+        @param argument: shell argument
+        @type argument: string
+        @return: evaluated argument
+        @rtype: bytes
+        @raise AttributeError: in case of errors
+        """
+        if os.path.basename(self._shell) not in ShellEvaluator.POSIX_SHELLS:
+            return eval_shell_argument(argument, env = self._env)
+
+        with self._lock:
+            frame = self._evaluate(argument)
+            if frame is None:
+                # the coprocess died (killed by the argument itself?)
+                self._stop()
+        if frame is None:
+            return eval_shell_argument(argument, env = self._env)
+
+        evaluated, exit_st = frame
+        if exit_st != 0 or not evaluated:
             raise AttributeError(
-                "error while parsing argument: '%s'" % (
-                    argument,))
-        # maximum 1024 chars
+                "error while parsing argument: '%s'" % (argument,))
+        return evaluated
+
+def _shell_quote(string):
+    """
+    Quote string for a POSIX shell.
+    """
+    return "'" + string.replace("'", "'\"'\"'") + "'"
+
+_SHELL_EVALUATOR = None
+_SHELL_EVALUATOR_LOCK = threading.Lock()
+
+def get_shell_evaluator():
+    """
+    Return the ShellEvaluator shared by the current process.
+    """
+    global _SHELL_EVALUATOR
+    with _SHELL_EVALUATOR_LOCK:
+        if _SHELL_EVALUATOR is None:
+            _SHELL_EVALUATOR = ShellEvaluator()
+            atexit.register(_SHELL_EVALUATOR.close)
+        return _SHELL_EVALUATOR
+
+# child processes spawned by exec_cmd() and friends, value is the
+# identifier of the spawning thread
+_CHILDREN = {}
+_CHILDREN_LOCK = threading.Lock()
+
+# per-thread ChildUsage collecting the resource usage of the child
+# processes, see account_children()
+_ACCOUNTING = threading.local()
+
+
+class ChildUsage(object):
+
+    """
+    Resource usage of the child processes spawned by exec_cmd(),
+    exec_chroot_cmd() and friends while accounting is active, see
+    account_children(). CPU times and peak RSS come from wait4(), I/O
+    counters from /proc/<pid>/io (read before reaping the child, they
+    also include its reaped descendants), when available.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.processes = 0
+        self.user_time = 0.0
+        self.system_time = 0.0
+        self.max_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.read_chars = 0
+        self.write_chars = 0
+        self.io_available = True
+
+    def add(self, rusage, io_counters):
+        """
+        Account a terminated child process.
+
+        @param rusage: resource usage as returned by os.wait4()
+        @type rusage: resource.struct_rusage
+        @param io_counters: /proc/<pid>/io counters, None if not available
+        @type io_counters: dict
+        """
+        with self._lock:
+            self.processes += 1
+            self.user_time += rusage.ru_utime
+            self.system_time += rusage.ru_stime
+            self.max_rss = max(self.max_rss, rusage.ru_maxrss)
+            if io_counters is None:
+                self.io_available = False
+                return
+            self.read_bytes += io_counters.get('read_bytes', 0)
+            self.write_bytes += io_counters.get('write_bytes', 0)
+            self.read_chars += io_counters.get('rchar', 0)
+            self.write_chars += io_counters.get('wchar', 0)
+
+    def as_dict(self):
+        """
+        Return the collected figures as dict, times are in seconds, peak
+        RSS in KiB, I/O counters in bytes (None if not available).
+        """
+        with self._lock:
+            data = {
+                'processes': self.processes,
+                'user_time': round(self.user_time, 6),
+                'system_time': round(self.system_time, 6),
+                'max_rss': self.max_rss,
+                'read_bytes': None,
+                'write_bytes': None,
+                'read_chars': None,
+                'write_chars': None,
+            }
+            if self.io_available:
+                data['read_bytes'] = self.read_bytes
+                data['write_bytes'] = self.write_bytes
+                data['read_chars'] = self.read_chars
+                data['write_chars'] = self.write_chars
+            return data
+
+
+@contextlib.contextmanager
+def account_children(usage):
+    """
+    Context manager accounting the resource usage of the child processes
+    spawned by the calling thread through exec_cmd(), exec_chroot_cmd()
+    and friends into usage. If usage is None, nothing is accounted.
+
+    @param usage: ChildUsage object
+    @type usage: ChildUsage
+    """
+    previous = getattr(_ACCOUNTING, "usage", None)
+    _ACCOUNTING.usage = usage
+    try:
+        yield usage
+    finally:
+        _ACCOUNTING.usage = previous
+
+def _read_proc_io(pid):
+    """
+    Return the I/O counters of the given process, read from
+    /proc/<pid>/io, or None if not available.
+    """
+    counters = {}
+    try:
+        with open("/proc/%d/io" % (pid,), "r") as io_f:
+            for line in io_f.readlines():
+                key, value = line.split(":", 1)
+                counters[key.strip()] = int(value)
+    except (IOError, OSError, ValueError):
+        return None
+    return counters
+
+def _proc_state(pid):
+    """
+    Return the state letter of the given process ("Z" for zombies), read
+    from /proc/<pid>/stat, or None if not available.
+    """
+    try:
+        with open("/proc/%d/stat" % (pid,), "r") as stat_f:
+            data = stat_f.read()
+    except (IOError, OSError):
+        return None
+    # the command name, in parentheses, may contain anything
+    return data[data.rfind(")") + 2:][:1] or None
+
+def _retry_on_eintr(func, *args):
+    while True:
         try:
-            evaluated = os.read(read, 1024)
+            return func(*args)
         except OSError as err:
-            # errno 11 is due to O_NONBLOCK
-            if err.errno == errno.EAGAIN:
-                raise AttributeError(
-                    "error while parsing argument: '%s'" %(
-                        argument,))
-            raise
-        return evaluated
+            if err.errno != errno.EINTR:
+                raise
+
+def _wait_accounted(proc, usage):
+    """
+    Wait for the termination of the given subprocess.Popen object,
+    account its resource usage into usage and return its exit status.
+    """
+    if hasattr(os, "waitid"):
+        # leave the child as a zombie, so that its I/O counters can
+        # still be read
+        _retry_on_eintr(os.waitid, os.P_PID, proc.pid,
+            os.WEXITED | os.WNOWAIT)
+    else:
+        # no waitid() (Python 2): poll until the child is a zombie
+        delay = 0.001
+        while _proc_state(proc.pid) not in (None, "Z"):
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+    io_counters = _read_proc_io(proc.pid)
+    _pid, status, rusage = _retry_on_eintr(os.wait4, proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    usage.add(rusage, io_counters)
+    return proc.returncode
+
+def _spawn_and_wait(args, **kwargs):
+    """
+    subprocess.call() replacement that keeps track of the running child
+    processes, see kill_children(), and accounts their resource usage,
+    see account_children().
+    """
+    usage = getattr(_ACCOUNTING, "usage", None)
+    proc = subprocess.Popen(args, **kwargs)
+    with _CHILDREN_LOCK:
+        _CHILDREN[proc] = threading.current_thread().ident
+    try:
+        if usage is not None:
+            return _wait_accounted(proc, usage)
+        return proc.wait()
+    except:
+        if proc.returncode is None:
+            proc.kill()
+            proc.wait()
+        raise
     finally:
-        if read is not None:
-            try:
-                os.close(read)
-            except OSError:
-                pass
-        if write is not None:
-            try:
-                os.close(write)
-            except OSError:
-                pass
+        with _CHILDREN_LOCK:
+            _CHILDREN.pop(proc, None)
+
+def get_children(thread_ident = None):
+    """
+    Return the list of pids of the running child processes spawned by
+    exec_cmd(), exec_chroot_cmd() and friends. If thread_ident is given,
+    only those spawned by the given thread are returned.
+    """
+    with _CHILDREN_LOCK:
+        return [x.pid for x, y in _CHILDREN.items() \
+                    if thread_ident is None or y == thread_ident]
+
+def kill_children(thread_ident = None, sig = signal.SIGTERM):
+    """
+    Send sig to the running child processes spawned by exec_cmd(),
+    exec_chroot_cmd() and friends. If thread_ident is given, only those
+    spawned by the given thread are signaled. Return the list of
+    signaled pids.
+    """
+    killed = []
+    for pid in get_children(thread_ident = thread_ident):
+        try:
+            os.kill(pid, sig)
+            killed.append(pid)
+        except OSError:
+            continue
+    return killed
 
 def exec_cmd(args, env = None):
-    return subprocess.call(args, env = env)
+    return _spawn_and_wait(args, env = env)
 
 def exec_cmd_get_status_output(args):
     """Return (status, output) of executing cmd in a shell."""
@@ -151,7 +636,7 @@ def exec_chroot_cmd(args, chroot, pre_chroot = None, env = None):
         env = os.environ.copy()
     exec_args = pre_chroot + [
         "chroot", chroot] + args
-    return subprocess.call(exec_args, env=env)
+    return _spawn_and_wait(exec_args, env=env)
 
 def kill_chroot_pids(chroot, sig = signal.SIGTERM, sleep = False):
     """
@@ -186,16 +671,9 @@ def kill_chroot_pids(chroot, sig = signal.SIGTERM, sleep = False):
 
 def empty_dir(dest_dir):
     """
-    Remove the content of a directory in a safe way.
+    Remove the content of a directory in a safe way, see remove_tree().
     """
-    for el in os.listdir(dest_dir):
-        el = os.path.join(dest_dir, el)
-        if os.path.isfile(el) or os.path.islink(el):
-            os.remove(el)
-        elif os.path.isdir(el):
-            shutil.rmtree(el, True)
-            if os.path.isdir(el):
-                os.rmdir(el)
+    remove_tree(dest_dir, contents_only = True)
 
 def mkdtemp(suffix=''):
     """
@@ -207,12 +685,32 @@ def mkdtemp(suffix=''):
     return tempfile.mkdtemp(prefix = "molecule", dir = tmp_dir,
         suffix = suffix)
 
-# using subprocess.call to not care about wildcards
-def remove_path(path):
+def remove_path(path, defer = False):
     """
-    Remove path, calling "rm -rf path".
+    Remove path, like "rm -rf path" does, see remove_tree(). If path
+    does not exist as-is, shell wildcards in it are expanded.
+
+    @keyword defer: remove path in background, see Trash
+    @type defer: bool
+    @return: exit status, 0 on success
+    @rtype: int
     """
-    return subprocess.call('rm -rf %s' % (path,), shell = True)
+    rc = 0
+    if os.path.lexists(path):
+        # literal names can contain "[", "*" or "?" too
+        matches = [path]
+    else:
+        matches = glob.glob(path)
+    for match in matches:
+        try:
+            if defer:
+                get_trash().trash(match)
+            else:
+                remove_tree(match)
+        except (IOError, OSError) as err:
+            sys.stderr.write("remove_path: %s\n" % (err,))
+            rc = 1
+    return rc
 
 def remove_path_sandbox(path, sandbox_env, stdout = None, stderr = None):
     """
@@ -244,38 +742,1422 @@ def get_random_str(str_len):
     """
     return os.urandom(str_len)
 
+# files at least this big are hashed through mmap()
+_MMAP_THRESHOLD = 67108864
+_HASH_BUFFER_SIZE = 4194304
+
+def _new_hasher(algorithm):
+    constructor = getattr(hashlib, algorithm, None)
+    if constructor is None:
+        return hashlib.new(algorithm)
+    return constructor()
+
+def feed_hashers(path, hashers, use_mmap = None,
+    buffer_size = _HASH_BUFFER_SIZE):
+    """
+    Feed the content of the given file into all the given hashlib
+    objects, reading it once, in large blocks (or through mmap()).
+
+    @param path: file path
+    @type path: string
+    @param hashers: list of hashlib objects
+    @type hashers: list
+    @keyword use_mmap: map the file in memory instead of reading it,
+        automatically chosen by file size if None
+    @type use_mmap: bool
+    @keyword buffer_size: read block size
+    @type buffer_size: int
+    @return: number of hashed bytes
+    @rtype: int
+    """
+    with open(path, "rb", 0) as path_f:
+        fd = path_f.fileno()
+        size = os.fstat(fd).st_size
+        fadvise = getattr(os, "posix_fadvise", None)
+        if fadvise is not None:
+            try:
+                fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        if use_mmap is None:
+            use_mmap = size >= _MMAP_THRESHOLD
+        if use_mmap and size:
+            import mmap
+            data = mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
+            try:
+                try:
+                    view = memoryview(data)
+                except TypeError:
+                    # Python 2 mmap objects do not export their buffer,
+                    # read the file instead
+                    view = None
+                if view is not None:
+                    try:
+                        # hashlib releases the GIL while hashing each block
+                        for offset in range(0, len(data), buffer_size):
+                            block = view[offset:offset + buffer_size]
+                            for hasher in hashers:
+                                hasher.update(block)
+                            block.release()
+                        return len(data)
+                    finally:
+                        view.release()
+            finally:
+                data.close()
+
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        hashed = 0
+        while True:
+            count = path_f.readinto(buf)
+            if not count:
+                break
+            for hasher in hashers:
+                hasher.update(view[:count])
+            hashed += count
+        return hashed
+
+def file_digests(path, algorithms = ("md5",), use_mmap = None):
+    """
+    Compute several digests of the given file, in one pass.
+
+    @param path: file path
+    @type path: string
+    @keyword algorithms: hashlib algorithm names ("md5", "sha1",
+        "sha256", "sha512", ...)
+    @type algorithms: iterable
+    @keyword use_mmap: see feed_hashers()
+    @type use_mmap: bool
+    @return: dict composed by algorithm name as key and hex digest as
+        value
+    @rtype: dict
+    """
+    hashers = [(x, _new_hasher(x)) for x in algorithms]
+    feed_hashers(path, [x[1] for x in hashers], use_mmap = use_mmap)
+    return dict((name, hasher.hexdigest()) for name, hasher in hashers)
+
+def hash_files(paths, algorithms = ("md5",), workers = None):
+    """
+    Compute the digests of several files, hashing them in parallel
+    threads, see file_digests().
+
+    @param paths: file paths
+    @type paths: iterable
+    @keyword algorithms: hashlib algorithm names
+    @type algorithms: iterable
+    @keyword workers: number of hashing threads
+    @type workers: int
+    @return: dict composed by file path as key and file_digests() result
+        as value
+    @rtype: dict
+    @raise IOError: if a file cannot be read
+    """
+    algorithms = tuple(algorithms)
+    paths = list(paths)
+    if workers is None:
+        workers = _default_workers()
+    workers = max(1, min(workers, len(paths)))
+    results = {}
+    lock = threading.Lock()
+
+    def _hash(path):
+        digests = file_digests(path, algorithms = algorithms)
+        with lock:
+            results[path] = digests
+
+    if workers == 1:
+        for path in paths:
+            _hash(path)
+        return results
+
+    pool = _WorkerPool(_hash, workers)
+    try:
+        for path in paths:
+            pool.submit(path)
+    finally:
+        pool.join()
+    return results
+
+def write_digest_files(paths, algorithms = ("md5",), workers = None):
+    """
+    Write "<path>.<algorithm>" digest files, in the format used by
+    md5sum, sha256sum, etc ("<hex digest>  <file name>"), for every
+    given file and algorithm. Files are hashed in parallel, see
+    hash_files().
+
+    @param paths: file paths
+    @type paths: iterable
+    @keyword algorithms: hashlib algorithm names
+    @type algorithms: iterable
+    @keyword workers: number of hashing threads
+    @type workers: int
+    @return: list of the written digest file paths
+    @rtype: list
+    @raise IOError: if a file cannot be read or written
+    """
+    paths = list(paths)
+    algorithms = tuple(algorithms)
+    results = hash_files(paths, algorithms = algorithms, workers = workers)
+    written = []
+    for path in paths:
+        for algorithm in algorithms:
+            digest_path = "%s.%s" % (path, algorithm,)
+            tmp_path = "%s.tmp" % (digest_path,)
+            with open(tmp_path, "w") as digest_f:
+                digest_f.write("%s  %s\n" % (results[path][algorithm],
+                    os.path.basename(path),))
+            os.rename(tmp_path, digest_path)
+            written.append(digest_path)
+    return written
+
 def md5sum(filepath):
     """
     Calcuate md5 hash of given file path.
     """
-    import hashlib
-    m = hashlib.md5()
-    readfile = open(filepath, "rb")
-    block = readfile.read(1024)
-    while block:
-        m.update(convert_to_rawstring(block))
-        block = readfile.read(1024)
-    readfile.close()
-    return m.hexdigest()
+    return file_digests(filepath, algorithms = ("md5",))['md5']
+
+def _default_workers():
+    try:
+        import multiprocessing
+        cpus = multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        cpus = 1
+    return min(32, cpus + 4)
+
+
+class _WorkerPool(object):
+
+    """
+    Minimal thread pool, executing func(*args) for every submitted
+    argument tuple. The first exception raised by func stops the
+    processing of the queued items and is re-raised by submit() or
+    join(). With an unbounded queue (queue_size = 0), func can submit
+    further items itself, join() waits for them as well.
+    """
+
+    _STOP = object()
+
+    def __init__(self, func, workers, queue_size = None):
+        self._func = func
+        if queue_size is None:
+            queue_size = workers * 4
+        self._queue = queue.Queue(queue_size)
+        self._error = None
+        self._threads = []
+        for _index in range(workers):
+            thread = threading.Thread(target = self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            args = self._queue.get()
+            try:
+                if args is _WorkerPool._STOP:
+                    return
+                if self._error is not None:
+                    continue
+                try:
+                    self._func(*args)
+                except Exception as err:
+                    if self._error is None:
+                        self._error = err
+            finally:
+                self._queue.task_done()
+
+    def submit(self, *args):
+        """
+        Queue func(*args), blocking if too many items are pending.
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put(args)
+
+    def join(self):
+        """
+        Wait for the queued items to be processed and stop the workers.
+        """
+        self._queue.join()
+        for _thread in self._threads:
+            self._queue.put(_WorkerPool._STOP)
+        for thread in self._threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+class CopyStats(object):
+
+    """
+    Counters of a copy_tree() or sync_tree() execution. This class is
+    thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.files = 0
+        self.directories = 0
+        self.symlinks = 0
+        self.special = 0
+        self.hardlinks = 0
+        self.reflinks = 0
+        self.bytes = 0
+        # sync_tree() only
+        self.unchanged = 0
+        self.deleted = 0
+        self.elapsed = 0.0
+
+    def add(self, **counters):
+        """
+        Increment the given counters.
+        """
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def throughput(self):
+        """
+        Return the copy throughput, in bytes per second.
+        """
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.bytes / self.elapsed
+
+    def as_dict(self):
+        """
+        Return the counters as dict, including "throughput".
+        """
+        with self._lock:
+            data = dict((x, getattr(self, x)) for x in (
+                "files", "directories", "symlinks", "special", "hardlinks",
+                "reflinks", "bytes", "unchanged", "deleted", "elapsed"))
+        data['throughput'] = self.throughput()
+        return data
+
+    def __str__(self):
+        summary = "%d files, %d directories, %.1f MiB in %.2fs " \
+            "(%.1f MiB/s)" % (self.files, self.directories,
+                self.bytes / 1048576.0, self.elapsed,
+                self.throughput() / 1048576.0,)
+        if self.unchanged or self.deleted:
+            summary += ", %d unchanged, %d deleted" % (
+                self.unchanged, self.deleted,)
+        return summary
+
+
+# linux/fs.h, _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+_COPY_BUFFER_SIZE = 1048576
+# errors meaning "this kind of copy is not possible here, use another one"
+_COPY_FALLBACK_ERRNOS = frozenset([errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+    errno.ENOTTY, errno.EOPNOTSUPP, errno.EPERM, errno.EBADF])
+
+def _scan_dir(path):
+    """
+    Return a list of (name, lstat result) of the entries of the given
+    directory.
+    """
+    scandir = getattr(os, "scandir", None)
+    if scandir is None:
+        return [(x, os.lstat(os.path.join(path, x))) \
+                    for x in os.listdir(path)]
+    iterator = scandir(path)
+    try:
+        return [(x.name, x.stat(follow_symlinks = False)) for x in iterator]
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
 
-def copy_dir(src_dir, dest_dir):
+def _copy_range(src_fd, dest_fd, count):
     """
-    Copy a directory src (src_dir) to dst (dest_dir) using cp -Rap.
+    Copy count bytes from the current src_fd offset to the current dest_fd
+    offset, using copy_file_range() if possible. Return the number of
+    copied bytes (less than count if the source file got truncated).
     """
-    args = ["cp", "-Rap", src_dir, dest_dir]
-    return exec_cmd(args)
+    remaining = count
+    copy_file_range = getattr(os, "copy_file_range", None)
+    while copy_file_range is not None and remaining > 0:
+        try:
+            copied = copy_file_range(src_fd, dest_fd,
+                min(remaining, 1073741824))
+        except OSError as err:
+            if err.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+            break
+        if not copied:
+            return count - remaining
+        remaining -= copied
+
+    while remaining > 0:
+        data = os.read(src_fd, min(remaining, _COPY_BUFFER_SIZE))
+        if not data:
+            break
+        remaining -= len(data)
+        view = memoryview(data)
+        while view:
+            written = os.write(dest_fd, view)
+            view = view[written:]
+    return count - remaining
 
-def copy_dir_existing_dest(src_dir, dest_dir):
+def _copy_data(src_fd, dest_fd, st):
     """
-    Copy a directory src (src_dir) to dst (dest_dir) using cp -Rap.
+    Copy the content of a regular file, preserving holes of sparse files.
+    Return the number of copied bytes.
+    """
+    size = st.st_size
+    seek_data = getattr(os, "SEEK_DATA", None)
+    sparse = getattr(st, "st_blocks", size) * 512 < size
+    if not sparse or seek_data is None:
+        return _copy_range(src_fd, dest_fd, size)
+
+    copied, offset = 0, 0
+    while offset < size:
+        try:
+            data = os.lseek(src_fd, offset, seek_data)
+        except OSError as err:
+            if err.errno != errno.ENXIO:
+                raise
+            break # only a hole left
+        hole = os.lseek(src_fd, data, os.SEEK_HOLE)
+        os.lseek(src_fd, data, os.SEEK_SET)
+        os.lseek(dest_fd, data, os.SEEK_SET)
+        copied += _copy_range(src_fd, dest_fd, min(hole, size) - data)
+        offset = hole
+    os.ftruncate(dest_fd, size)
+    return copied
+
+def _copy_xattrs(src_path, dest_path):
+    listxattr = getattr(os, "listxattr", None)
+    if listxattr is None:
+        return
+    try:
+        names = listxattr(src_path, follow_symlinks = False)
+    except OSError as err:
+        if err.errno in (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM):
+            return
+        raise
+    for name in names:
+        try:
+            os.setxattr(dest_path, name,
+                os.getxattr(src_path, name, follow_symlinks = False),
+                follow_symlinks = False)
+        except OSError as err:
+            # like cp -a, do not fail because of unsupported or
+            # privileged attributes
+            if err.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP,
+                                 errno.EPERM, errno.EACCES, errno.ENODATA):
+                raise
+
+def _copy_metadata(src_path, dest_path, st):
+    """
+    Copy ownership, extended attributes, mode and timestamps of src_path
+    (whose lstat result is st) to dest_path.
+    """
+    is_link = stat.S_ISLNK(st.st_mode)
+    try:
+        os.lchown(dest_path, st.st_uid, st.st_gid)
+    except OSError as err:
+        # unprivileged copies get our ownership
+        if err.errno not in (errno.EPERM, errno.EINVAL):
+            raise
+    _copy_xattrs(src_path, dest_path)
+    if not is_link:
+        os.chmod(dest_path, stat.S_IMODE(st.st_mode))
+    if hasattr(st, "st_mtime_ns"):
+        if is_link and os.utime not in getattr(
+                os, "supports_follow_symlinks", ()):
+            return
+        os.utime(dest_path, ns = (st.st_atime_ns, st.st_mtime_ns),
+            follow_symlinks = False)
+    elif not is_link:
+        os.utime(dest_path, (st.st_atime, st.st_mtime))
+
+
+class _TreeCopier(object):
+
+    """
+    copy_tree() and sync_tree() implementation.
+    """
+
+    def __init__(self, mode, stats, checksum = False):
+        self._mode = mode
+        self._stats = stats
+        self._checksum = checksum
+        # (src device, dest device) pairs not supporting reflinks
+        self._no_reflink = set()
+        self._pool = None
+        # (src, dest, lstat) of the copied directories, in walk order
+        self._directories = []
+        # (dest, first dest) hard links to create once files are copied
+        self._links = []
+        # (device, inode) -> first dest path of hard linked files
+        self._inodes = {}
+
+    @staticmethod
+    def _run(func, *args):
+        func(*args)
+
+    def _reflink(self, src_fd, dest_fd, st, dest_dev):
+        devices = (st.st_dev, dest_dev)
+        if devices in self._no_reflink:
+            if self._mode == "reflink":
+                raise OSError(errno.EOPNOTSUPP,
+                    "reflinks not supported")
+            return False
+        try:
+            fcntl.ioctl(dest_fd, _FICLONE, src_fd)
+        except (IOError, OSError) as err:
+            if err.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+            if self._mode == "reflink":
+                raise OSError(err.errno, "cannot reflink: %s" % (err,))
+            self._no_reflink.add(devices)
+            return False
+        return True
+
+    def copy_file(self, src_path, dest_path, st, dest_dev):
+        """
+        Copy a regular file (dest_path must not exist).
+        """
+        if self._mode == "hardlink":
+            try:
+                os.link(src_path, dest_path)
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.EPERM,
+                                     errno.EMLINK, errno.EACCES):
+                    raise
+            else:
+                self._stats.add(files = 1, hardlinks = 1)
+                return
+
+        src_fd = os.open(src_path, os.O_RDONLY)
+        try:
+            dest_fd = os.open(dest_path,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                if self._mode != "copy" and st.st_size and \
+                        self._reflink(src_fd, dest_fd, st, dest_dev):
+                    self._stats.add(files = 1, reflinks = 1,
+                        bytes = st.st_size)
+                else:
+                    _copy_data(src_fd, dest_fd, st)
+                    self._stats.add(files = 1, bytes = st.st_size)
+            finally:
+                os.close(dest_fd)
+        finally:
+            os.close(src_fd)
+        _copy_metadata(src_path, dest_path, st)
+
+    def sync_file(self, src_path, dest_path, st, dest_st, dest_dev):
+        """
+        Bring the existing regular file dest_path up-to-date with
+        src_path, copying it only if its content changed.
+        """
+        if st.st_size == dest_st.st_size:
+            if self._checksum:
+                unchanged = file_digests(src_path, ("sha1",)) == \
+                    file_digests(dest_path, ("sha1",))
+            else:
+                unchanged = int(st.st_mtime) == int(dest_st.st_mtime)
+            if unchanged:
+                if (st.st_mode, st.st_uid, st.st_gid, int(st.st_mtime)) != (
+                        dest_st.st_mode, dest_st.st_uid, dest_st.st_gid,
+                        int(dest_st.st_mtime)):
+                    _copy_metadata(src_path, dest_path, st)
+                self._stats.add(unchanged = 1)
+                return
+        os.remove(dest_path)
+        self.copy_file(src_path, dest_path, st, dest_dev)
+
+    def _prepare_dest(self, dest_path, st, fresh):
+        """
+        Make room for dest_path, return True if it is an already existing
+        directory to merge into.
+        """
+        if fresh:
+            return False
+        try:
+            dest_st = os.lstat(dest_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+        if stat.S_ISDIR(dest_st.st_mode):
+            if stat.S_ISDIR(st.st_mode):
+                return True
+            raise OSError(errno.EISDIR,
+                "cannot overwrite directory %s" % (dest_path,))
+        if stat.S_ISDIR(st.st_mode):
+            raise OSError(errno.ENOTDIR,
+                "cannot overwrite non-directory %s" % (dest_path,))
+        os.remove(dest_path)
+        return False
+
+    def _remove(self, dest_path, dest_st):
+        remove_tree(dest_path)
+        self._stats.add(deleted = 1)
+
+    def _hardlinked(self, dest_path, st):
+        """
+        Return True if dest_path is another name of an already seen hard
+        linked file, to be linked at the end.
+        """
+        if st.st_nlink < 2 or self._mode == "hardlink":
+            return False
+        inode = (st.st_dev, st.st_ino)
+        first_dest = self._inodes.get(inode)
+        if first_dest is None:
+            self._inodes[inode] = dest_path
+            return False
+        self._links.append((dest_path, first_dest))
+        return True
+
+    def _copy_entry(self, src_path, dest_path, st, dest_dev):
+        """
+        Copy a non-directory entry, dest_path must not exist.
+        """
+        mode = st.st_mode
+        if stat.S_ISREG(mode):
+            if not self._hardlinked(dest_path, st):
+                self._pool.submit(self.copy_file, src_path, dest_path, st,
+                    dest_dev)
+        elif stat.S_ISLNK(mode):
+            os.symlink(os.readlink(src_path), dest_path)
+            _copy_metadata(src_path, dest_path, st)
+            self._stats.add(symlinks = 1)
+        else:
+            # device nodes (root only), fifos and sockets
+            os.mknod(dest_path, mode, st.st_rdev)
+            _copy_metadata(src_path, dest_path, st)
+            self._stats.add(special = 1)
+
+    def _sync_entry(self, src_path, dest_path, st, dest_st, dest_dev):
+        """
+        Bring the existing non-directory dest_path (of the same file type)
+        up-to-date with src_path.
+        """
+        mode = st.st_mode
+        if stat.S_ISREG(mode):
+            if not self._hardlinked(dest_path, st):
+                self._pool.submit(self.sync_file, src_path, dest_path, st,
+                    dest_st, dest_dev)
+            return
+        if stat.S_ISLNK(mode):
+            unchanged = os.readlink(src_path) == os.readlink(dest_path)
+        else:
+            unchanged = st.st_rdev == dest_st.st_rdev
+        if unchanged:
+            if (st.st_mode, st.st_uid, st.st_gid) != (
+                    dest_st.st_mode, dest_st.st_uid, dest_st.st_gid):
+                _copy_metadata(src_path, dest_path, st)
+            self._stats.add(unchanged = 1)
+            return
+        os.remove(dest_path)
+        self._copy_entry(src_path, dest_path, st, dest_dev)
+
+    def _copy_walk(self, src, dest, src_st, fresh):
+        stack = [(src, dest, src_st, fresh)]
+        while stack:
+            src_path, dest_path, st, fresh = stack.pop()
+            merge = self._prepare_dest(dest_path, st, fresh)
+
+            if not stat.S_ISDIR(st.st_mode):
+                dest_dev = os.lstat(os.path.dirname(
+                    os.path.abspath(dest_path))).st_dev
+                self._copy_entry(src_path, dest_path, st, dest_dev)
+                continue
+
+            if not merge:
+                os.mkdir(dest_path, 0o700)
+            self._directories.append((src_path, dest_path, st))
+            self._stats.add(directories = 1)
+            dest_dev = os.lstat(dest_path).st_dev
+            for name, child_st in _scan_dir(src_path):
+                child_src = os.path.join(src_path, name)
+                child_dest = os.path.join(dest_path, name)
+                if stat.S_ISDIR(child_st.st_mode):
+                    stack.append((child_src, child_dest, child_st,
+                        not merge))
+                    continue
+                if merge:
+                    self._prepare_dest(child_dest, child_st, False)
+                self._copy_entry(child_src, child_dest, child_st, dest_dev)
+
+    def _sync_walk(self, src, dest, src_st, delete):
+        stack = [(src, dest, src_st)]
+        while stack:
+            src_path, dest_path, st = stack.pop()
+            self._directories.append((src_path, dest_path, st))
+            self._stats.add(directories = 1)
+            dest_dev = os.lstat(dest_path).st_dev
+            dest_entries = dict(_scan_dir(dest_path))
+
+            for name, child_st in _scan_dir(src_path):
+                child_src = os.path.join(src_path, name)
+                child_dest = os.path.join(dest_path, name)
+                dest_st = dest_entries.pop(name, None)
+                if dest_st is not None and stat.S_IFMT(dest_st.st_mode) != \
+                        stat.S_IFMT(child_st.st_mode):
+                    self._remove(child_dest, dest_st)
+                    dest_st = None
+
+                if dest_st is None:
+                    self._copy_walk(child_src, child_dest, child_st, True)
+                elif stat.S_ISDIR(child_st.st_mode):
+                    stack.append((child_src, child_dest, child_st))
+                else:
+                    self._sync_entry(child_src, child_dest, child_st,
+                        dest_st, dest_dev)
+
+            if delete:
+                for name, dest_st in dest_entries.items():
+                    self._remove(os.path.join(dest_path, name), dest_st)
+
+    def copy(self, src, dest, workers, contents_only = False, sync = False,
+        delete = True):
+        src_st = os.lstat(src)
+        if (contents_only or sync) and not stat.S_ISDIR(src_st.st_mode):
+            raise OSError(errno.ENOTDIR, "%s is not a directory" % (src,))
+        if contents_only and not os.path.isdir(dest):
+            raise OSError(errno.ENOTDIR, "%s is not a directory" % (dest,))
+
+        self._pool = _WorkerPool(self._run, workers)
+        try:
+            if sync and os.path.isdir(dest) and not os.path.islink(dest):
+                self._sync_walk(src, dest, src_st, delete)
+            else:
+                self._copy_walk(src, dest, src_st, False)
+        finally:
+            self._pool.join()
+
+        # hard links inside the tree, once their first copy exists
+        for dest_path, first_dest in self._links:
+            if sync and os.path.lexists(dest_path):
+                if os.path.samefile(dest_path, first_dest):
+                    self._stats.add(unchanged = 1)
+                    continue
+                os.remove(dest_path)
+            os.link(first_dest, dest_path)
+            self._stats.add(files = 1, hardlinks = 1)
+
+        directories = self._directories
+        if contents_only:
+            # leave dest attributes alone
+            directories = directories[1:]
+        # children first, so that timestamps and modes are not altered
+        for src_path, dest_path, st in reversed(directories):
+            _copy_metadata(src_path, dest_path, st)
+
+def copy_tree(src, dest, mode = "auto", workers = None,
+    contents_only = False, stats = None):
+    """
+    Copy src (directory tree or single file) to dest, like "cp -a src
+    dest" does when dest does not exist. If dest is an existing directory,
+    src content is merged into it, replacing existing non-directory
+    entries. Ownership (if permitted), modes, timestamps, extended
+    attributes and hard links inside the tree are preserved. Regular
+    files are copied by a pool of threads.
+
+    @param src: source path
+    @type src: string
+    @param dest: destination path
+    @type dest: string
+    @keyword mode: "auto" (reflink files if the filesystem supports it,
+        copy them otherwise), "reflink" (reflink files or fail), "copy"
+        (always copy data, using copy_file_range() when possible) or
+        "hardlink" (hard link files to src, copy them if not possible)
+    @type mode: string
+    @keyword workers: number of copy threads
+    @type workers: int
+    @keyword contents_only: copy the content of the src directory into
+        the existing dest directory, leaving dest attributes untouched
+    @type contents_only: bool
+    @keyword stats: counters to update, for progress reporting
+    @type stats: CopyStats
+    @return: copy statistics
+    @rtype: CopyStats
+    @raise OSError: in case of errors, dest is left incomplete
+    """
+    if mode not in ("auto", "reflink", "copy", "hardlink"):
+        raise ValueError("invalid copy mode: %s" % (mode,))
+    if workers is None:
+        workers = _default_workers()
+    if stats is None:
+        stats = CopyStats()
+    start = time.time()
+    try:
+        _TreeCopier(mode, stats).copy(src, dest, workers,
+            contents_only = contents_only)
+    finally:
+        stats.elapsed = time.time() - start
+    return stats
+
+def sync_tree(src, dest, checksum = False, delete = True, mode = "auto",
+    workers = None, contents_only = False, stats = None):
+    """
+    Incrementally synchronize the dest directory with the src directory,
+    like "rsync -aH [--delete] src/ dest/" does: only new and changed
+    entries are copied (see copy_tree()), the metadata of unchanged ones
+    is updated if needed. Regular files are considered unchanged if size
+    and modification time (in seconds) match or, if checksum is True,
+    if size and content match. If dest does not exist, this is
+    equivalent to copy_tree().
+
+    @param src: source directory path
+    @type src: string
+    @param dest: destination directory path
+    @type dest: string
+    @keyword checksum: compare the content of regular files having the
+        same size instead of their modification time
+    @type checksum: bool
+    @keyword delete: remove dest entries not existing in src
+    @type delete: bool
+    @keyword mode: how files are copied, see copy_tree()
+    @type mode: string
+    @keyword workers: number of copy threads
+    @type workers: int
+    @keyword contents_only: leave dest attributes untouched
+    @type contents_only: bool
+    @keyword stats: counters to update, for progress reporting
+    @type stats: CopyStats
+    @return: synchronization statistics ("bytes" being the amount of
+        transferred data)
+    @rtype: CopyStats
+    @raise OSError: in case of errors, dest is left incomplete
+    """
+    if mode not in ("auto", "reflink", "copy", "hardlink"):
+        raise ValueError("invalid copy mode: %s" % (mode,))
+    if workers is None:
+        workers = _default_workers()
+    if stats is None:
+        stats = CopyStats()
+    start = time.time()
+    try:
+        _TreeCopier(mode, stats, checksum = checksum).copy(src, dest,
+            workers, contents_only = contents_only, sync = True,
+            delete = delete)
+    finally:
+        stats.elapsed = time.time() - start
+    return stats
+
+class RemoveStats(object):
+
+    """
+    Progress counters of a remove_tree() execution, they can be read
+    by other threads while the removal is in progress. This class is
+    thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.files = 0
+        self.directories = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def add(self, **counters):
+        """
+        Increment the given counters.
+        """
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        """
+        Return the counters as dict.
+        """
+        with self._lock:
+            return dict((x, getattr(self, x)) for x in (
+                "files", "directories", "errors", "elapsed"))
+
+    def __str__(self):
+        return "%d files, %d directories removed in %.2fs, %d errors" % (
+            self.files, self.directories, self.elapsed, self.errors,)
+
+
+def _mount_points(root):
+    """
+    Return the set of the mount points below the given (real) path.
+    """
+    def _unescape(match):
+        return chr(int(match.group(1), 8))
+
+    points = set()
+    prefix = root.rstrip("/") + "/"
+    try:
+        with open("/proc/self/mountinfo", "r") as mount_f:
+            for line in mount_f:
+                fields = line.split()
+                if len(fields) < 5:
+                    continue
+                point = re.sub(r"\\([0-7]{3})", _unescape, fields[4])
+                if point.startswith(prefix):
+                    points.add(point)
+    except (IOError, OSError):
+        pass
+    return points
+
+
+class _RemoveNode(object):
+
+    def __init__(self, path, parent, keep = False):
+        self.path = path
+        self.parent = parent
+        # do not remove the directory itself, only its content
+        self.keep = keep
+        # own scan plus the subdirectories being removed
+        self.pending = 1
+
+
+class _TreeRemover(object):
+
+    """
+    remove_tree() implementation. Every directory is scanned by a pool
+    thread, entries are unlinked relative to the directory file
+    descriptor and subdirectories are queued to the pool; a directory is
+    removed once its scan and all its subdirectories are done.
+    Without fd based scandir() and unlinkat() (Python 2), the tree is
+    walked sequentially instead, see _walk().
+    """
+
+    def __init__(self, stats, one_file_system):
+        self._stats = stats
+        self._one_file_system = one_file_system
+        self._lock = threading.Lock()
+        self._errors = []
+        self._pool = None
+        self._device = None
+        self._mounts = frozenset()
+
+    def _error(self, path, err):
+        self._stats.add(errors = 1)
+        with self._lock:
+            self._errors.append((path, err))
+
+    def errors(self):
+        """
+        Return the list of (path, exception) errors.
+        """
+        with self._lock:
+            return list(self._errors)
+
+    def _crosses_mount(self, path, st):
+        return st.st_dev != self._device or path in self._mounts
+
+    def _scan(self, node):
+        try:
+            fd = os.open(node.path,
+                os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+        except OSError as err:
+            self._error(node.path, err)
+            self._done(node)
+            return
+
+        try:
+            mode = os.fstat(fd).st_mode
+            if mode & stat.S_IRWXU != stat.S_IRWXU:
+                # read-only directories, like "rm -rf" does
+                try:
+                    os.chmod(fd, stat.S_IMODE(mode) | stat.S_IRWXU)
+                except OSError:
+                    pass
+            iterator = os.scandir(fd)
+            try:
+                for entry in iterator:
+                    path = os.path.join(node.path, entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks = False):
+                            if self._one_file_system and self._crosses_mount(
+                                    path, entry.stat(follow_symlinks = False)):
+                                raise OSError(errno.EBUSY,
+                                    "refusing to cross mount point")
+                            with self._lock:
+                                node.pending += 1
+                            self._pool.submit(_RemoveNode(path, node))
+                        else:
+                            os.unlink(entry.name, dir_fd = fd)
+                            self._stats.add(files = 1)
+                    except OSError as err:
+                        self._error(path, err)
+            finally:
+                iterator.close()
+        except OSError as err:
+            self._error(node.path, err)
+        finally:
+            os.close(fd)
+        self._done(node)
+
+    def _done(self, node):
+        """
+        Account one completed task of node, removing the directory (and
+        its completed parents) when nothing else is pending.
+        """
+        while node is not None:
+            with self._lock:
+                node.pending -= 1
+                if node.pending:
+                    return
+            if not node.keep:
+                try:
+                    os.rmdir(node.path)
+                    self._stats.add(directories = 1)
+                except OSError as err:
+                    self._error(node.path, err)
+            node = node.parent
+
+    def _walk(self, path, keep):
+        """
+        Sequential, path based removal, for Python versions lacking fd
+        based scandir() and unlinkat(). Directories are removed depth
+        first, after their content.
+        """
+        # (path, keep, content removed)
+        stack = [(path, keep, False)]
+        while stack:
+            path, keep, emptied = stack.pop()
+            if emptied:
+                if not keep:
+                    try:
+                        os.rmdir(path)
+                        self._stats.add(directories = 1)
+                    except OSError as err:
+                        self._error(path, err)
+                continue
+
+            stack.append((path, keep, True))
+            try:
+                mode = os.lstat(path).st_mode
+                if mode & stat.S_IRWXU != stat.S_IRWXU:
+                    # read-only directories, like "rm -rf" does
+                    try:
+                        os.chmod(path, stat.S_IMODE(mode) | stat.S_IRWXU)
+                    except OSError:
+                        pass
+                names = os.listdir(path)
+            except OSError as err:
+                self._error(path, err)
+                continue
+
+            for name in names:
+                entry_path = os.path.join(path, name)
+                try:
+                    st = os.lstat(entry_path)
+                    if stat.S_ISDIR(st.st_mode):
+                        if self._one_file_system and self._crosses_mount(
+                                entry_path, st):
+                            raise OSError(errno.EBUSY,
+                                "refusing to cross mount point")
+                        stack.append((entry_path, False, False))
+                    else:
+                        os.unlink(entry_path)
+                        self._stats.add(files = 1)
+                except OSError as err:
+                    self._error(entry_path, err)
+
+    def remove(self, path, contents_only, workers):
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            if contents_only:
+                raise OSError(errno.ENOTDIR, "%s is not a directory" % (
+                    path,))
+            os.remove(path)
+            self._stats.add(files = 1)
+            return
+
+        real_path = os.path.realpath(path)
+        self._device = st.st_dev
+        self._mounts = _mount_points(real_path)
+        if not _HAS_DIR_FD:
+            self._walk(real_path, contents_only)
+            return
+
+        self._pool = _WorkerPool(self._scan, workers, queue_size = 0)
+        try:
+            self._pool.submit(_RemoveNode(real_path, None,
+                keep = contents_only))
+        finally:
+            self._pool.join()
+
+# remove_tree() needs fd based scandir() and unlinkat()
+_HAS_DIR_FD = os.scandir in getattr(os, "supports_fd", ()) \
+    if hasattr(os, "scandir") else False
+_HAS_DIR_FD = _HAS_DIR_FD and os.unlink in getattr(os, "supports_dir_fd", ())
+
+def remove_tree(path, workers = None, one_file_system = True,
+    contents_only = False, stats = None):
+    """
+    Remove the given path (directory tree or any other file type, never
+    following symbolic links) without spawning any process, scanning and
+    removing directories in parallel threads. Like "rm -rf", as much as
+    possible is removed even in case of errors, read-only directories
+    are made writable.
+
+    @param path: path to remove
+    @type path: string
+    @keyword workers: number of threads
+    @type workers: int
+    @keyword one_file_system: refuse to descend into directories on
+        other filesystems (mount points, bind mounts included)
+    @type one_file_system: bool
+    @keyword contents_only: only remove the content of the path directory
+    @type contents_only: bool
+    @keyword stats: counters to update, for progress reporting
+    @type stats: RemoveStats
+    @return: removal statistics
+    @rtype: RemoveStats
+    @raise OSError: if path, or part of it, could not be removed
+    """
+    if workers is None:
+        workers = _default_workers()
+    if stats is None:
+        stats = RemoveStats()
+    remover = _TreeRemover(stats, one_file_system)
+    start = time.time()
+    try:
+        remover.remove(path, contents_only, workers)
+    finally:
+        stats.elapsed = time.time() - start
+
+    errors = remover.errors()
+    if errors:
+        err_path, err = errors[0]
+        raise OSError(getattr(err, "errno", None) or errno.EIO,
+            "cannot remove %s: %s (%d errors)" % (
+                err_path, getattr(err, "strerror", None) or err,
+                len(errors),))
+    return stats
+
+# ioprio_set() system call numbers
+_IOPRIO_SET = {
+    "x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30,
+    "riscv64": 30, "armv7l": 314, "ppc64": 273, "ppc64le": 273,
+    "s390x": 282,
+}
+
+def _set_idle_io_priority():
+    """
+    Move the calling thread to the idle I/O scheduling class, if
+    possible.
+    """
+    try:
+        import ctypes
+        import platform
+        syscall_nr = _IOPRIO_SET.get(platform.machine())
+        if syscall_nr is None:
+            return False
+        libc = ctypes.CDLL(None, use_errno = True)
+        # IOPRIO_WHO_PROCESS, 0 = calling thread, IOPRIO_CLASS_IDLE
+        return libc.syscall(syscall_nr, 1, 0, 3 << 13) == 0
+    except (ImportError, OSError, AttributeError):
+        return False
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+class Trash(object):
+
+    """
+    Deferred removal of directory trees. Paths are atomically renamed
+    into a trash directory living on the same filesystem
+    (<tmp_dir>/molecule-trash or <mount point>/.molecule-trash) and
+    removed by a background thread running at idle I/O priority.
+    Trash entries are named after the owning process, leftovers of
+    terminated processes (crashed runs, spec file worker processes) are
+    picked up by reclaim(). This class is thread-safe.
+    """
+
+    TRASH_DIR = "molecule-trash"
+    MOUNT_TRASH_DIR = ".molecule-trash"
+
+    def __init__(self, tmp_dir = None):
+        """
+        Object constructor.
+
+        @keyword tmp_dir: base directory, Configuration tmp_dir if None
+        @type tmp_dir: string
+        """
+        self._tmp_dir = tmp_dir
+        self._cond = threading.Condition()
+        self._queue = []
+        # queued or being removed
+        self._pending = set()
+        self._thread = None
+        self._pid = None
+        self.errors = 0
+
+    def _get_tmp_dir(self):
+        if self._tmp_dir is None:
+            import molecule.settings
+            return molecule.settings.Configuration()['tmp_dir']
+        return self._tmp_dir
+
+    @staticmethod
+    def _trusted(trash_dir, create = False):
+        """
+        Return the lstat() result of trash_dir if it is a directory owned
+        by us and not writable by others, None otherwise.
+        """
+        if create:
+            try:
+                os.mkdir(trash_dir, 0o700)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    return None
+        try:
+            st = os.lstat(trash_dir)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            return None
+        if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return None
+        return st
+
+    @staticmethod
+    def _mount_point(path, device):
+        path = os.path.realpath(path)
+        while path != "/":
+            parent = os.path.dirname(path)
+            if os.lstat(parent).st_dev != device:
+                break
+            path = parent
+        return path
+
+    def _trash_dirs(self):
+        """
+        Return the list of the trash directories that may exist.
+        """
+        trash_dirs = [os.path.join(self._get_tmp_dir(), Trash.TRASH_DIR)]
+        mount_points = _mount_points("/")
+        mount_points.add("/")
+        for mount_point in sorted(mount_points):
+            trash_dirs.append(os.path.join(mount_point,
+                Trash.MOUNT_TRASH_DIR))
+        return trash_dirs
+
+    def _trash_dir_for(self, path, device):
+        tmp_trash = os.path.join(self._get_tmp_dir(), Trash.TRASH_DIR)
+        try:
+            mount_trash = os.path.join(self._mount_point(
+                os.path.dirname(os.path.abspath(path)), device),
+                Trash.MOUNT_TRASH_DIR)
+        except OSError:
+            mount_trash = None
+        for trash_dir in (tmp_trash, mount_trash):
+            if trash_dir is None:
+                continue
+            try:
+                if os.lstat(os.path.dirname(trash_dir)).st_dev != device:
+                    continue
+            except OSError:
+                continue
+            st = self._trusted(trash_dir, create = True)
+            if st is not None and st.st_dev == device:
+                return trash_dir
+        return None
+
+    def _check_fork(self):
+        # a forked process does not inherit the removal thread, entries
+        # of the parent are not ours (caller holds self._cond)
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = None
+            del self._queue[:]
+            self._pending.clear()
+
+    def _enqueue(self, path):
+        with self._cond:
+            self._check_fork()
+            if path in self._pending:
+                return False
+            self._pending.add(path)
+            self._queue.append(path)
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._worker)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+            return True
+
+    def _worker(self):
+        _set_idle_io_priority()
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                path = self._queue.pop(0)
+            try:
+                remove_tree(path, workers = 2)
+            except (IOError, OSError):
+                with self._cond:
+                    self.errors += 1
+            with self._cond:
+                self._pending.discard(path)
+                self._cond.notify_all()
+
+    def trash(self, path):
+        """
+        Remove the given path in background. If it cannot be moved to a
+        trash directory, it is removed synchronously instead.
+
+        @param path: path to remove
+        @type path: string
+        @return: True if removal has been deferred
+        @rtype: bool
+        @raise OSError: if synchronous removal fails
+        """
+        st = os.lstat(path)
+        trash_dir = None
+        if not os.path.ismount(path):
+            trash_dir = self._trash_dir_for(path, st.st_dev)
+        if trash_dir is not None:
+            trash_path = os.path.join(trash_dir, "%d-%s-%s" % (
+                os.getpid(),
+                binascii.hexlify(get_random_str(4)).decode("ascii"),
+                os.path.basename(os.path.normpath(path)),))
+            try:
+                os.rename(path, trash_path)
+            except OSError:
+                trash_path = None
+            if trash_path is not None:
+                self._enqueue(trash_path)
+                return True
+        remove_tree(path)
+        return False
+
+    def reclaim(self):
+        """
+        Schedule the removal of the trash entries left behind by
+        terminated processes.
+
+        @return: number of scheduled entries
+        @rtype: int
+        """
+        count = 0
+        for trash_dir in self._trash_dirs():
+            if self._trusted(trash_dir) is None:
+                continue
+            try:
+                names = os.listdir(trash_dir)
+            except OSError:
+                continue
+            for name in names:
+                try:
+                    pid = int(name.split("-", 1)[0])
+                except ValueError:
+                    pid = None
+                if pid is not None and _pid_alive(pid):
+                    continue
+                if self._enqueue(os.path.join(trash_dir, name)):
+                    count += 1
+        return count
+
+    def pending(self):
+        """
+        Return the number of entries still to be removed by this process.
+        """
+        with self._cond:
+            self._check_fork()
+            return len(self._pending)
+
+    def wait(self, timeout = None):
+        """
+        Wait for the scheduled removals to complete.
+
+        @keyword timeout: maximum waiting time in seconds
+        @type timeout: float
+        @return: True if nothing is pending anymore
+        @rtype: bool
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            self._check_fork()
+            while self._pending:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._cond.wait(remaining)
+            return True
+
+_TRASH = None
+_TRASH_LOCK = threading.Lock()
+
+def get_trash():
+    """
+    Return the Trash shared by the current process.
+    """
+    global _TRASH
+    with _TRASH_LOCK:
+        if _TRASH is None:
+            _TRASH = Trash()
+        return _TRASH
+
+def copy_dir(src_dir, dest_dir, mode = "auto"):
+    """
+    Copy a directory src (src_dir) to dst (dest_dir), with the same
+    semantics of "cp -Rap", see copy_tree().
+
+    @return: exit status, 0 on success
+    @rtype: int
+    """
+    if os.path.isdir(dest_dir):
+        dest_dir = os.path.join(dest_dir,
+            os.path.basename(os.path.normpath(src_dir)))
+    try:
+        copy_tree(src_dir, dest_dir, mode = mode)
+    except (IOError, OSError) as err:
+        sys.stderr.write("copy_dir: cannot copy %s to %s: %s\n" % (
+            src_dir, dest_dir, err,))
+        return 1
+    return 0
+
+def copy_dir_existing_dest(src_dir, dest_dir, mode = "auto", sync = False,
+    checksum = False, stats = None):
+    """
+    Copy a directory src (src_dir) to dst (dest_dir), with the same
+    semantics of "cp -Rap src_dir/* dest_dir/", see copy_tree().
     This variant takes into consideration the fact that destination
     directory exists.
+
+    If sync is True, dest_dir is incrementally synchronized instead:
+    only changed files are copied and the ones not existing in src_dir
+    anymore are removed, see sync_tree().
+
+    @keyword sync: synchronize dest_dir with src_dir
+    @type sync: bool
+    @keyword checksum: with sync, compare file contents instead of
+        modification times
+    @type checksum: bool
+    @keyword stats: counters to update with the copied (and, with sync,
+        unchanged and deleted) entries, see CopyStats
+    @type stats: CopyStats
+    @return: exit status, 0 on success
+    @rtype: int
     """
-    source_objects = []
-    for obj in os.listdir(src_dir):
-        source_objects.append(os.path.join(src_dir, obj))
-    args = ["cp", "-Rap"] + source_objects + [dest_dir + "/"]
-    return exec_cmd(args)
+    try:
+        if sync:
+            sync_tree(src_dir, dest_dir, checksum = checksum, mode = mode,
+                contents_only = True, stats = stats)
+        else:
+            copy_tree(src_dir, dest_dir, mode = mode, contents_only = True,
+                stats = stats)
+    except (IOError, OSError) as err:
+        sys.stderr.write("copy_dir: cannot copy %s to %s: %s\n" % (
+            src_dir, dest_dir, err,))
+        return 1
+    return 0
 
 def print_traceback(f = None):
     """
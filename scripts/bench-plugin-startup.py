@@ -0,0 +1,55 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Compare the startup cost of plugin entry point discovery through
+pkg_resources and through importlib.metadata (see
+molecule.specs.factory.iter_entry_points()). Usage (from git repo root):
+
+    python scripts/bench-plugin-startup.py [<runs>]
+
+Every measurement is taken in a fresh interpreter, the interpreter
+startup time itself is reported as "baseline".
+"""
+import os
+import sys
+import time
+import subprocess
+
+_GROUP = "molecule.plugins"
+
+_SNIPPETS = [
+    ("baseline", "pass"),
+    ("pkg_resources",
+     "import pkg_resources\n"
+     "list(pkg_resources.iter_entry_points(%r))" % (_GROUP,)),
+    ("importlib.metadata",
+     "from molecule.specs.factory import iter_entry_points\n"
+     "iter_entry_points(%r)" % (_GROUP,)),
+]
+
+def _measure(code, runs):
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.getcwd()
+    timings = []
+    for _run in range(runs):
+        start = time.time()
+        rc = subprocess.call([sys.executable, "-c", code], env = env)
+        timings.append(time.time() - start)
+        if rc != 0:
+            return None
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def main(argv):
+    runs = int(argv[0]) if argv else 10
+    print("%-20s %12s" % ("method", "median (ms)"))
+    for name, code in _SNIPPETS:
+        elapsed = _measure(code, runs)
+        if elapsed is None:
+            print("%-20s %12s" % (name, "n/a"))
+        else:
+            print("%-20s %12.1f" % (name, elapsed * 1000.0))
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Measure spec file parsing time as spec files grow, to check that it
+scales linearly. Usage (from git repo root):
+
+    python scripts/bench-spec-parse.py [<lines> ...]
+
+Every generated spec file %import-s a fragment holding half of its lines
+and carries a package list parameter spanning all the other lines.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+_PLUGIN = '''
+from molecule.specs.skel import GenericSpec
+
+class BenchSpec(GenericSpec):
+
+    PLUGIN_API_VERSION = 1
+
+    @staticmethod
+    def execution_strategy():
+        return "bench"
+
+    def vital_parameters(self):
+        return ["packages"]
+
+    def parameters(self):
+        return {
+            'packages': {
+                'parser': lambda x: x.split(),
+                'verifier': lambda x: True,
+            },
+            'description': {
+                'parser': lambda x: x,
+                'verifier': lambda x: True,
+            },
+        }
+
+    def execution_steps(self):
+        return []
+'''
+
+def _write_spec(tmp_dir, lines):
+    fragment_path = os.path.join(tmp_dir, "fragment-%d" % (lines,))
+    spec_path = os.path.join(tmp_dir, "bench-%d.spec" % (lines,))
+    half = lines // 2
+    with open(fragment_path, "w") as fragment_f:
+        fragment_f.write("description: generated\n")
+        for index in range(half - 1):
+            fragment_f.write("    more description text %d # comment\n" % (
+                index,))
+    with open(spec_path, "w") as spec_f:
+        spec_f.write("execution_strategy: bench\n")
+        spec_f.write("%%import %s\n" % (os.path.basename(fragment_path),))
+        spec_f.write("packages: app-misc/package-0\n")
+        for index in range(1, lines - half - 2):
+            spec_f.write("    app-misc/package-%d\n" % (index,))
+    return spec_path
+
+def main(argv):
+    sizes = [int(x) for x in argv] or [10000, 100000, 1000000]
+    tmp_dir = tempfile.mkdtemp(prefix = "molecule-bench")
+    try:
+        with open(os.path.join(tmp_dir, "bench_plugin.py"), "w") as plugin_f:
+            plugin_f.write(_PLUGIN)
+        sys.path.insert(0, tmp_dir)
+        sys.path.insert(0, os.getcwd())
+        os.environ["MOLECULE_PLUGIN_MODULES"] = "bench_plugin"
+        from molecule.settings import SpecParser
+
+        print("%10s %10s %12s" % ("lines", "seconds", "usec/line"))
+        for lines in sizes:
+            spec_path = _write_spec(tmp_dir, lines)
+            start = time.time()
+            metadata = SpecParser(spec_path).parse()
+            elapsed = time.time() - start
+            assert len(metadata['packages']) == lines - (lines // 2) - 2
+            print("%10d %10.3f %12.2f" % (lines, elapsed,
+                elapsed * 1000000.0 / lines))
+    finally:
+        shutil.rmtree(tmp_dir, True)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import sys
+sys.path.insert(0,'.')
+sys.path.insert(0,'..')
+import time
+import asyncio
+import unittest
+
+from molecule.specs.skel import GenericExecutionStep
+from molecule.aio import AsyncRunner, async_exec_cmd
+from molecule.utils import exec_cmd
+
+
+class _Step(GenericExecutionStep):
+
+    def pre_run(self):
+        return 0
+
+    def run(self):
+        self.metadata['executed'].append(self.__class__.__name__)
+        return 0
+
+    def post_run(self):
+        return 0
+
+    def kill(self, success = True):
+        self.metadata['killed'].append((self.__class__.__name__, success))
+        return 0
+
+class _SleepingStep(_Step):
+
+    def run(self):
+        self.metadata['executed'].append(self.__class__.__name__)
+        return exec_cmd(["sleep", "30"])
+
+class _BusyStep(_Step):
+
+    def run(self):
+        # pure Python, cannot be interrupted
+        time.sleep(1.5)
+        self.metadata['executed'].append(self.__class__.__name__)
+        return 0
+
+    def kill(self, success = True):
+        self.metadata['killed'].append((self.__class__.__name__, success,
+            list(self.metadata['executed'])))
+        return 0
+
+class _AsyncStep(_Step):
+
+    async def run(self):
+        self.metadata['executed'].append(self.__class__.__name__)
+        return await async_exec_cmd(["sleep", "30"])
+
+class _Plugin(object):
+
+    def __init__(self, steps):
+        self._steps = steps
+
+    def execution_steps(self):
+        return self._steps
+
+
+class AsyncRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        sys.stdout.write("%s called\n" % (self,))
+        sys.stdout.flush()
+
+    def tearDown(self):
+        """
+        tearDown is run after each test
+        """
+        sys.stdout.write("%s ran\n" % (self,))
+        sys.stdout.flush()
+
+    def _metadata(self, steps):
+        return {
+            '__plugin__': _Plugin(steps),
+            'executed': [],
+            'killed': [],
+        }
+
+    def test_run(self):
+        metadata = self._metadata([_Step, (_Step, _Step)])
+        runner = AsyncRunner("test.spec", metadata, step_timeout = 10)
+        self.assertEqual(runner.run(), 0)
+        self.assertEqual(len(metadata['executed']), 3)
+        self.assertEqual(metadata['killed'], [('_Step', True)] * 3)
+
+    def test_step_timeout(self):
+        metadata = self._metadata([_SleepingStep, _Step])
+        runner = AsyncRunner("test.spec", metadata, step_timeout = 0.5)
+        started = time.time()
+        self.assertEqual(runner.run(), 1)
+        self.assert_(time.time() - started < 10)
+        self.assertEqual(metadata['executed'], ['_SleepingStep'])
+        self.assertEqual(metadata['killed'], [('_SleepingStep', False)])
+
+    def test_step_timeout_busy_hook(self):
+        metadata = self._metadata([_BusyStep])
+        runner = AsyncRunner("test.spec", metadata, step_timeout = 0.2)
+        self.assertEqual(runner.run(), 1)
+        # kill() is called once the timed out hook returned
+        self.assertEqual(metadata['killed'],
+            [('_BusyStep', False, ['_BusyStep'])])
+
+    def test_spec_timeout_async_step(self):
+        metadata = self._metadata([_Step, _AsyncStep])
+        runner = AsyncRunner("test.spec", metadata, timeout = 0.5)
+        started = time.time()
+        self.assertEqual(runner.run(), 1)
+        self.assert_(time.time() - started < 10)
+        self.assertEqual(metadata['killed'],
+            [('_Step', True), ('_AsyncStep', False)])
+
+    def test_async_exec_cmd(self):
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(
+                async_exec_cmd(["true"])), 0)
+            self.assertRaises(asyncio.TimeoutError, loop.run_until_complete,
+                async_exec_cmd(["sleep", "30"], timeout = 0.2))
+        finally:
+            loop.close()
+
+if __name__ == '__main__':
+    unittest.main()
+    raise SystemExit(0)
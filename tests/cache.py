@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.insert(0,'.')
+sys.path.insert(0,'..')
+import unittest
+import tempfile
+
+from molecule.cache import StepCache
+from molecule.utils import remove_path
+
+
+class _Step(object):
+    pass
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        sys.stdout.write("%s called\n" % (self,))
+        sys.stdout.flush()
+        self._tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        self._cache = StepCache(
+            cache_dir = os.path.join(self._tmp_dir, "cache"),
+            max_size = 1024)
+
+    def tearDown(self):
+        """
+        tearDown is run after each test
+        """
+        remove_path(self._tmp_dir)
+        sys.stdout.write("%s ran\n" % (self,))
+        sys.stdout.flush()
+
+    def _write(self, path, content):
+        with open(path, "w") as path_f:
+            path_f.write(content)
+
+    def _read(self, path):
+        with open(path, "r") as path_f:
+            return path_f.read()
+
+    def test_key(self):
+        input_path = os.path.join(self._tmp_dir, "input")
+        self._write(input_path, "hello")
+        key1 = self._cache.key("abc", _Step, [input_path])
+        self.assertEqual(key1, self._cache.key("abc", _Step, [input_path]))
+        self.assertNotEqual(key1, self._cache.key("abd", _Step, [input_path]))
+        self._write(input_path, "world")
+        self.assertNotEqual(key1, self._cache.key("abc", _Step, [input_path]))
+
+    def test_store_restore(self):
+        out_file = os.path.join(self._tmp_dir, "out.img")
+        out_dir = os.path.join(self._tmp_dir, "out.d")
+        os.mkdir(out_dir)
+        self._write(out_file, "image")
+        self._write(os.path.join(out_dir, "file"), "content")
+        outputs = [out_file, out_dir]
+
+        self.assert_(not self._cache.restore("k1", outputs))
+        self._cache.store("k1", outputs)
+        self.assertEqual(self._cache.stats()['entries'], 1)
+
+        remove_path(out_file)
+        remove_path(out_dir)
+        self.assert_(self._cache.restore("k1", outputs))
+        self.assertEqual(self._read(out_file), "image")
+        self.assertEqual(self._read(os.path.join(out_dir, "file")),
+            "content")
+        # outputs list must match
+        self.assert_(not self._cache.restore("k1", [out_file]))
+
+    def test_in_place_edit(self):
+        out_file = os.path.join(self._tmp_dir, "out[1].img")
+        self._write(out_file, "image")
+        self._cache.store("k1", [out_file])
+        # editing a stored output must not touch the cache entry
+        with open(out_file, "a") as out_f:
+            out_f.write(" edited")
+        self.assert_(self._cache.restore("k1", [out_file]))
+        self.assertEqual(self._read(out_file), "image")
+        # and neither must editing a restored one
+        with open(out_file, "a") as out_f:
+            out_f.write(" edited")
+        self.assert_(self._cache.restore("k1", [out_file]))
+        self.assertEqual(self._read(out_file), "image")
+        cached_path = os.path.join(self._cache.cache_dir(), "k1", "data", "0")
+        self.assertEqual(os.stat(cached_path).st_nlink, 1)
+
+    def test_prune(self):
+        out_file = os.path.join(self._tmp_dir, "out.img")
+        self._write(out_file, "x" * 600)
+        self._cache.store("k1", [out_file])
+        os.utime(os.path.join(self._cache.cache_dir(), "k1", "manifest"),
+            (1, 1))
+        self._cache.store("k2", [out_file])
+        # k1 is the least recently used one
+        stats = self._cache.stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assert_(self._cache.restore("k2", [out_file]))
+        self.assertEqual(self._cache.prune(max_size = 0), (1, 600))
+        self.assertEqual(self._cache.stats()['entries'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
+    raise SystemExit(0)
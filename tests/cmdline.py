@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import sys
+sys.path.insert(0,'.')
+sys.path.insert(0,'..')
+import os
+import unittest
+import tempfile
+
+from molecule.cmdline import parse_options, parse_specs, run_command
+from molecule.cache import StepCache
+from molecule.utils import remove_path, get_trash, Trash
+
+class CmdlineTest(unittest.TestCase):
+
+    def setUp(self):
+        sys.stdout.write("%s called\n" % (self,))
+        sys.stdout.flush()
+
+    def tearDown(self):
+        """
+        tearDown is run after each test
+        """
+        sys.stdout.write("%s ran\n" % (self,))
+        sys.stdout.flush()
+
+    def test_parse_options(self):
+        options, args = parse_options(
+            ["--nocolor", "a.spec", "--jobs", "4", "b.spec"])
+        self.assert_(options['nocolor'])
+        self.assert_(not options['fail_fast'])
+        self.assertEqual(options['jobs'], 4)
+        self.assertEqual(args, ["a.spec", "b.spec"])
+
+    def test_parse_options_equal(self):
+        options, args = parse_options(["--jobs=3", "--fail-fast"])
+        self.assertEqual(options['jobs'], 3)
+        self.assert_(options['fail_fast'])
+        self.assertEqual(args, [])
+
+    def test_parse_options_invalid(self):
+        self.assertRaises(ValueError, parse_options, ["--jobs"])
+        self.assertRaises(ValueError, parse_options, ["--jobs", "x"])
+        self.assertRaises(ValueError, parse_options, ["--jobs", "0"])
+
+    def test_parse_specs_errors(self):
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        try:
+            spec_paths = []
+            for index in range(4):
+                spec_path = os.path.join(tmp_dir, "%d.spec" % (index,))
+                with open(spec_path, "w") as spec_f:
+                    if index % 2:
+                        spec_f.write("%import missing\n")
+                    else:
+                        spec_f.write("execution_strategy: missing\n")
+                spec_paths.append(spec_path)
+            for processes in (1, 2):
+                results = parse_specs(spec_paths, processes = processes)
+                # all the errors are reported, in order
+                self.assertEqual([x[0] for x in results], spec_paths)
+                for spec_path, metadata, error in results:
+                    self.assertEqual(metadata, None)
+                    self.assert_(error)
+                self.assert_("%import" in results[1][2])
+                self.assert_("not supported" in results[2][2])
+        finally:
+            remove_path(tmp_dir)
+
+    def test_cache_prune(self):
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        old_tmp_dir = os.environ.get("MOLECULE_TMPDIR")
+        os.environ["MOLECULE_TMPDIR"] = tmp_dir
+        try:
+            cache = StepCache()
+            out_file = os.path.join(tmp_dir, "out.img")
+            with open(out_file, "wb") as out_f:
+                out_f.write(b"x" * 1048576)
+            for key in ("k1", "k2"):
+                cache.store(key, [out_file])
+            self.assertEqual(cache.stats()['entries'], 2)
+
+            self.assertEqual(run_command(["cache", "prune", "0"]), 0)
+            # evicted entries are gone from disk once the command returned
+            self.assertEqual(get_trash().pending(), 0)
+            self.assertEqual(os.listdir(cache.cache_dir()), [])
+            trash_dir = os.path.join(tmp_dir, Trash.TRASH_DIR)
+            if os.path.isdir(trash_dir):
+                self.assertEqual(os.listdir(trash_dir), [])
+        finally:
+            if old_tmp_dir is None:
+                del os.environ["MOLECULE_TMPDIR"]
+            else:
+                os.environ["MOLECULE_TMPDIR"] = old_tmp_dir
+            remove_path(tmp_dir)
+
+if __name__ == '__main__':
+    unittest.main()
+    raise SystemExit(0)
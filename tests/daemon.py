@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.insert(0,'.')
+sys.path.insert(0,'..')
+import io
+import time
+import stat
+import signal
+import unittest
+import tempfile
+import threading
+import subprocess
+
+import molecule
+from molecule.daemon import DaemonClient, get_socket_path
+from molecule.utils import remove_path
+
+_PLUGIN = """
+import os
+import sys
+import time
+from molecule.specs.factory import PluginFactory
+from molecule.specs.skel import GenericSpec, GenericExecutionStep
+
+# record the processes importing this module and the plugin scans
+# happening afterwards
+with open(os.path.join(os.environ["MOLECULE_TMPDIR"],
+          "plugin-imports"), "a") as imports_f:
+    imports_f.write("%d\\n" % (os.getpid(),))
+_SCANS = []
+def _scan_module(self, modpath, _scan = PluginFactory._scan_module):
+    _SCANS.append(modpath)
+    return _scan(self, modpath)
+PluginFactory._scan_module = _scan_module
+
+class EchoStep(GenericExecutionStep):
+
+    def pre_run(self):
+        return 0
+
+    def run(self):
+        sys.stdout.write("scans: %d\\n" % (len(_SCANS),))
+        sys.stdout.write("%s\\0%s\\n" % (PREFIX,
+            self.metadata['message'],))
+        sys.stdout.flush()
+        time.sleep(float(self.metadata.get('sleep', '0')))
+        return int(self.metadata.get('rc', '0'))
+
+    def post_run(self):
+        return 0
+
+    def kill(self, success = True):
+        sys.stdout.write("killed: %s\\n" % (success,))
+        sys.stdout.flush()
+        return 0
+
+class EchoSpec(GenericSpec):
+
+    PLUGIN_API_VERSION = 1
+
+    @staticmethod
+    def require_super_user():
+        return False
+
+    @staticmethod
+    def execution_strategy():
+        return "daemon_test"
+
+    def vital_parameters(self):
+        return ["message"]
+
+    def parameters(self):
+        return {
+            'message': {'parser': str, 'verifier': lambda x: True},
+            'sleep': {'parser': str, 'verifier': lambda x: True},
+            'rc': {'parser': str, 'verifier': lambda x: True},
+        }
+
+    def execution_steps(self):
+        return [EchoStep]
+
+PREFIX = "output"
+"""
+
+
+class DaemonTest(unittest.TestCase):
+
+    _ENV = ("MOLECULE_TMPDIR", "MOLECULE_PLUGIN_MODULES", "PYTHONPATH")
+
+    def setUp(self):
+        sys.stdout.write("%s called\n" % (self,))
+        sys.stdout.flush()
+        self._tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        with open(os.path.join(self._tmp_dir, "daemon_test_plugin.py"),
+                  "w") as plugin_f:
+            plugin_f.write(_PLUGIN)
+
+        self._old_env = dict((x, os.environ.get(x)) for x in self._ENV)
+        lib_dir = os.path.dirname(os.path.dirname(
+            os.path.abspath(molecule.__file__)))
+        os.environ["MOLECULE_TMPDIR"] = self._tmp_dir
+        os.environ["MOLECULE_PLUGIN_MODULES"] = "daemon_test_plugin"
+        os.environ["PYTHONPATH"] = os.pathsep.join(
+            [lib_dir, self._tmp_dir])
+
+        self._socket_path = get_socket_path()
+        self._log = open(os.path.join(self._tmp_dir, "daemon.log"), "wb")
+        self._daemon = subprocess.Popen([sys.executable, "-c",
+            "import molecule.daemon; raise SystemExit("
+            "molecule.daemon.BuildDaemon().serve_forever())"],
+            stdout = self._log, stderr = subprocess.STDOUT)
+        deadline = time.time() + 30
+        while not os.path.exists(self._socket_path):
+            self.assert_(time.time() < deadline)
+            self.assertEqual(self._daemon.poll(), None)
+            time.sleep(0.05)
+        self._client = DaemonClient()
+
+    def tearDown(self):
+        """
+        tearDown is run after each test
+        """
+        if self._daemon.poll() is None:
+            self._daemon.send_signal(signal.SIGTERM)
+        self._daemon.wait()
+        self._log.close()
+        for key, value in self._old_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        remove_path(self._tmp_dir)
+        sys.stdout.write("%s ran\n" % (self,))
+        sys.stdout.flush()
+
+    def _spec(self, name, **params):
+        path = os.path.join(self._tmp_dir, name)
+        with open(path, "w") as spec_f:
+            spec_f.write("execution_strategy: daemon_test\n")
+            for key, value in params.items():
+                spec_f.write("%s: %s\n" % (key, value,))
+        return path
+
+    def _submit(self, spec, results):
+        results[spec] = [None, io.BytesIO()]
+        def _build():
+            results[spec][0] = self._client.build([spec],
+                out = results[spec][1])
+        th = threading.Thread(target = _build)
+        th.start()
+        return th
+
+    def _wait_queue(self, predicate):
+        deadline = time.time() + 30
+        while True:
+            queue = self._client.queue()
+            if predicate(queue):
+                return queue
+            self.assert_(time.time() < deadline)
+            time.sleep(0.05)
+
+    def test_socket_dir(self):
+        st = os.lstat(os.path.dirname(self._socket_path))
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o700)
+        self.assertEqual(st.st_uid, os.getuid())
+
+    def test_build_output(self):
+        out = io.BytesIO()
+        spec = self._spec("a.spec", message = "first")
+        self.assertEqual(self._client.build(["--connect", spec],
+            out = out), 0)
+        # NUL bytes in the output do not break the stream
+        self.assert_(b"output\0first\n" in out.getvalue())
+
+        spec = self._spec("b.spec", message = "second", rc = 3)
+        out = io.BytesIO()
+        self.assertEqual(self._client.build([spec], out = out), 3)
+        self.assert_(b"output\0second\n" in out.getvalue())
+
+    def _imports(self):
+        with open(os.path.join(self._tmp_dir, "plugin-imports"),
+                  "r") as imports_f:
+            return [int(x) for x in imports_f.read().split()]
+
+    def test_warm_plugins(self):
+        scans = []
+        for name in ("a.spec", "b.spec"):
+            out = io.BytesIO()
+            spec = self._spec(name, message = name)
+            self.assertEqual(self._client.build([spec], out = out), 0)
+            self.assert_(b"output\0" + name.encode("ascii") + b"\n" \
+                in out.getvalue())
+            scans.extend(x for x in out.getvalue().splitlines() \
+                if x.startswith(b"scans: "))
+        # the plugin registry is not scanned again by the jobs
+        self.assertEqual(len(scans), 2)
+        self.assertEqual(scans[0], scans[1])
+        # the plugin module is only imported once, by the daemon, before
+        # forking the zygote
+        self.assertEqual(self._imports(), [self._daemon.pid])
+
+    def test_plugin_reload(self):
+        spec = self._spec("a.spec", message = "first")
+        self.assertEqual(self._client.build([spec]), 0)
+
+        plugin_path = os.path.join(self._tmp_dir, "daemon_test_plugin.py")
+        with open(plugin_path, "w") as plugin_f:
+            plugin_f.write(_PLUGIN.replace('PREFIX = "output"',
+                'PREFIX = "reloaded"'))
+        mtime = os.stat(plugin_path).st_mtime + 10
+        os.utime(plugin_path, (mtime, mtime))
+
+        for x in range(2):
+            out = io.BytesIO()
+            self.assertEqual(self._client.build([spec], out = out), 0)
+            self.assert_(b"reloaded\0first\n" in out.getvalue())
+        # reloaded once, by the zygote
+        imports = self._imports()
+        self.assertEqual(len(imports), 2)
+        self.assertEqual(imports[0], self._daemon.pid)
+        self.assertNotEqual(imports[1], self._daemon.pid)
+
+    def test_rejected_args(self):
+        spec = self._spec("a.spec", message = "first")
+        self.assertEqual(self._client.build(["--daemon", spec]), 1)
+        self.assertEqual(self._client.queue(),
+            {'running': None, 'queued': []})
+
+    def test_status_cancel(self):
+        results = {}
+        slow = self._spec("slow.spec", message = "slow", sleep = 60)
+        queued = self._spec("queued.spec", message = "queued")
+
+        slow_th = self._submit(slow, results)
+        queue = self._wait_queue(lambda x: x['running'] is not None)
+        self.assertEqual(queue['running'], {'id': 1, 'args': [slow]})
+        queued_th = self._submit(queued, results)
+        queue = self._wait_queue(lambda x: x['queued'])
+        self.assertEqual(queue['queued'], [{'id': 2, 'args': [queued]}])
+        self.assertEqual(self._client.status(), 0)
+
+        # wait for the slow step to be running
+        deadline = time.time() + 30
+        while b"output\0slow" not in results[slow][1].getvalue():
+            self.assert_(time.time() < deadline)
+            time.sleep(0.05)
+
+        self.assertEqual(self._client.cancel(2), 0)
+        queued_th.join()
+        self.assertEqual(results[queued][0], 1)
+        self.assertEqual(results[queued][1].getvalue(), b"")
+
+        self.assertEqual(self._client.cancel(1), 0)
+        slow_th.join()
+        rc, out = results[slow]
+        self.assertEqual(rc, 1)
+        self.assert_(b"killed: False\n" in out.getvalue())
+
+        self.assertEqual(self._client.cancel(1), 1)
+        self.assertEqual(self._client.queue(),
+            {'running': None, 'queued': []})
+
+if __name__ == '__main__':
+    unittest.main()
+    raise SystemExit(0)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+import sys
+sys.path.insert(0,'.')
+sys.path.insert(0,'..')
+import os
+import unittest
+import threading
+import tempfile
+
+from molecule.specs.skel import GenericExecutionStep
+from molecule.handlers import Runner
+from molecule.checkpoint import CheckpointJournal, metadata_fingerprint
+from molecule.utils import remove_path
+from molecule.trace import Tracer
+
+
+class _Step(GenericExecutionStep):
+
+    RC = 0
+
+    def pre_run(self):
+        return 0
+
+    def run(self):
+        self.metadata['executed'].append(self.__class__.__name__)
+        return self.RC
+
+    def post_run(self):
+        return 0
+
+    def kill(self, success = True):
+        self.metadata['killed'].append((self.__class__.__name__, success))
+        return 0
+
+class _StepA(_Step):
+    pass
+
+class _StepB(_Step):
+    pass
+
+class _FailingStep(_Step):
+    RC = 5
+
+class _RaisingStep(_Step):
+
+    def run(self):
+        raise ValueError("broken step")
+
+class _EventSetStep(_Step):
+
+    def run(self):
+        self.metadata['event'].set()
+        return _Step.run(self)
+
+class _EventWaitStep(_Step):
+
+    def run(self):
+        # only succeeds if executed concurrently with _EventSetStep
+        if not self.metadata['event'].wait(10):
+            return 1
+        return _Step.run(self)
+
+
+class _FailOnceStep(_Step):
+
+    FAILED = False
+
+    def run(self):
+        _Step.run(self)
+        if not _FailOnceStep.FAILED:
+            _FailOnceStep.FAILED = True
+            return 3
+        return 0
+
+
+class _CachedStep(_Step):
+
+    def run(self):
+        _Step.run(self)
+        with open(self.metadata['output'], "w") as out_f:
+            out_f.write("cached")
+        return 0
+
+    def cache_outputs(self):
+        return [self.metadata['output']]
+
+
+class _Plugin(object):
+
+    def __init__(self, steps):
+        self._steps = steps
+
+    def execution_steps(self):
+        return self._steps
+
+
+class RunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        sys.stdout.write("%s called\n" % (self,))
+        sys.stdout.flush()
+        self._tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        self._old_tmp_dir = os.environ.get("MOLECULE_TMPDIR")
+        os.environ["MOLECULE_TMPDIR"] = self._tmp_dir
+
+    def tearDown(self):
+        """
+        tearDown is run after each test
+        """
+        if self._old_tmp_dir is None:
+            del os.environ["MOLECULE_TMPDIR"]
+        else:
+            os.environ["MOLECULE_TMPDIR"] = self._old_tmp_dir
+        remove_path(self._tmp_dir)
+        sys.stdout.write("%s ran\n" % (self,))
+        sys.stdout.flush()
+
+    def _runner(self, steps):
+        metadata = {
+            '__plugin__': _Plugin(steps),
+            'executed': [],
+            'killed': [],
+            'event': threading.Event(),
+        }
+        return Runner("test.spec", metadata), metadata
+
+    def test_sequential(self):
+        runner, metadata = self._runner([_StepA, _StepB])
+        self.assertEqual(runner.run(), 0)
+        self.assertEqual(metadata['executed'], ['_StepA', '_StepB'])
+        self.assertEqual(metadata['killed'],
+            [('_StepA', True), ('_StepB', True)])
+
+    def test_failure(self):
+        runner, metadata = self._runner([_StepA, _FailingStep, _StepB])
+        self.assertEqual(runner.run(), 5)
+        self.assertEqual(metadata['executed'], ['_StepA', '_FailingStep'])
+        self.assertEqual(metadata['killed'],
+            [('_StepA', True), ('_FailingStep', False)])
+
+    def test_parallel_group(self):
+        runner, metadata = self._runner(
+            [_StepA, (_EventWaitStep, _EventSetStep), _StepB])
+        self.assertEqual(runner.run(), 0)
+        self.assertEqual(metadata['executed'][0], '_StepA')
+        self.assertEqual(metadata['executed'][-1], '_StepB')
+        self.assertEqual(sorted(metadata['executed'][1:3]),
+            ['_EventSetStep', '_EventWaitStep'])
+
+    def test_parallel_group_failure(self):
+        runner, metadata = self._runner([(_StepA, _FailingStep), _StepB])
+        self.assertEqual(runner.run(), 5)
+        self.assert_('_StepB' not in metadata['executed'])
+        self.assertEqual(sorted(metadata['killed']),
+            [('_FailingStep', False), ('_StepA', True)])
+
+    def test_parallel_group_exception(self):
+        runner, metadata = self._runner([(_StepA, _RaisingStep)])
+        self.assertRaises(ValueError, runner.run)
+        self.assert_(('_RaisingStep', False) in metadata['killed'])
+
+    def test_resume(self):
+        metadata = {
+            '__plugin__': _Plugin([_StepA, _FailOnceStep, _StepB]),
+            'executed': [],
+            'killed': [],
+        }
+        runner = Runner("test.spec", metadata, resume = True)
+        self.assertEqual(runner.run(), 3)
+        self.assertEqual(metadata['executed'], ['_StepA', '_FailOnceStep'])
+
+        del metadata['executed'][:]
+        del metadata['killed'][:]
+        runner = Runner("test.spec", metadata, resume = True)
+        self.assertEqual(runner.run(), 0)
+        self.assertEqual(metadata['executed'], ['_FailOnceStep', '_StepB'])
+
+        # journal is gone after a successful execution
+        del metadata['executed'][:]
+        del metadata['killed'][:]
+        runner = Runner("test.spec", metadata, resume = True)
+        self.assertEqual(runner.run(), 0)
+        self.assertEqual(metadata['executed'],
+            ['_StepA', '_FailOnceStep', '_StepB'])
+
+    def test_checkpoint_fingerprint(self):
+        journal = CheckpointJournal("test.spec",
+            metadata_fingerprint({'a': "b"}), tmp_dir = self._tmp_dir)
+        journal.record("1:test.Step")
+        self.assert_(journal.is_completed("1:test.Step"))
+
+        journal = CheckpointJournal("test.spec",
+            metadata_fingerprint({'a': "c"}), tmp_dir = self._tmp_dir)
+        self.assert_(not journal.is_completed("1:test.Step"))
+        journal.reset()
+        self.assert_(not os.path.exists(journal.path()))
+
+    def test_tracer(self):
+        tracer = Tracer()
+        metadata = {
+            '__plugin__': _Plugin([_StepA, _StepB]),
+            'executed': [],
+            'killed': [],
+        }
+        runner = Runner("test.spec", metadata, tracer = tracer)
+        self.assertEqual(runner.run(), 0)
+        names = [x['name'] for x in tracer.events()]
+        self.assertEqual(names[:5], ['_StepA.setup', '_StepA.pre_run',
+            '_StepA.run', '_StepA.post_run', '_StepA.kill'])
+        self.assertEqual(len(names), 10)
+        rows = dict((x[1], x[2]) for x in tracer.summary())
+        self.assertEqual(rows['_StepB.run'], 1)
+
+        trace_path = os.path.join(self._tmp_dir, "trace.json")
+        tracer.write(trace_path)
+        self.assertEqual(Tracer.load(trace_path), tracer.events())
+
+    def test_step_results(self):
+        runner, metadata = self._runner([_StepA, _FailingStep])
+        self.assertEqual(runner.run(), 5)
+        results = runner.step_results()
+        self.assertEqual([x['step'] for x in results],
+            ['1:%s._StepA' % (__name__,), '2:%s._FailingStep' % (__name__,)])
+        self.assertEqual([x['rc'] for x in results], [0, 5])
+        for result in results:
+            self.assert_(result['wall_time'] >= 0)
+            self.assertEqual(result['children']['processes'], 0)
+            self.assert_('user_time' in result['rusage_children'])
+
+    def test_step_cache(self):
+        output = os.path.join(self._tmp_dir, "output")
+        metadata = {
+            '__plugin__': _Plugin([_CachedStep]),
+            'executed': [],
+            'killed': [],
+            'output': output,
+        }
+        runner = Runner("test.spec", metadata, use_cache = True)
+        self.assertEqual(runner.run(), 0)
+        self.assertEqual(metadata['executed'], ['_CachedStep'])
+
+        os.remove(output)
+        del metadata['executed'][:]
+        del metadata['killed'][:]
+        runner = Runner("test.spec", metadata, use_cache = True)
+        self.assertEqual(runner.run(), 0)
+        self.assertEqual(metadata['executed'], [])
+        self.assert_(os.path.isfile(output))
+
+if __name__ == '__main__':
+    unittest.main()
+    raise SystemExit(0)
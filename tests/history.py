@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.insert(0,'.')
+sys.path.insert(0,'..')
+import unittest
+import tempfile
+
+from molecule.history import TimingHistory
+from molecule.scheduler import SpecScheduler
+from molecule.utils import remove_path
+
+
+class _Step(object):
+    pass
+
+
+class _Plugin(object):
+
+    def execution_steps(self):
+        return [_Step]
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        sys.stdout.write("%s called\n" % (self,))
+        sys.stdout.flush()
+        self._tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        self._history = TimingHistory(
+            db_path = os.path.join(self._tmp_dir, "history.db"))
+
+    def tearDown(self):
+        """
+        tearDown is run after each test
+        """
+        self._history.close()
+        remove_path(self._tmp_dir)
+        sys.stdout.write("%s ran\n" % (self,))
+        sys.stdout.flush()
+
+    def test_expected(self):
+        self.assertEqual(self._history.expected_spec("a.spec"), None)
+        self._history.record_spec(os.path.abspath("a.spec"), 10.0, 0,
+            started = 1.0)
+        self._history.record_spec("a.spec", 20.0, 0, started = 2.0)
+        self._history.record_spec("a.spec", 500.0, 1, started = 3.0)
+        self.assertEqual(self._history.expected_spec("a.spec"), 15.0)
+        # same file name, different spec file
+        self._history.record_spec("/path/a.spec", 100.0, 0, started = 4.0)
+        self.assertEqual(self._history.expected_spec("a.spec"), 15.0)
+        self.assertEqual(self._history.expected_spec("/path/a.spec"), 100.0)
+
+        step = "%s._Step" % (__name__,)
+        self._history.record_steps("a.spec", [
+            {'class': step, 'rc': 0, 'wall_time': 4.0},
+            {'class': "other.Step", 'rc': None, 'wall_time': 1.0},
+        ])
+        self.assertEqual(self._history.expected_steps("a.spec"),
+            {step: 4.0})
+
+    def test_longest_first(self):
+        for spec, duration in (("a.spec", 1.0), ("b.spec", 5.0),
+                               ("c.spec", 10.0), ("d.spec", 3.0)):
+            self._history.record_spec(spec, duration, 0)
+        # d.spec depends on a.spec: the a -> d chain (4s) beats b.spec
+        data = {
+            'a.spec': {'__plugin__': _Plugin()},
+            'b.spec': {'__plugin__': _Plugin()},
+            'c.spec': {'__plugin__': _Plugin()},
+            'd.spec': {'__plugin__': _Plugin(),
+                       'depends': [os.path.abspath("a.spec")]},
+        }
+        order = sorted(data.keys())
+        scheduler = SpecScheduler(data, order, jobs = 2,
+            history = self._history)
+        self.assertEqual(scheduler._ready(list(order)),
+            ['c.spec', 'b.spec', 'a.spec'])
+
+        expected, critical_path, duration = scheduler.plan()
+        self.assertEqual(expected['c.spec'], 10.0)
+        self.assertEqual(critical_path, ['c.spec'])
+        self.assertEqual(duration, 10.0)
+
+        self._history.record_spec("d.spec", 30.0, 0)
+        scheduler = SpecScheduler(data, order, jobs = 2,
+            history = self._history)
+        expected, critical_path, duration = scheduler.plan()
+        self.assertEqual(critical_path, ['a.spec', 'd.spec'])
+        self.assertEqual(duration, 1.0 + (3.0 + 30.0) / 2)
+
+if __name__ == '__main__':
+    unittest.main()
+    raise SystemExit(0)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.insert(0,'.')
+sys.path.insert(0,'..')
+import time
+import unittest
+import tempfile
+
+from molecule.exception import SpecFileError
+from molecule.specs.skel import GenericExecutionStep
+from molecule.scheduler import SpecScheduler
+from molecule.utils import remove_path
+
+
+class _Step(GenericExecutionStep):
+
+    def pre_run(self):
+        return 0
+
+    def run(self):
+        started_file = self.metadata.get('started_file')
+        if started_file:
+            with open(started_file, "w") as started_f:
+                started_f.write("started")
+        wait_file = self.metadata.get('wait_file')
+        if wait_file:
+            deadline = time.time() + 30
+            while not os.path.isfile(wait_file) and time.time() < deadline:
+                time.sleep(0.05)
+        time.sleep(self.metadata.get('sleep', 0))
+        return self.metadata['rc']
+
+    def post_run(self):
+        return 0
+
+    def kill(self, success = True):
+        kill_file = self.metadata.get('kill_file')
+        if kill_file:
+            with open(kill_file, "w") as kill_f:
+                kill_f.write(str(success))
+        return 0
+
+
+class _Plugin(object):
+
+    def execution_steps(self):
+        return [_Step]
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        sys.stdout.write("%s called\n" % (self,))
+        sys.stdout.flush()
+        self._log_dir = tempfile.mkdtemp(dir=os.getcwd())
+        self._old_tmp_dir = os.environ.get("MOLECULE_TMPDIR")
+        os.environ["MOLECULE_TMPDIR"] = self._log_dir
+
+    def tearDown(self):
+        """
+        tearDown is run after each test
+        """
+        if self._old_tmp_dir is None:
+            del os.environ["MOLECULE_TMPDIR"]
+        else:
+            os.environ["MOLECULE_TMPDIR"] = self._old_tmp_dir
+        remove_path(self._log_dir)
+        sys.stdout.write("%s ran\n" % (self,))
+        sys.stdout.flush()
+
+    def _metadata(self, rc, depends = None):
+        metadata = {'__plugin__': _Plugin(), 'rc': rc}
+        if depends:
+            metadata['depends'] = [os.path.abspath(x) for x in depends]
+        return metadata
+
+    def test_parallel_success(self):
+        data = dict(("%d.spec" % (x,), self._metadata(0)) for x in range(4))
+        order = sorted(data.keys())
+        scheduler = SpecScheduler(data, order, jobs = 2,
+            log_dir = self._log_dir)
+        self.assertEqual(scheduler.run(), 0)
+        self.assertEqual(sorted(scheduler.results().keys()), order)
+        for log_path in scheduler.log_paths().values():
+            self.assert_(os.path.isfile(log_path))
+
+    def test_parallel_step_results(self):
+        data = dict(("%d.spec" % (x,), self._metadata(0)) for x in range(2))
+        order = sorted(data.keys())
+        scheduler = SpecScheduler(data, order, jobs = 2,
+            log_dir = self._log_dir)
+        self.assertEqual(scheduler.run(), 0)
+        step_results = scheduler.step_results()
+        self.assertEqual(sorted(step_results.keys()), order)
+        for results in step_results.values():
+            self.assertEqual([x['rc'] for x in results], [0])
+
+    def test_parallel_failure(self):
+        data = {
+            'a.spec': self._metadata(0),
+            'b.spec': self._metadata(3),
+        }
+        scheduler = SpecScheduler(data, ['a.spec', 'b.spec'], jobs = 2,
+            log_dir = self._log_dir)
+        self.assertEqual(scheduler.run(), 3)
+        self.assertEqual(scheduler.results(), {'a.spec': 0, 'b.spec': 3})
+
+    def test_fail_fast(self):
+        data = {
+            'a.spec': self._metadata(2),
+            'b.spec': self._metadata(0),
+        }
+        scheduler = SpecScheduler(data, ['a.spec', 'b.spec'], jobs = 1,
+            fail_fast = True, log_dir = self._log_dir)
+        self.assertEqual(scheduler.run(), 2)
+        self.assert_('b.spec' not in scheduler.results())
+
+    def test_parallel_fail_fast(self):
+        started_file = os.path.join(self._log_dir, "started")
+        kill_file = os.path.join(self._log_dir, "killed")
+        slow = self._metadata(0)
+        slow.update({'sleep': 60, 'started_file': started_file,
+            'kill_file': kill_file})
+        failing = self._metadata(2)
+        # fail only once the slow spec is inside its step
+        failing['wait_file'] = started_file
+        data = {'a.spec': slow, 'b.spec': failing}
+        scheduler = SpecScheduler(data, ['a.spec', 'b.spec'], jobs = 2,
+            fail_fast = True, log_dir = self._log_dir)
+        start = time.time()
+        self.assertEqual(scheduler.run(), 2)
+        self.assert_(time.time() - start < 30)
+        results = scheduler.results()
+        self.assertEqual(results['b.spec'], 2)
+        self.assertNotEqual(results.get('a.spec'), 0)
+        # the terminated Runner unwound through kill(success = False)
+        with open(kill_file, "r") as kill_f:
+            self.assertEqual(kill_f.read(), "False")
+
+    def test_inline_dependencies(self):
+        data = {
+            'a.spec': self._metadata(0, depends = ['b.spec']),
+            'b.spec': self._metadata(0),
+        }
+        scheduler = SpecScheduler(data, ['a.spec', 'b.spec'])
+        self.assertEqual(scheduler.dependencies(),
+            {'a.spec': ['b.spec'], 'b.spec': []})
+        self.assertEqual(scheduler.run(), 0)
+        self.assertEqual(scheduler.results(), {'a.spec': 0, 'b.spec': 0})
+
+    def test_failed_dependency(self):
+        data = {
+            'a.spec': self._metadata(4),
+            'b.spec': self._metadata(0, depends = ['a.spec']),
+            'c.spec': self._metadata(0, depends = ['b.spec']),
+            'd.spec': self._metadata(0),
+        }
+        order = ['a.spec', 'b.spec', 'c.spec', 'd.spec']
+        scheduler = SpecScheduler(data, order, jobs = 2,
+            log_dir = self._log_dir)
+        self.assertEqual(scheduler.run(), 4)
+        self.assertEqual(scheduler.results(), {'a.spec': 4, 'd.spec': 0})
+        self.assertEqual(scheduler.skipped(), set(['b.spec', 'c.spec']))
+
+    def test_invalid_dependencies(self):
+        data = {
+            'a.spec': self._metadata(0, depends = ['b.spec']),
+            'b.spec': self._metadata(0, depends = ['a.spec']),
+        }
+        self.assertRaises(SpecFileError, SpecScheduler, data,
+            ['a.spec', 'b.spec'])
+        data['c.spec'] = self._metadata(0, depends = ['a.spec'])
+        try:
+            SpecScheduler(data, ['c.spec', 'a.spec', 'b.spec'])
+        except SpecFileError as err:
+            self.assert_("a.spec -> b.spec -> a.spec" in str(err))
+        else:
+            self.fail("circular dependency not detected")
+        data = {
+            'a.spec': self._metadata(0, depends = ['z.spec']),
+        }
+        self.assertRaises(SpecFileError, SpecScheduler, data, ['a.spec'])
+
+    def test_diamond_dependencies(self):
+        # every layer depends on both spec files of the previous one:
+        # 2^40 dependency paths, checked in linear time
+        data = {'0.spec': self._metadata(0)}
+        order = ['0.spec']
+        previous = ['0.spec']
+        for layer in range(1, 41):
+            current = ["%d-%s.spec" % (layer, x,) for x in ("a", "b")]
+            for spec_path in current:
+                data[spec_path] = self._metadata(0, depends = previous)
+            order.extend(current)
+            previous = current
+        start = time.time()
+        SpecScheduler(data, order)
+        self.assert_(time.time() - start < 10)
+
+if __name__ == '__main__':
+    unittest.main()
+    raise SystemExit(0)
@@ -4,6 +4,17 @@ import sys
 sys.path.insert(0,'.')
 sys.path.insert(0,'..')
 import unittest
+import tempfile
+
+from molecule.settings import SpecPreprocessor, SpecParser, \
+    _expand_parameters, get_include_loader, _split_lines, _iter_statements, \
+    _merge_values
+from molecule.speccache import SpecCache
+from molecule.exception import SpecFileError
+from molecule.specs.factory import PluginFactory
+from molecule.specs.skel import GenericSpec
+from molecule.utils import remove_path
+
 
 class SpecsTest(unittest.TestCase):
 
@@ -18,7 +29,308 @@ class SpecsTest(unittest.TestCase):
         sys.stdout.write("%s ran\n" % (self,))
         sys.stdout.flush()
 
-    
+    def test_line_pipeline(self):
+        for chunks in ([], [""], ["a\n", "b"], ["a", "b\n", "\n"],
+                       ["a\nb\nc", "d\n", "e"], ["\n\n", "x", "", "y\n"]):
+            self.assertEqual(list(_split_lines(chunks)),
+                "".join(chunks).split("\n"))
+        self.assertEqual(list(_iter_statements(
+            ["# comment", "a: b # c", "  ", " d ", "  # e"])),
+            ["a: b", "d", ""])
+        self.assertEqual(_merge_values(["a", "b", "c"]), "a b c")
+        self.assertEqual(_merge_values([["a"], ["b", "c"]]), ["a", "b", "c"])
+        self.assertEqual(_merge_values([["a"], "bc"]), ["a", " ", "b", "c"])
+
+    def test_expand_parameters(self):
+        env = {'FOO': "bar", 'EMPTY': ""}
+        expected = {
+            "${FOO}": "bar",
+            "$FOO/x": "bar/x",
+            "${UNSET:-d}": "d",
+            "${EMPTY:-d}": "d",
+            "${EMPTY-d}": "",
+            "${FOO:+alt}": "alt",
+            "${EMPTY+alt}": "alt",
+            "${UNSET:-${FOO}}": "bar",
+            "a$ b": "a$ b",
+            "it's": "it's",
+        }
+        for arg, value in expected.items():
+            self.assertEqual(_expand_parameters(arg, env = env), value)
+        # evaluated by the shell
+        for arg in ("$(echo)", "`echo`", "a\\b", "${#FOO}", "${FOO:?x}",
+                    "${1}", "${PWD}", "${FOO"):
+            self.assertEqual(_expand_parameters(arg, env = env), None)
+
+    def test_env_expander(self):
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        try:
+            spec_path = os.path.join(tmp_dir, "test.spec")
+            with open(spec_path, "w") as spec_f:
+                spec_f.write("%env a: ${MOLECULE_TEST:-x}/y \"$(echo z)\"\n")
+                spec_f.write("%env b: ${MOLECULE_TEST_UNSET}\n")
+            preprocessor = SpecPreprocessor(spec_path)
+            self.assertRaises(SpecPreprocessor.PreprocessorError,
+                preprocessor.parse)
+
+            with open(spec_path, "w") as spec_f:
+                spec_f.write("%env a: ${MOLECULE_TEST:-x}/y \"$(echo z)\"\n")
+            self.assertEqual(SpecPreprocessor(spec_path).parse()[0],
+                "a: x/y z")
+        finally:
+            remove_path(tmp_dir)
+
+    def test_spec_cache(self):
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        old_env = os.environ.get("MOLECULE_TEST")
+        try:
+            cache = SpecCache(cache_dir = os.path.join(tmp_dir, "cache"))
+            spec_path = os.path.join(tmp_dir, "test.spec")
+            import_path = os.path.join(tmp_dir, "imported")
+            with open(spec_path, "w") as spec_f:
+                spec_f.write("%import imported\n")
+                spec_f.write("%env b: ${MOLECULE_TEST}\n")
+            with open(import_path, "w") as import_f:
+                import_f.write("a: 1\n")
+            os.environ["MOLECULE_TEST"] = "x"
+
+            content = SpecPreprocessor(spec_path, cache = cache).parse()
+            self.assertEqual(content, ["a: 1", "b: x", ""])
+            self.assertEqual(cache.load(spec_path), content)
+
+            # inputs changed
+            os.environ["MOLECULE_TEST"] = "y"
+            self.assertEqual(cache.load(spec_path), None)
+            self.assertEqual(SpecPreprocessor(spec_path, cache = cache).parse(),
+                ["a: 1", "b: y", ""])
+            with open(import_path, "w") as import_f:
+                import_f.write("a: 2\n")
+            self.assertEqual(cache.load(spec_path), None)
+
+            # arguments evaluated by the shell are not cacheable
+            with open(spec_path, "w") as spec_f:
+                spec_f.write("%env b: \"$(echo z)\"\n")
+            self.assertEqual(SpecPreprocessor(spec_path, cache = cache).parse(),
+                ["b: z", ""])
+            self.assertEqual(cache.load(spec_path), None)
+        finally:
+            if old_env is None:
+                os.environ.pop("MOLECULE_TEST", None)
+            else:
+                os.environ["MOLECULE_TEST"] = old_env
+            remove_path(tmp_dir)
+
+    def test_import(self):
+        tmp_dir = os.path.realpath(tempfile.mkdtemp(dir=os.getcwd()))
+        loader = get_include_loader()
+        try:
+            def _write(name, content):
+                with open(os.path.join(tmp_dir, name), "w") as path_f:
+                    path_f.write(content)
+            _write("a.spec", "%import common\nname: a\n")
+            _write("b.spec", "%import common\nname: b\n")
+            _write("common", "%import nested\ncommon: 1\n")
+            _write("nested", "nested: 1\n")
+            a_path = os.path.join(tmp_dir, "a.spec")
+            common_path = os.path.join(tmp_dir, "common")
+            nested_path = os.path.join(tmp_dir, "nested")
+
+            preprocessor = SpecPreprocessor(a_path)
+            self.assertEqual(preprocessor.parse(),
+                ["nested: 1", "common: 1", "name: a", ""])
+            self.assertEqual(preprocessor.includes(), {
+                a_path: [common_path],
+                common_path: [nested_path],
+                nested_path: [],
+            })
+            self.assertEqual(
+                SpecPreprocessor(os.path.join(tmp_dir, "b.spec")).parse(),
+                ["nested: 1", "common: 1", "name: b", ""])
+            self.assertEqual(loader.includers(nested_path),
+                [a_path, os.path.join(tmp_dir, "b.spec"), common_path])
+
+            # memoized content is invalidated by changes
+            _write("nested", "nested: 22\n")
+            os.utime(nested_path, (1, 1))
+            self.assertEqual(SpecPreprocessor(a_path).parse(),
+                ["nested: 22", "common: 1", "name: a", ""])
+
+            # circular imports
+            _write("nested", "%import common\n")
+            self.assertRaises(SpecPreprocessor.PreprocessorError,
+                SpecPreprocessor(a_path).parse)
+        finally:
+            loader.clear()
+            remove_path(tmp_dir)
+
+    def test_plugin_manifest(self):
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        pkg_dir = os.path.join(tmp_dir, "manifest_test_plugins")
+        os.mkdir(pkg_dir)
+        with open(os.path.join(pkg_dir, "__init__.py"), "w") as init_f:
+            init_f.write("")
+        for name in ("alpha", "beta"):
+            with open(os.path.join(pkg_dir, "%s_plugin.py" % (name,)),
+                      "w") as plugin_f:
+                plugin_f.write(
+                    "from molecule.specs.skel import GenericSpec\n"
+                    "class %sSpec(GenericSpec):\n"
+                    "    PLUGIN_API_VERSION = 1\n"
+                    "    @staticmethod\n"
+                    "    def execution_strategy():\n"
+                    "        return %r\n" % (name.capitalize(), name,))
+
+        def _factory():
+            for modname in list(sys.modules.keys()):
+                if modname.startswith("manifest_test_plugins"):
+                    del sys.modules[modname]
+            package = __import__("manifest_test_plugins")
+            return PluginFactory(GenericSpec, package,
+                manifest_key = lambda x: x.execution_strategy(),
+                manifest_dir = os.path.join(tmp_dir, "manifests"))
+
+        sys.path.insert(0, tmp_dir)
+        try:
+            factory = _factory()
+            self.assertEqual(sorted(factory.get_plugin_keys()),
+                ["alpha", "beta"])
+            # manifest available, only the requested module is imported
+            factory = _factory()
+            self.assertEqual(factory.get_plugin("beta").__name__, "BetaSpec")
+            self.assert_("manifest_test_plugins.beta_plugin" in sys.modules)
+            self.assert_(
+                "manifest_test_plugins.alpha_plugin" not in sys.modules)
+            self.assertEqual(factory.get_plugin("gamma"), None)
+            plugins = factory.get_plugin_map()
+            self.assertEqual(sorted(plugins.keys()), ["alpha", "beta"])
+            self.assertEqual(plugins["alpha"].__name__, "AlphaSpec")
+
+            # changed modules invalidate the manifest
+            with open(os.path.join(pkg_dir, "alpha_plugin.py"), "a") \
+                    as plugin_f:
+                plugin_f.write("    PLUGIN_DISABLED = True\n")
+            os.utime(os.path.join(pkg_dir, "alpha_plugin.py"), (0, 0))
+            factory = _factory()
+            self.assertEqual(factory.get_plugin_keys(), ["beta"])
+            self.assertEqual(factory.get_plugin("alpha"), None)
+        finally:
+            sys.path.remove(tmp_dir)
+            remove_path(tmp_dir)
+
+    def test_plugin_entry_points(self):
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        dist_dir = os.path.join(tmp_dir, "molecule_ep_test-1.0.dist-info")
+        os.mkdir(dist_dir)
+        with open(os.path.join(dist_dir, "METADATA"), "w") as meta_f:
+            meta_f.write("Metadata-Version: 2.1\nName: molecule_ep_test\n"
+                         "Version: 1.0\n")
+        with open(os.path.join(dist_dir, "entry_points.txt"), "w") as ep_f:
+            ep_f.write("[molecule_ep_test.plugins]\n"
+                       "alpha = molecule_ep_test_alpha:AlphaSpec\n"
+                       "beta = molecule_ep_test_beta:BetaSpec\n")
+        for name in ("alpha", "beta"):
+            with open(os.path.join(tmp_dir, "molecule_ep_test_%s.py" % (
+                        name,)), "w") as plugin_f:
+                plugin_f.write(
+                    "from molecule.specs.skel import GenericSpec\n"
+                    "class %sSpec(GenericSpec):\n"
+                    "    PLUGIN_API_VERSION = 1\n"
+                    "    @staticmethod\n"
+                    "    def execution_strategy():\n"
+                    "        return %r\n" % (name.capitalize(), name,))
+
+        import molecule.specs.plugins as plugs
+        sys.path.insert(0, tmp_dir)
+        try:
+            factory = PluginFactory(GenericSpec, plugs,
+                egg_entry_point_group = "molecule_ep_test.plugins",
+                manifest_key = lambda x: x.execution_strategy())
+            self.assertEqual(sorted(factory.get_plugin_keys()),
+                ["alpha", "beta"])
+            # only the requested entry point is loaded
+            self.assertEqual(factory.get_plugin("beta").__name__, "BetaSpec")
+            self.assert_("molecule_ep_test_beta" in sys.modules)
+            self.assert_("molecule_ep_test_alpha" not in sys.modules)
+            self.assertEqual(factory.get_plugin("gamma"), None)
+            self.assertEqual(sorted(factory.get_available_plugins().keys()),
+                ["alpha", "beta"])
+        finally:
+            sys.path.remove(tmp_dir)
+            for name in ("alpha", "beta"):
+                sys.modules.pop("molecule_ep_test_%s" % (name,), None)
+            remove_path(tmp_dir)
+
+    def test_parse_preprocess_once(self):
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        pkg_dir = os.path.join(tmp_dir, "parser_test_plugins")
+        os.mkdir(pkg_dir)
+        with open(os.path.join(pkg_dir, "__init__.py"), "w") as init_f:
+            init_f.write("")
+        with open(os.path.join(pkg_dir, "once_plugin.py"), "w") as plugin_f:
+            plugin_f.write(
+                "from molecule.specs.skel import GenericSpec\n"
+                "class OnceSpec(GenericSpec):\n"
+                "    PLUGIN_API_VERSION = 1\n"
+                "    @staticmethod\n"
+                "    def execution_strategy():\n"
+                "        return 'once'\n"
+                "    def vital_parameters(self):\n"
+                "        return ['name']\n"
+                "    def parameters(self):\n"
+                "        return {'name': {'parser': lambda x: x,\n"
+                "                         'verifier': lambda x: True}}\n")
+        spec_path = os.path.join(tmp_dir, "test.spec")
+        with open(spec_path, "w") as spec_f:
+            spec_f.write("execution_strategy: once\nname: test\n")
+
+        calls = []
+        orig_parse = SpecPreprocessor.__dict__["parse"]
+        def _parse(preprocessor):
+            calls.append(preprocessor)
+            return orig_parse(preprocessor)
+        orig_factory = PluginFactory._SPEC_FACTORY
+        sys.path.insert(0, tmp_dir)
+        try:
+            package = __import__("parser_test_plugins")
+            PluginFactory._SPEC_FACTORY = PluginFactory(GenericSpec, package,
+                manifest_key = lambda x: x.execution_strategy(),
+                manifest_dir = os.path.join(tmp_dir, "manifests"))
+            SpecPreprocessor.parse = _parse
+            parser = SpecParser(spec_path)
+            self.assertEqual(parser.parse_execution_strategy(), "once")
+            self.assertEqual(parser.parse()['name'], "test")
+            # the execution strategy lookup and the parse share one pass
+            self.assertEqual(len(calls), 1)
+
+            # plugins cannot take over the parameters handled by Molecule
+            with open(os.path.join(pkg_dir, "clash_plugin.py"), "w") \
+                    as plugin_f:
+                plugin_f.write(
+                    "from molecule.specs.skel import GenericSpec\n"
+                    "class ClashSpec(GenericSpec):\n"
+                    "    PLUGIN_API_VERSION = 1\n"
+                    "    @staticmethod\n"
+                    "    def execution_strategy():\n"
+                    "        return 'clash'\n"
+                    "    def vital_parameters(self):\n"
+                    "        return []\n"
+                    "    def parameters(self):\n"
+                    "        return {'depends': {'parser': lambda x: x,\n"
+                    "                            'verifier': lambda x: True}}\n")
+            with open(spec_path, "w") as spec_f:
+                spec_f.write("execution_strategy: clash\n")
+            PluginFactory._SPEC_FACTORY = PluginFactory(GenericSpec, package,
+                manifest_key = lambda x: x.execution_strategy(),
+                manifest_dir = os.path.join(tmp_dir, "manifests"))
+            self.assertRaises(SpecFileError, SpecParser, spec_path)
+        finally:
+            SpecPreprocessor.parse = orig_parse
+            PluginFactory._SPEC_FACTORY = orig_factory
+            sys.path.remove(tmp_dir)
+            for modname in list(sys.modules.keys()):
+                if modname.startswith("parser_test_plugins"):
+                    del sys.modules[modname]
+            remove_path(tmp_dir)
 
 if __name__ == '__main__':
     unittest.main()
@@ -10,7 +10,10 @@ from molecule.compat import get_stringtype, convert_to_rawstring
 from molecule.utils import md5sum, copy_dir, get_random_number, \
     remove_path_sandbox, remove_path, mkdtemp, empty_dir, \
     exec_cmd_get_status_output, exec_cmd, is_exec_available, \
-    valid_exec_check, get_year, exec_chroot_cmd
+    valid_exec_check, get_year, exec_chroot_cmd, ChildUsage, \
+    account_children, eval_shell_argument, ShellEvaluator, ExecutableIndex, \
+    copy_tree, copy_dir_existing_dest, sync_tree, CopyStats, remove_tree, \
+    RemoveStats, Trash, file_digests, hash_files, write_digest_files
 
 class UtilsTest(unittest.TestCase):
 
@@ -34,6 +37,39 @@ class UtilsTest(unittest.TestCase):
         self.assertEqual(result, "5d41402abc4b2a76b9719d911017c592")
         os.remove(tmp_path)
 
+    def test_file_digests(self):
+        import hashlib
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        try:
+            algorithms = ("md5", "sha1", "sha256", "sha512")
+            paths = []
+            for index, size in enumerate((0, 5, 4194304 * 2 + 3)):
+                path = os.path.join(tmp_dir, "file%d.iso" % (index,))
+                data = os.urandom(size)
+                with open(path, "wb") as tmp_f:
+                    tmp_f.write(data)
+                expected = dict((x, hashlib.new(x, data).hexdigest()) \
+                                    for x in algorithms)
+                for use_mmap in (None, True, False):
+                    self.assertEqual(file_digests(path, algorithms,
+                        use_mmap = use_mmap), expected)
+                paths.append((path, expected))
+
+            results = hash_files([x[0] for x in paths], algorithms,
+                workers = 2)
+            self.assertEqual(results, dict(paths))
+
+            written = write_digest_files([x[0] for x in paths],
+                ("md5", "sha256"))
+            self.assertEqual(len(written), 6)
+            path, expected = paths[1]
+            with open(path + ".sha256", "r") as digest_f:
+                self.assertEqual(digest_f.read(), "%s  %s\n" % (
+                    expected['sha256'], os.path.basename(path),))
+            self.assertEqual(md5sum(path), expected['md5'])
+        finally:
+            remove_path(tmp_dir)
+
     def test_copy_dir(self):
         tmp_dir1 = tempfile.mkdtemp(dir=os.getcwd())
         tmp_dir2 = tempfile.mkdtemp(dir=os.getcwd())
@@ -50,6 +86,143 @@ class UtilsTest(unittest.TestCase):
         os.remove(tmp_path2)
         os.rmdir(tmp_dir2)
 
+    def _make_tree(self, root):
+        os.makedirs(os.path.join(root, "a", "b"))
+        with open(os.path.join(root, "a", "file"), "w") as tmp_f:
+            tmp_f.write("hello")
+        os.link(os.path.join(root, "a", "file"),
+            os.path.join(root, "a", "b", "link"))
+        with open(os.path.join(root, "sparse"), "wb") as tmp_f:
+            tmp_f.seek(4 * 1048576)
+            tmp_f.write(b"end")
+        os.symlink("a/file", os.path.join(root, "symlink"))
+        os.mkfifo(os.path.join(root, "fifo"))
+        os.chmod(os.path.join(root, "a", "file"), 0o640)
+        os.chmod(os.path.join(root, "a", "b"), 0o555)
+        os.utime(os.path.join(root, "a"), (1000000000, 1000000000))
+
+    def _assert_same_tree(self, src, dest):
+        for root, dirs, files in os.walk(src):
+            for name in dirs + files:
+                src_path = os.path.join(root, name)
+                dest_path = os.path.join(dest, os.path.relpath(src_path, src))
+                src_st, dest_st = os.lstat(src_path), os.lstat(dest_path)
+                self.assertEqual(src_st.st_mode, dest_st.st_mode)
+                if not os.path.islink(src_path):
+                    self.assertEqual(int(src_st.st_mtime),
+                        int(dest_st.st_mtime))
+                if os.path.isfile(src_path) and \
+                        not os.path.islink(src_path):
+                    self.assertEqual(md5sum(src_path), md5sum(dest_path))
+
+    def test_copy_tree(self):
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        try:
+            src = os.path.join(tmp_dir, "src")
+            self._make_tree(src)
+            for mode in ("auto", "copy", "hardlink"):
+                dest = os.path.join(tmp_dir, mode)
+                stats = copy_tree(src, dest, mode = mode, workers = 2)
+                self._assert_same_tree(src, dest)
+                self.assertEqual(os.readlink(os.path.join(dest, "symlink")),
+                    "a/file")
+                # hard links inside the tree are preserved
+                self.assertEqual(
+                    os.stat(os.path.join(dest, "a", "file")).st_ino,
+                    os.stat(os.path.join(dest, "a", "b", "link")).st_ino)
+                self.assertEqual((stats.files, stats.directories,
+                    stats.symlinks, stats.special), (3, 3, 1, 1))
+                if mode == "hardlink":
+                    self.assertEqual(stats.hardlinks, 3)
+                else:
+                    self.assertEqual(stats.bytes, 4 * 1048576 + 8)
+                    self.assertNotEqual(
+                        os.stat(os.path.join(dest, "a", "file")).st_ino,
+                        os.stat(os.path.join(src, "a", "file")).st_ino)
+                self.assert_(stats.throughput() >= 0.0)
+                os.chmod(os.path.join(dest, "a", "b"), 0o755)
+
+            # merge into an existing directory, leaving it untouched
+            dest = os.path.join(tmp_dir, "existing")
+            os.mkdir(dest, 0o700)
+            with open(os.path.join(dest, "sparse"), "w") as tmp_f:
+                tmp_f.write("old")
+            with open(os.path.join(dest, "other"), "w") as tmp_f:
+                tmp_f.write("other")
+            self.assertEqual(copy_dir_existing_dest(src, dest), 0)
+            self._assert_same_tree(src, dest)
+            self.assert_(os.path.isfile(os.path.join(dest, "other")))
+            self.assertEqual(os.stat(dest).st_mode & 0o777, 0o700)
+            os.chmod(os.path.join(dest, "a", "b"), 0o755)
+            os.chmod(os.path.join(src, "a", "b"), 0o755)
+        finally:
+            remove_path(tmp_dir)
+
+    def test_sync_tree(self):
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        try:
+            src = os.path.join(tmp_dir, "src")
+            dest = os.path.join(tmp_dir, "dest")
+            self._make_tree(src)
+            os.chmod(os.path.join(src, "a", "b"), 0o755)
+            stats = sync_tree(src, dest)
+            self.assertEqual(stats.bytes, 4 * 1048576 + 8)
+            self._assert_same_tree(src, dest)
+
+            # nothing changed, nothing transferred
+            stats = sync_tree(src, dest)
+            self.assertEqual((stats.bytes, stats.files, stats.deleted),
+                (0, 0, 0))
+            self.assertEqual(stats.unchanged, 5)
+
+            with open(os.path.join(src, "a", "file"), "w") as tmp_f:
+                tmp_f.write("changed")
+            with open(os.path.join(src, "new"), "w") as tmp_f:
+                tmp_f.write("new")
+            os.remove(os.path.join(src, "fifo"))
+            os.symlink("new", os.path.join(src, "a", "b", "new-link"))
+            os.makedirs(os.path.join(dest, "stale", "dir"))
+            stats = sync_tree(src, dest)
+            self.assertEqual(stats.bytes, len("changed") + len("new"))
+            self.assertEqual(stats.deleted, 2)
+            self.assertEqual(sorted(os.listdir(dest)),
+                sorted(os.listdir(src)))
+            self._assert_same_tree(src, dest)
+            # the hard link has been recreated
+            self.assertEqual(
+                os.stat(os.path.join(dest, "a", "file")).st_ino,
+                os.stat(os.path.join(dest, "a", "b", "link")).st_ino)
+
+            # same size and mtime, only noticed comparing contents
+            path = os.path.join(src, "new")
+            st = os.stat(path)
+            with open(path, "w") as tmp_f:
+                tmp_f.write("NEW")
+            os.utime(path, (st.st_atime, st.st_mtime))
+            self.assertEqual(sync_tree(src, dest).bytes, 0)
+            self.assertEqual(sync_tree(src, dest, checksum = True).bytes, 3)
+            with open(os.path.join(dest, "new"), "r") as tmp_f:
+                self.assertEqual(tmp_f.read(), "NEW")
+
+            # copy_dir_existing_dest(sync = True) keeps dest attributes
+            os.chmod(dest, 0o700)
+            stats = CopyStats()
+            self.assertEqual(copy_dir_existing_dest(src, dest, sync = True,
+                stats = stats), 0)
+            self.assertEqual(os.stat(dest).st_mode & 0o777, 0o700)
+            self.assertEqual((stats.files, stats.bytes), (0, 0))
+            self.assert_(stats.unchanged > 0)
+
+            # and reports what has been transferred
+            with open(os.path.join(src, "new"), "w") as tmp_f:
+                tmp_f.write("NEWER")
+            stats = CopyStats()
+            self.assertEqual(copy_dir_existing_dest(src, dest, sync = True,
+                stats = stats), 0)
+            self.assertEqual((stats.files, stats.bytes), (1, 5))
+        finally:
+            remove_path(tmp_dir)
+
     def test_randint(self):
         self.assert_(get_random_number() in range(0, 99999))
 
@@ -95,6 +268,77 @@ class UtilsTest(unittest.TestCase):
         self.assert_(not os.listdir(tmp_dir1))
         os.rmdir(tmp_dir1)
 
+    def test_remove_tree(self):
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        try:
+            root = os.path.join(tmp_dir, "tree with spaces")
+            for index in range(10):
+                sub_dir = os.path.join(root, "d%d" % (index,), "sub")
+                os.makedirs(sub_dir)
+                for name in ("f 1", "f2"):
+                    with open(os.path.join(sub_dir, name), "w") as tmp_f:
+                        tmp_f.write("x")
+            os.symlink(tmp_dir, os.path.join(root, "d0", "link"))
+            os.chmod(os.path.join(root, "d1", "sub"), 0o555)
+
+            stats = RemoveStats()
+            self.assert_(remove_tree(root, workers = 3, stats = stats) \
+                is stats)
+            self.assert_(not os.path.lexists(root))
+            self.assertEqual((stats.files, stats.directories, stats.errors),
+                (21, 21, 0))
+            # symlinks are never followed
+            self.assert_(os.path.isdir(tmp_dir))
+
+            os.makedirs(os.path.join(root, "a"))
+            self.assertEqual(remove_tree(root, contents_only = True).
+                directories, 1)
+            self.assertEqual(os.listdir(root), [])
+            self.assertRaises(OSError, remove_tree,
+                os.path.join(tmp_dir, "missing"))
+
+            # remove_path() expands wildcards, without any shell involved
+            for name in ("a b", "a c", "b"):
+                os.makedirs(os.path.join(tmp_dir, name, "x"))
+            self.assertEqual(remove_path(os.path.join(tmp_dir, "a *")), 0)
+            self.assertEqual(sorted(os.listdir(tmp_dir)),
+                ["b", "tree with spaces"])
+            # existing paths are taken literally
+            os.makedirs(os.path.join(tmp_dir, "br[1]", "x"))
+            self.assertEqual(remove_path(os.path.join(tmp_dir, "br[1]")), 0)
+            self.assertEqual(sorted(os.listdir(tmp_dir)),
+                ["b", "tree with spaces"])
+        finally:
+            remove_path(tmp_dir)
+
+    def test_trash(self):
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        try:
+            trash = Trash(tmp_dir = tmp_dir)
+            trash_dir = os.path.join(tmp_dir, Trash.TRASH_DIR)
+            workspace = os.path.join(tmp_dir, "workspace")
+            os.makedirs(os.path.join(workspace, "a", "b"))
+            with open(os.path.join(workspace, "a", "file"), "w") as tmp_f:
+                tmp_f.write("x")
+
+            self.assert_(trash.trash(workspace))
+            # gone right away, removed in background
+            self.assert_(not os.path.lexists(workspace))
+            self.assert_(trash.wait(30))
+            self.assertEqual(trash.pending(), 0)
+            self.assertEqual(os.listdir(trash_dir), [])
+            self.assertEqual(os.stat(trash_dir).st_mode & 0o777, 0o700)
+
+            # leftovers of dead processes only
+            for name in ("999999999-0-dead", "%d-0-alive" % (os.getpid(),)):
+                os.makedirs(os.path.join(trash_dir, name, "dir"))
+            self.assert_(trash.reclaim() >= 1)
+            self.assert_(trash.wait(30))
+            self.assertEqual(os.listdir(trash_dir),
+                ["%d-0-alive" % (os.getpid(),)])
+        finally:
+            remove_path(tmp_dir)
+
     def test_exec_cmd_get_status_output(self):
         rc, output = exec_cmd_get_status_output(["echo", "hello"])
         self.assert_(rc == 0)
@@ -104,12 +348,95 @@ class UtilsTest(unittest.TestCase):
         rc = exec_cmd(["/bin/echo", "${TEST}"], env = {'TEST': "hello"})
         self.assert_(rc == 0)
 
+    def test_account_children(self):
+        usage = ChildUsage()
+        with account_children(usage):
+            self.assertEqual(exec_cmd(["sh", "-c", "exit 3"]), 3)
+            self.assertEqual(exec_cmd(["sh", "-c", "kill -9 $$"]), -9)
+        self.assertEqual(exec_cmd(["true"]), 0)
+        data = usage.as_dict()
+        self.assertEqual(data['processes'], 2)
+        self.assert_(data['max_rss'] > 0)
+        if os.path.isfile("/proc/self/io"):
+            self.assert_(data['read_chars'] is not None)
+
+    def test_eval_shell_argument(self):
+        # output is not truncated
+        self.assertEqual(len(eval_shell_argument("$(seq 1 2000)")), 8892)
+        self.assertRaises(AttributeError, eval_shell_argument, "$(exit 1)")
+
+    def test_shell_evaluator(self):
+        env = {'TEST': "hello", 'PATH': os.getenv("PATH", "/bin:/usr/bin")}
+        evaluator = ShellEvaluator(shell = "/bin/sh", env = env)
+        try:
+            for arg in ("${TEST}", "x$(echo y)z", "it's", "a\nb"):
+                self.assertEqual(evaluator.evaluate(arg),
+                    eval_shell_argument(arg, env = env))
+            # errors: exit status, empty result, broken syntax
+            for arg in ("$(exit 3)", "${NOT_SET}", "$(echo"):
+                self.assertRaises(AttributeError, evaluator.evaluate, arg)
+            # shell state does not leak between arguments
+            self.assertEqual(evaluator.evaluate("${X:=1}"), b"1")
+            self.assertRaises(AttributeError, evaluator.evaluate, "${X}")
+        finally:
+            evaluator.close()
+
     def test_is_exec_available(self):
         self.assert_(is_exec_available("/bin/echo"))
+        self.assert_(is_exec_available("sh"))
+        self.assert_(not is_exec_available("this-does-not-exist-for-sure"))
+
+    def test_executable_index(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            bin_dir = os.path.join(tmp_dir, "bin")
+            os.mkdir(bin_dir)
+            exe = os.path.join(bin_dir, "tool")
+            with open(exe, "w") as exe_f:
+                exe_f.write("#!/bin/sh\n")
+            os.chmod(exe, 0o755)
+            with open(os.path.join(bin_dir, "data"), "w") as data_f:
+                data_f.write("\n")
+            paths = "%s:%s" % (os.path.join(tmp_dir, "missing"), bin_dir,)
+
+            index = ExecutableIndex()
+            self.assertEqual(index.lookup("tool", paths = paths), exe)
+            self.assertEqual(index.lookup("data", paths = paths), None)
+            self.assertEqual(index.lookup("other", paths = paths), None)
+
+            # permission changes do not touch the directory mtime
+            mtime = os.stat(bin_dir).st_mtime
+            os.chmod(exe, 0o644)
+            self.assertEqual(os.stat(bin_dir).st_mtime, mtime)
+            self.assertEqual(index.lookup("tool", paths = paths), None)
+            os.chmod(exe, 0o755)
+            self.assertEqual(index.lookup("tool", paths = paths), exe)
+
+            # new entries are picked up once the directory mtime changes
+            other = os.path.join(bin_dir, "other")
+            os.symlink(exe, other)
+            os.utime(bin_dir, (0, 0))
+            self.assertEqual(index.lookup("other", paths = paths), other)
+            os.remove(exe)
+            os.utime(bin_dir, (1, 1))
+            self.assertEqual(index.lookup("tool", paths = paths), None)
+            self.assertEqual(index.lookup("other", paths = paths), None)
+
+            # a directory replaced keeping the same mtime is noticed too
+            os.rename(bin_dir, bin_dir + ".old")
+            os.mkdir(bin_dir)
+            os.symlink("/bin/sh", os.path.join(bin_dir, "tool"))
+            os.utime(bin_dir, (1, 1))
+            self.assertEqual(index.lookup("tool", paths = paths),
+                os.path.join(bin_dir, "tool"))
+        finally:
+            remove_path(tmp_dir)
 
     def test_valid_exec_check(self):
         self.assertRaises(EnvironmentError,
             valid_exec_check, "/bin/this-does-not-exist-for-sure")
+        self.assertRaises(EnvironmentError,
+            valid_exec_check, "this-does-not-exist-for-sure")
 
     def test_get_year(self):
         year = int(get_year())